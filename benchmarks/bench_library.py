@@ -0,0 +1,67 @@
+import argparse
+
+import pytest
+
+from gtunes import db
+from gtunes import parse
+from gtunes.scripts import cli
+
+def _list_args(**filters):
+    args = {"name": None, "type": None, "status": None, "key": None, "rhythm": None}
+    args.update(filters)
+    return argparse.Namespace(**args)
+
+def _closing(fn, *args):
+    # Not every command closes the database when it's done
+    def run():
+        fn(*args)
+        if not db.db.is_closed():
+            db.close_db()
+    return run
+
+@pytest.mark.benchmark(group="open_db")
+def test_open_db(benchmark, library, size):
+    benchmark(_closing(db.open_db))
+
+@pytest.mark.benchmark(group="tune_list")
+def test_tune_list(benchmark, library, size, capsys):
+    benchmark(_closing(cli.tune_list, _list_args()))
+
+@pytest.mark.benchmark(group="tune_list_filtered")
+def test_tune_list_filtered(benchmark, library, size, capsys):
+    benchmark(_closing(cli.tune_list, _list_args(type="REEL", status="2")))
+
+@pytest.mark.benchmark(group="export")
+def test_export_csv(benchmark, library, size, tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    benchmark(_closing(cli.export, argparse.Namespace(c=True)))
+
+@pytest.mark.benchmark(group="select_tune")
+def test_select_tune_choices(benchmark, library, size, monkeypatch):
+    # Only building the list of choices, not the prompt itself
+    class NoAnswer:
+        def ask(self):
+            return None
+    monkeypatch.setattr(db.questionary, "autocomplete", lambda *args, **kwargs: NoAnswer())
+
+    db.open_db()
+    try:
+        benchmark(db.select_tune, "Choose a tune")
+    finally:
+        db.close_db()
+
+@pytest.mark.benchmark(group="parse")
+def test_parse_tune_list(benchmark, tune_list_path, size, capsys):
+    database_path = db.db.database
+
+    def fresh_db():
+        db.db.close()
+        db.db.init(":memory:", pragmas={'foreign_keys': 1})
+        db.db.connect()
+        db.db.create_tables(db.TABLES)
+
+    try:
+        benchmark.pedantic(lambda: parse.TuneListParser(tune_list_path).parse(), setup=fresh_db, rounds=3)
+    finally:
+        db.db.close()
+        db.db.init(database_path, pragmas={'foreign_keys': 1})
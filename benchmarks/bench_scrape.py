@@ -0,0 +1,62 @@
+import os
+
+import bs4
+import pytest
+
+from benchmarks import generate
+from gtunes import htmlextract
+from gtunes import httpfixtures
+
+# Recordings per generated page
+PAGE_SIZES = [10, 100, 1000]
+
+# Parsers compared, with the whole page BeautifulSoup tree the scraper used to build
+PARSERS = htmlextract.available_parsers() + ["full soup"]
+
+def _recorded_pages() -> list:
+    """
+    The recordings pages of GTUNES_HTTP_FIXTURES, if it's set to an archive.
+    """
+    path = os.getenv("GTUNES_HTTP_FIXTURES")
+    if not path or not os.path.exists(path):
+        return []
+    archive = httpfixtures.FixtureArchive(path)
+    return [(key, entry["body"]) for key, entry in sorted(archive.entries.items())
+            if key.endswith("/recordings") and entry["status"] == 200]
+
+# Pages by size: the number of recordings, or the path of a recorded one
+PAGES = dict([(f"{n} recordings", generate.generate_recordings_page(n)) for n in PAGE_SIZES]
+             + _recorded_pages())
+
+def _full_soup(page: str) -> list:
+    soup = bs4.BeautifulSoup(page, "html.parser")
+    return soup.find_all("li", class_="manifest-item")
+
+def _chunks(page: str, size: int = 16 * 1024) -> list:
+    data = page.encode("utf-8")
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+@pytest.mark.benchmark(group="extract manifest items")
+@pytest.mark.parametrize("parser", PARSERS)
+@pytest.mark.parametrize("size", PAGES)
+def test_extract(benchmark, parser, size):
+    html = PAGES[size]
+    if parser == "full soup":
+        items = benchmark(_full_soup, html)
+    else:
+        items = benchmark(htmlextract.extract, html, htmlextract.MANIFEST_ITEMS, parser)
+    assert len(items) == html.count('class="manifest-item"')
+
+@pytest.mark.benchmark(group="first manifest item")
+@pytest.mark.parametrize("parser", htmlextract.available_parsers())
+@pytest.mark.parametrize("size", PAGES)
+def test_first_item(benchmark, parser, size):
+    """
+    Time until the first item of a page given in chunks, as it's downloaded.
+    """
+    chunks = _chunks(PAGES[size])
+
+    def first():
+        return next(htmlextract.iter_extract(chunks, htmlextract.MANIFEST_ITEMS, parser))
+
+    assert benchmark(first).find("a", class_="manifest-item-title") is not None
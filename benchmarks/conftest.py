@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+from benchmarks import generate
+from gtunes import db
+
+# Library sizes to benchmark. 100k and 1M take a while to generate the first time,
+# e.g. GTUNES_BENCH_SIZES=1000,10000,100000,1000000
+SIZES = [int(size) for size in os.getenv("GTUNES_BENCH_SIZES", "1000,10000").split(",")]
+
+# Generated databases are kept between runs, as generating the big ones is slow
+DATA_DIR = os.getenv("GTUNES_BENCH_DATA_DIR", os.path.join(os.path.dirname(__file__), ".data"))
+
+def pytest_generate_tests(metafunc):
+    # Unless the benchmark has sizes of its own
+    if "size" in metafunc.fixturenames and not any(
+            marker.args[0] == "size" for marker in metafunc.definition.iter_markers("parametrize")):
+        metafunc.parametrize("size", SIZES, scope="session")
+
+@pytest.fixture(scope="session")
+def library_path(size):
+    os.makedirs(DATA_DIR, exist_ok=True)
+    path = os.path.join(DATA_DIR, f"library-{size}-v{generate.GENERATOR_VERSION}.db")
+    if not os.path.exists(path):
+        generate.generate_library(path + ".tmp", size)
+        os.replace(path + ".tmp", path)
+
+    return path
+
+@pytest.fixture
+def library(library_path):
+    """
+    Points the gtunes database at a generated library, unopened, for the duration
+    of a benchmark.
+    """
+    database_path = db.db.database
+    db.db.init(library_path, pragmas={'foreign_keys': 1})
+
+    yield library_path
+
+    db.db.close()
+    db.db.init(database_path, pragmas={'foreign_keys': 1})
+
+@pytest.fixture(scope="session")
+def tune_list_path(size, tmp_path_factory):
+    return generate.generate_tune_list(str(tmp_path_factory.mktemp("tune_lists") / f"tunes-{size}.md"), size)
@@ -0,0 +1,182 @@
+# Deterministic synthetic data for the benchmarks.
+#
+# Builds tune databases of any size, with recordings linked to their tunes, and
+# tune list files in the format TuneListParser reads. The same size and seed always
+# give the same data, so results are comparable between commits.
+#
+#   python -m benchmarks.generate --tunes 100000 library.db
+#   python -m benchmarks.generate --tunes 100000 --tune-list tunes.md
+
+import argparse
+import os
+import random
+
+from peewee import chunked
+
+from gtunes import db
+
+# Bump when the generated data changes so cached databases are rebuilt
+GENERATOR_VERSION = 1
+
+BATCH_SIZE = 500
+
+_FIRST_WORDS = ["Humours of", "Road to", "Lass of", "Star of", "Boys of", "Maid of", "Rose of", "Lark on",
+                "Pride of", "Banks of", "Hills of", "Wind that Shakes", "Gold Ring of", "Plains of"]
+_SECOND_WORDS = ["Ballyvourney", "Tulla", "Kilkenny", "Lisdoonvarna", "the Strand", "Dublin", "Ennis",
+                 "Sligo", "Mullaghbawn", "Glendart", "Carrick", "Bunker Hill", "Tipperary", "Coolea"]
+_KEYS = ["D", "G", "A", "E", "Dmix", "Ador", "Edor", "Bm", "Em", "Amix", "Gmaj", "C"]
+_TYPES = ["reel", "jig", "slip jig", "hornpipe", "polka", "slide", "hop jig"]
+_ARTISTS = ["Kevin Burke", "Matt Molloy", "Mary Bergin", "Bobby Casey", "Tommy Peoples", "Noel Hill"]
+
+def tune_name(rng: random.Random, i: int) -> str:
+    """
+    A plausible tune name that's unique for each i.
+    """
+    return f"The {rng.choice(_FIRST_WORDS)} {rng.choice(_SECOND_WORDS)} No. {i}"
+
+def tune_rows(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    for i in range(count):
+        yield {
+            "name": tune_name(rng, i),
+            "key": rng.choice(_KEYS),
+            "type": rng.choice(_TYPES).upper(),
+            "status": rng.randint(db.Status.TODO.value, db.Status.MASTERED.value),
+            "ts_id": rng.randint(1, 25000) if rng.random() < 0.6 else None,
+            "comments": f"from {rng.choice(_ARTISTS)}" if rng.random() < 0.2 else None,
+        }
+
+def generate_library(path: str, tunes: int, seed: int = 0, recordings_per_tune: float = 0.5) -> str:
+    """
+    Write a tune database of the given number of tunes to path, along with
+    recordings of one to three tunes each.
+
+    Returns:
+        path
+    """
+    rng = random.Random(seed)
+    recordings = int(tunes * recordings_per_tune)
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    previous_path = db.db.database
+    # Nothing to lose if generation is interrupted, so skip the journal
+    db.db.init(path, pragmas={'foreign_keys': 1, 'journal_mode': 'off', 'synchronous': 0})
+    try:
+        db.db.connect()
+        db.db.create_tables(db.TABLES)
+        with db.db.atomic():
+            for batch in chunked(tune_rows(tunes, seed), BATCH_SIZE):
+                db.Tune.insert_many(batch).execute()
+
+            recording_rows = ({
+                "name": f"Track {i}",
+                "url": f"https://open.spotify.com/track/{rng.getrandbits(80):020x}",
+                "source": db.RecordingSource.SPOTIFY.value,
+                "artist": rng.choice(_ARTISTS),
+                "album": f"Album {i // 10}",
+            } for i in range(recordings))
+            for batch in chunked(recording_rows, BATCH_SIZE):
+                db.Recording.insert_many(batch).execute()
+
+            link_rows = []
+            for recording_id in range(1, recordings + 1):
+                start = 0
+                for tune_id in rng.sample(range(1, tunes + 1), rng.randint(1, min(3, tunes))):
+                    length = rng.randint(60, 180)
+                    link_rows.append({"tune": tune_id, "recording": recording_id,
+                                      "start_time_secs": start, "end_time_secs": start + length})
+                    start += length
+            for batch in chunked(link_rows, BATCH_SIZE):
+                db.RecordingTune.insert_many(batch).execute()
+    finally:
+        db.db.close()
+        db.db.init(previous_path, pragmas={'foreign_keys': 1})
+
+    return path
+
+def generate_tune_list(path: str, tunes: int, seed: int = 0) -> str:
+    """
+    Write a tune list of the given number of tunes in the format TuneListParser reads:
+    tunes to learn, tunes to practice, then learned tunes grouped by type and key.
+
+    Returns:
+        path
+    """
+    rng = random.Random(seed)
+    learn = tunes // 3
+    practice = tunes // 3
+
+    with open(path, "w") as tune_list:
+        tune_list.write("LEARN:\n")
+        for i in range(tunes):
+            if i == learn:
+                tune_list.write("PRACTICE:\n")
+            elif i == learn + practice:
+                tune_list.write("REELS:\n")
+
+            if i >= learn + practice:
+                if i % 20 == 0:
+                    tune_list.write(f"{rng.choice(_KEYS)}:\n")
+                # Learned tunes are listed bare, lower case so names aren't taken for keys
+                tune_list.write(f"- {tune_name(rng, i).lower()}\n")
+            else:
+                metadata = [rng.choice(_KEYS), rng.choice(_TYPES)]
+                if rng.random() < 0.2:
+                    metadata.append(f"from {rng.choice(_ARTISTS).lower()}")
+                tune_list.write(f"- {tune_name(rng, i)} - {', '.join(metadata)}\n")
+
+    return path
+
+def generate_recordings_page(recordings: int, seed: int = 0) -> str:
+    """
+    A page in the shape of TheSession's list of a tune's recordings, chrome and
+    all, with the given number of recordings.
+    """
+    rng = random.Random(seed)
+    items = []
+    for i in range(recordings):
+        artist = rng.choice(_ARTISTS)
+        items.append(f"""
+  <li class="manifest-item">
+    <a class="manifest-item-title" href="/recordings/{1000 + i}?tune_id=1">{tune_name(rng, i)}</a>
+    <span class="bill-item-cost">by <a href="/artists/{_ARTISTS.index(artist)}">{artist}</a></span>
+    <p class="manifest-item-details">{rng.randint(1, 20)} tracks, added {rng.randint(2001, 2025)}</p>
+  </li>""")
+
+    nav = "".join(f'<li><a href="/{section}">{section.title()}</a></li>'
+                  for section in ("tunes", "recordings", "sessions", "events", "discussions", "members"))
+    return f"""<!DOCTYPE html>
+<html lang="en">
+<head><meta charset="utf-8"><title>Recordings of The Ashplant</title>
+<link rel="stylesheet" href="/css/main.css"><script src="/js/main.js" defer></script></head>
+<body>
+<nav><ul>{nav}</ul></nav>
+<main>
+<h1>Recordings of The Ashplant</h1>
+<ol class="manifest-inventory">{"".join(items)}
+</ol>
+</main>
+<footer><p>The Session is a community website dedicated to Irish traditional music.</p></footer>
+</body>
+</html>
+"""
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic gtunes data for benchmarking")
+    parser.add_argument("outfile", help="Database, or tune list with --tune-list, to write")
+    parser.add_argument("--tunes", type=int, default=10000, help="Number of tunes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tune-list", action="store_true", help="Write a tune list rather than a database")
+    args = parser.parse_args()
+
+    if args.tune_list:
+        generate_tune_list(args.outfile, args.tunes, args.seed)
+    else:
+        generate_library(args.outfile, args.tunes, args.seed)
+
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,257 @@
+# Helpers for working with abc notation: https://abcnotation.com/wiki/abc:standard:v2.1
+
+import re
+
+# Header fields pulled out of a setting when it is stored
+HEADER_FIELDS = {
+    "K": "key",
+    "M": "meter",
+    "L": "unit_length",
+    "R": "rhythm",
+}
+
+_MODE_ALIASES = {
+    "": "maj",
+    "maj": "maj",
+    "major": "maj",
+    "ion": "maj",
+    "ionian": "maj",
+    "m": "min",
+    "min": "min",
+    "minor": "min",
+    "aeo": "min",
+    "aeolian": "min",
+    "mix": "mix",
+    "mixolydian": "mix",
+    "dor": "dor",
+    "dorian": "dor",
+    "phr": "phr",
+    "phrygian": "phr",
+    "lyd": "lyd",
+    "lydian": "lyd",
+    "loc": "loc",
+    "locrian": "loc",
+}
+
+_HEADER_PATTERN = re.compile(r"^([A-Za-z]):\s*(.*?)\s*$")
+_KEY_PATTERN = re.compile(r"^([A-Ga-g])([#b♯♭]?)\s*([A-Za-z]*)")
+
+def parse_headers(abc_string: str) -> dict:
+    """
+    Returns:
+        The first value of each header field in HEADER_FIELDS, keyed by field name,
+        e.g. {"key": "Dmix", "meter": "4/4", "unit_length": "1/8", "rhythm": "reel"}.
+        Keys are normalized with normalize_key and rhythms are lowercased.
+        Missing fields are None.
+    """
+    headers = {name: None for name in HEADER_FIELDS.values()}
+
+    for line in abc_string.splitlines():
+        match = _HEADER_PATTERN.match(line.strip())
+        if not match:
+            continue
+
+        field = HEADER_FIELDS.get(match.group(1))
+        if field and headers[field] is None:
+            headers[field] = match.group(2)
+
+        # The key is the last header field. The tune body follows it.
+        if match.group(1) == "K":
+            break
+
+    if headers["key"] is not None:
+        headers["key"] = normalize_key(headers["key"])
+    if headers["rhythm"] is not None:
+        headers["rhythm"] = headers["rhythm"].lower()
+
+    return headers
+
+def normalize_key(key: str) -> str | None:
+    """
+    Normalize the many ways of writing a key to a tonic and three letter mode.
+
+    e.g. "D Mixolydian", "Dmixolydian" and "DMix" all become "Dmix", and
+    "Em" and "Eminor" become "Emin".
+
+    Returns:
+        The normalized key, or None if it couldn't be parsed.
+    """
+    match = _KEY_PATTERN.match(key.strip())
+    if not match:
+        return None
+
+    tonic = match.group(1).upper()
+    accidental = match.group(2).replace("♯", "#").replace("♭", "b")
+    mode = _MODE_ALIASES.get(match.group(3).lower())
+    if mode is None:
+        # Things like "Edorian clef=bass" or an unknown mode spelling. Go by the
+        # first three letters since that's what abc itself does.
+        mode = _MODE_ALIASES.get(match.group(3)[:3].lower(), "maj")
+
+    return f"{tonic}{accidental}{mode}"
+
+# Semitones above C of each note letter
+_NOTE_SEMITONES = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+
+# Number of sharps (negative for flats) in the major key of each tonic
+_MAJOR_SHARPS = {
+    "C": 0, "G": 1, "D": 2, "A": 3, "E": 4, "B": 5, "F#": 6, "C#": 7,
+    "F": -1, "Bb": -2, "Eb": -3, "Ab": -4, "Db": -5, "Gb": -6, "Cb": -7,
+    # Tonics with no conventional major key signature
+    "G#": 8, "D#": 9, "A#": 10, "E#": 11, "B#": 12, "Fb": -8,
+}
+
+# Sharps relative to the major key of the same tonic
+_MODE_SHARPS = {"lyd": 1, "maj": 0, "mix": -1, "dor": -2, "min": -3, "phr": -4, "loc": -5}
+
+_SHARP_ORDER = "FCGDAEB"
+
+# Bits of the body that don't contain notes: "chord symbols", !decorations!,
+# +decorations+, {grace notes}, inline comments and lyric/field lines
+_NON_NOTE_PATTERN = re.compile(r'"[^"]*"|![^!]*!|\+[^+\s]*\+|\{[^}]*\}')
+_BODY_TOKEN_PATTERN = re.compile(r"\[([KLM]):([^\]]*)\]|(\|)|([\^_=]*)([A-Ga-g])([,']*)")
+
+def key_sharps(key: str | None) -> int | None:
+    """
+    Returns:
+        Number of sharps, or negative number of flats, in the signature of a
+        normalized key, e.g. 2 for Dmaj and Edor. None for an unknown or missing key.
+    """
+    if not key:
+        return None
+
+    mode = key[-3:]
+    tonic = key[:-3]
+    if tonic not in _MAJOR_SHARPS or mode not in _MODE_SHARPS:
+        return None
+
+    return _MAJOR_SHARPS[tonic] + _MODE_SHARPS[mode]
+
+def tonic_semitone(key: str | None) -> int | None:
+    """
+    Returns:
+        Semitones above C of the tonic of a normalized key, from 0 to 11.
+    """
+    if not key or key[:1] not in _NOTE_SEMITONES:
+        return None
+
+    tonic = key[:-3]
+    return (_NOTE_SEMITONES[tonic[0]] + tonic.count("#") - tonic.count("b")) % 12
+
+def key_signature(key: str | None) -> dict:
+    """
+    Returns:
+        Map of note letter to semitone alteration for a normalized key, e.g.
+        {"F": 1, "C": 1} for Dmaj. Empty for an unknown or missing key.
+    """
+    sharps = key_sharps(key)
+    if sharps is None:
+        return {}
+
+    signature = {}
+    for i in range(abs(sharps) % 8):
+        if sharps > 0:
+            signature[_SHARP_ORDER[i]] = 1
+        else:
+            signature[_SHARP_ORDER[-1 - i]] = -1
+
+    return signature
+
+def pitches(abc_string: str, key: str | None = None) -> list:
+    """
+    Extract the melody of an abc tune as a list of semitone pitches, with middle C
+    as 60. Key signatures, inline key changes and bar-local accidentals are applied.
+    Durations, rests, chord symbols, decorations and grace notes are ignored, and
+    only the first note of a chord is used.
+
+    Args:
+        abc_string: a full tune or just a fragment of its body
+        key: key to use if the abc has no K: field, normalized or not
+
+    Returns:
+        List of pitches in the order they are written (repeats aren't expanded)
+    """
+    signature = key_signature(normalize_key(key) if key else None)
+    body_lines = []
+    in_body = False
+    for line in abc_string.splitlines():
+        line = line.split("%", 1)[0].strip()
+        match = _HEADER_PATTERN.match(line)
+        if match:
+            if match.group(1) == "K":
+                signature = key_signature(normalize_key(match.group(2)))
+                in_body = True
+            continue
+        if line:
+            body_lines.append(line)
+            in_body = True
+
+    if not in_body:
+        return []
+
+    output = []
+    bar_accidentals = {}
+    in_chord = False
+    body = _NON_NOTE_PATTERN.sub(" ", " ".join(body_lines))
+    position = 0
+    while position < len(body):
+        char = body[position]
+        if char == "[" and not body.startswith(("[K:", "[L:", "[M:"), position) \
+                and position + 1 < len(body) and body[position + 1] not in "|0123456789":
+            in_chord = True
+            chord_has_note = False
+            position += 1
+            continue
+        if char == "]" and in_chord:
+            in_chord = False
+            position += 1
+            continue
+
+        match = _BODY_TOKEN_PATTERN.match(body, position)
+        if not match:
+            position += 1
+            continue
+        position = match.end()
+
+        if match.group(1) == "K":
+            signature = key_signature(normalize_key(match.group(2)))
+            bar_accidentals = {}
+            continue
+        if match.group(1):
+            continue
+        if match.group(3):
+            bar_accidentals = {}
+            continue
+
+        accidental, letter, octave_marks = match.group(4), match.group(5), match.group(6)
+        upper = letter.upper()
+        if accidental:
+            alteration = accidental.count("^") - accidental.count("_")
+            bar_accidentals[(letter, octave_marks)] = alteration
+        else:
+            alteration = bar_accidentals.get((letter, octave_marks), signature.get(upper, 0))
+
+        if in_chord:
+            if chord_has_note:
+                continue
+            chord_has_note = True
+
+        pitch = 60 + _NOTE_SEMITONES[upper] + alteration
+        if letter.islower():
+            pitch += 12
+        pitch += 12 * octave_marks.count("'") - 12 * octave_marks.count(",")
+        output.append(pitch)
+
+    return output
+
+def intervals(pitch_list: list) -> list:
+    """
+    Key invariant form of a melody: the semitone steps between consecutive notes,
+    with repeated notes collapsed so that "A2" and "AA" look the same.
+    """
+    steps = []
+    for previous, current in zip(pitch_list, pitch_list[1:]):
+        if current != previous:
+            steps.append(current - previous)
+
+    return steps
@@ -1,5 +1,9 @@
+import requests
+import requests.adapters
 import spotipy
+from spotipy.cache_handler import CacheFileHandler
 from spotipy.oauth2 import SpotifyOAuth
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 import os
 from time import sleep
@@ -9,6 +13,36 @@ from Levenshtein import distance
 import re
 from dataclasses import dataclass
 from gtunes import db
+from gtunes import fakespot
+from gtunes import profiling
+from gtunes import scheduler
+from gtunes import util
+
+glog = util.get_logger()
+
+SPOTIFY_SCOPE = "user-modify-playback-state user-read-playback-state"
+
+# The access token is refreshed this long before it expires, so requests never
+# wait on it. Spotify tokens last an hour.
+TOKEN_REFRESH_MARGIN_SECS = 300
+# How long to wait before trying again when a refresh fails
+TOKEN_RETRY_SECS = 30
+# How often to look for a token when none is cached yet, as before the first login
+TOKEN_POLL_SECS = 10
+
+# Connections kept open to the Spotify API, enough for the TUI's worker threads
+SPOTIFY_POOL_SIZE = 16
+
+# The retries spotipy makes when it builds its own session
+SPOTIFY_RETRIES = Retry(total=3, connect=None, read=False, status=3, backoff_factor=0.3,
+                        status_forcelist=spotipy.Spotify.default_retry_codes,
+                        allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]))
+
+# The client shared by the whole process, see connect_to_spotify, and the
+# thread refreshing its token
+_client = None
+_refresher = None
+_client_lock = threading.Lock()
 
 @dataclass
 class SpotTuneTrackData():
@@ -23,6 +57,9 @@ class SpotTuneTrackData():
     track_name: str = ""
     artist_name: str = ""
     tune: db.Tune = None
+    # The album as TheSession names it, and how well the Spotify album matched it
+    session_album_name: str = ""
+    score: float = 0.0
 
 
 def print_debug(debug_str):
@@ -45,32 +82,162 @@ class Track:
         self.start = time_to_ms(start) if start else 0
         self.end = time_to_ms(end) if end else end
 
-def connect_to_spotify():
+class _ProfiledClient:
+    """
+    Wraps every method call of a Spotify client in a span.
+    """
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with profiling.span(f"spotify {name}"):
+                return attr(*args, **kwargs)
+        return call
+
+def token_cache_path() -> str:
+    return os.path.join(util.get_data_dir(), "spotify_token.json")
+
+class _TokenRefresher(threading.Thread):
+    """
+    Refreshes the cached access token TOKEN_REFRESH_MARGIN_SECS before it expires,
+    until stopped or the process exits.
+    """
+    def __init__(self, auth_manager: SpotifyOAuth):
+        super().__init__(name="spotify token refresher", daemon=True)
+        self._auth_manager = auth_manager
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            token = self._auth_manager.cache_handler.get_cached_token()
+            if not token or "refresh_token" not in token:
+                # Logging in needs the user, so it's left to the first request.
+                # Wait for it to cache a token.
+                self.stop_event.wait(TOKEN_POLL_SECS)
+                continue
+
+            wait = token["expires_at"] - TOKEN_REFRESH_MARGIN_SECS - time.time()
+            if wait > 0:
+                self.stop_event.wait(wait)
+                continue
+
+            try:
+                with profiling.span("spotify refresh token"):
+                    self._auth_manager.refresh_access_token(token["refresh_token"])
+                glog.debug("Refreshed Spotify token")
+            except (spotipy.SpotifyOauthError, requests.RequestException) as e:
+                glog.debug(f"Spotify token refresh failed, trying again in {TOKEN_RETRY_SECS}s: {e}")
+                self.stop_event.wait(TOKEN_RETRY_SECS)
+
+    def stop(self):
+        self.stop_event.set()
+
+def _build_client():
+    """
+    Returns:
+        A new Spotify client, and the thread refreshing its token if it has one
+    """
     load_dotenv()
 
-    client_id = os.getenv("SPOTIPY_CLIENT_ID")
-    client_secret = os.getenv("SPOTIPY_CLIENT_SECRET")
-    redirect_uri = os.getenv("SPOTIPY_REDIRECT_URI")
+    if os.getenv("GTUNES_SPOTIFY_BACKEND", "spotify") == "fake":
+        return fakespot.from_env(), None
 
-    sp = spotipy.Spotify(auth_manager=SpotifyOAuth(client_id=client_id,
-                                                   client_secret=client_secret,
-                                                   redirect_uri=redirect_uri,
-                                                   scope="user-modify-playback-state user-read-playback-state"))
-    
-    return sp
+    # One pool of connections for the auth manager and the client. Sessions are
+    # safe to share between threads as long as nothing changes their settings.
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=SPOTIFY_POOL_SIZE,
+                                            max_retries=SPOTIFY_RETRIES)
+    session.mount("https://", adapter)
+    scheduler.schedule(session)
+
+    auth_manager = SpotifyOAuth(client_id=os.getenv("SPOTIPY_CLIENT_ID"),
+                                client_secret=os.getenv("SPOTIPY_CLIENT_SECRET"),
+                                redirect_uri=os.getenv("SPOTIPY_REDIRECT_URI"),
+                                scope=SPOTIFY_SCOPE,
+                                cache_handler=CacheFileHandler(cache_path=token_cache_path()),
+                                requests_session=session)
+    refresher = _TokenRefresher(auth_manager)
+    refresher.start()
+
+    return spotipy.Spotify(auth_manager=auth_manager, requests_session=session), refresher
+
+def connect_to_spotify():
+    """
+    The Spotify client shared by the whole process, made on the first call.
+
+    Its token is cached in the data dir and kept fresh by a background thread, and
+    it keeps a pool of connections open, so calls don't wait on logging in or
+    connecting.
+
+    Returns:
+        The Spotify client, or an in-process fake of it if GTUNES_SPOTIFY_BACKEND
+        is "fake" (see fakespot).
+    """
+    global _client, _refresher
+    with _client_lock:
+        if _client is None:
+            _client, _refresher = _build_client()
+            if profiling.enabled:
+                _client = _ProfiledClient(_client)
+
+        return _client
+
+def reset_spotify_client() -> None:
+    """
+    Make the next connect_to_spotify build a new client, e.g. after the backend
+    settings change. Stops the old client's token refresher.
+    """
+    global _client, _refresher
+    with _client_lock:
+        if _refresher is not None:
+            _refresher.stop()
+        _client = None
+        _refresher = None
+
+def spot_play_track(track_uri, sp, retries=3, delay=7, position_ms=0, log_fn = print, device_id: str = None) -> bool:
+    """
+    Start playing a track, retrying if Spotify has no device to play it on.
+
+    Args:
+        device_id: the device to play on, the active one if None
 
-def spot_play_track(track_uri, sp, retries=3, delay=7, position_ms=0, log_fn = print) -> None:
-    for _ in range(retries + 1):
+    Returns:
+        Whether playback started.
+    """
+    for attempt in range(retries + 1):
         try:
-            sp.start_playback(uris=[track_uri], position_ms=position_ms)
+            sp.start_playback(device_id=device_id, uris=[track_uri], position_ms=position_ms)
+            return True
 
         except spotipy.exceptions.SpotifyException as e:
             if e.reason == "NO_ACTIVE_DEVICE":
                 log_fn("Unable to determine which device to play on. Try briefly pressing play on target device.")
-                log_fn(f"Trying again in {delay} seconds")
-                time.sleep(delay)
+                if attempt < retries:
+                    log_fn(f"Trying again in {delay} seconds")
+                    time.sleep(delay)
             else:
                 raise e
+
+    return False
+
+def spot_pick_device(devices: list) -> str | None:
+    """
+    Choose a device to play on from sp.devices()["devices"]: the active one, or
+    else the first that accepts commands.
+
+    Returns:
+        The device id, or None if there's nothing to play on.
+    """
+    usable = [d for d in devices if not d.get("is_restricted")]
+    for device in usable:
+        if device.get("is_active"):
+            return device["id"]
+    return usable[0]["id"] if usable else None
             
 def spot_pause_track(track_uri: str, sp: spotipy.Spotify) -> None:
     sp.pause_playback()
@@ -87,7 +254,6 @@ def listen_for_input():
 stop_loop = False
 
 def loop_track(track, sp):
-    sp = connect_to_spotify()
     sp.start_playback(uris=[track.uri], position_ms=track.start)
 
     # Function to listen for user input
@@ -122,30 +288,46 @@ def levenshtein_string_similarity(string1, string2):
     return dist
 
 
-def spot_search_albums(album_name: str, sp: spotipy.Spotify, artist_name: str = None) -> dict | None:
+# Lowest similarity of names taken as the same album or artist
+MATCH_THRESHOLD = .8
+
+def spot_match_album(album_name: str, sp: spotipy.Spotify, artist_name: str = None) -> tuple | None:
     """
-    Search for album_name and compare title similarity using the Levenshtein algorithm.
-    If artist name is passed in, it will also compare that using Levenshtein.
-    It will try to detect multiple artists and compare each of them individually to each artist
-    who made a given album.
+    spot_search_albums, with how well the match scored.
+
+    Returns:
+        (album, album name similarity, artist name similarity) of the first match,
+        the artist similarity being 1.0 if no artist was passed in, or None.
     """
     results = sp.search(album_name, type='album')
 
     for alb in results['albums']['items']:
         result_name = alb['name']
-        if levenshtein_string_similarity(album_name, result_name) > .8:
+        album_score = levenshtein_string_similarity(album_name, result_name)
+        if album_score > MATCH_THRESHOLD:
             if not artist_name:
-                return alb
+                return alb, album_score, 1.0
             
             # Split artist_name string on common deliminters
             for arg_artist in re.split("and|[&,]", artist_name, flags=re.IGNORECASE):
                 # For now we have "big hammer" approach of: if any spotify artist matches any
                 # passed in artist, that's enough. This could be refined in the future.
                 for spot_artist in alb['artists']:
-                    if levenshtein_string_similarity(arg_artist, spot_artist['name']) > .8:
-                        return alb
+                    artist_score = levenshtein_string_similarity(arg_artist, spot_artist['name'])
+                    if artist_score > MATCH_THRESHOLD:
+                        return alb, album_score, artist_score
     return None
 
+def spot_search_albums(album_name: str, sp: spotipy.Spotify, artist_name: str = None) -> dict | None:
+    """
+    Search for album_name and compare title similarity using the Levenshtein algorithm.
+    If artist name is passed in, it will also compare that using Levenshtein.
+    It will try to detect multiple artists and compare each of them individually to each artist
+    who made a given album.
+    """
+    match = spot_match_album(album_name, sp, artist_name=artist_name)
+    return match[0] if match else None
+
 # returns the track data of the track being played
 def spot_play_nth_album_track(spot_album_id, track_num, sp):
     tracks = sp.album_tracks(spot_album_id)['items']
@@ -167,6 +349,56 @@ def spot_get_nth_album_track(spot_album_id: str, track_num: int, sp: spotipy.Spo
     
     return tracks[track_num - 1]
 
+# Most items a page of the playlist and album endpoints returns
+PLAYLIST_PAGE_SIZE = 100
+ALBUM_PAGE_SIZE = 50
+# Most ids sp.tracks takes
+MAX_TRACK_IDS = 50
+
+def spot_playlist_track_ids(playlist: str, sp: spotipy.Spotify) -> list:
+    """
+    Returns:
+        The ids of every track of a playlist, by its id, URI or URL, paging
+        through it. Episodes and local files are left out.
+    """
+    ids = []
+    offset = 0
+    while True:
+        page = sp.playlist_items(playlist, fields="items(track(id,type)),next", limit=PLAYLIST_PAGE_SIZE,
+                                 offset=offset, additional_types=("track",))
+        ids.extend(item["track"]["id"] for item in page["items"]
+                   if item.get("track") and item["track"].get("type") == "track" and item["track"].get("id"))
+        if not page.get("next"):
+            return ids
+        offset += PLAYLIST_PAGE_SIZE
+
+def spot_album_track_ids(album: str, sp: spotipy.Spotify) -> list:
+    """
+    Returns:
+        The ids of every track of an album, by its id, URI or URL, paging through it.
+    """
+    ids = []
+    offset = 0
+    while True:
+        page = sp.album_tracks(album, limit=ALBUM_PAGE_SIZE, offset=offset)
+        ids.extend(track["id"] for track in page["items"])
+        if not page.get("next"):
+            return ids
+        offset += ALBUM_PAGE_SIZE
+
+def spot_tracks(track_ids: list, sp: spotipy.Spotify) -> list:
+    """
+    Look up tracks MAX_TRACK_IDS at a time.
+
+    Returns:
+        The tracks found, in the order of their ids. Ids that aren't tracks are
+        left out.
+    """
+    tracks = []
+    for i in range(0, len(track_ids), MAX_TRACK_IDS):
+        tracks.extend(t for t in sp.tracks(track_ids[i:i + MAX_TRACK_IDS])["tracks"] if t)
+    return tracks
+
 def search_for_track(track_name, sp):
     results = sp.search(track_name)
     results = results['tracks']['items'] # I don't care much about anything but the track data
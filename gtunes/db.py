@@ -1,27 +1,84 @@
-from peewee import SqliteDatabase, Model, CharField, IntegerField, TextField, ForeignKeyField, DateTimeField
+from peewee import SqliteDatabase, Model, CharField, IntegerField, TextField, ForeignKeyField, DateTimeField, FloatField, BlobField, fn
+from playhouse.migrate import SqliteMigrator, migrate
+from peewee import chunked
+import ast
+import contextlib
+import re
+import zlib
 import os
 from dotenv import load_dotenv
 import questionary
 from gtunes import util
+from gtunes import abcnotation
+from gtunes import profiling
+from gtunes import querylog
 from gtunes.fzf_interact import fuzzy_select
 from enum import Enum
+from dataclasses import dataclass
 import datetime
 
 load_dotenv()
 data_dir = util.get_data_dir()
 database_path = os.path.join(data_dir, "gtunes.db")
-db = SqliteDatabase(database_path, pragmas={'foreign_keys': 1})
+class Database(SqliteDatabase):
+    """
+    The tune database, with every statement timed when profiling or logging queries.
+    """
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        if not profiling.enabled and not querylog.capturing():
+            return super().execute_sql(sql, params, *args, **kwargs)
+
+        def execute():
+            return super(Database, self).execute_sql(sql, params, *args, **kwargs)
+
+        with profiling.span(f"sqlite {sql.split(None, 1)[0].upper()}", sql=sql):
+            return querylog.timed(execute, sql)
+
+db = Database(database_path, pragmas={'foreign_keys': 1})
 
 glog = util.get_logger()
 glog.debug("Using gtunes database %s", database_path)
 
+# Whether open_db has been called. peewee's is_closed is per thread, so in a
+# worker thread it doesn't say whether the command has the database open.
+_opened = False
+
 def open_db():
-    global db
+    global db, _opened
     db.connect()
-    db.create_tables([Tune, Recording, RecordingTune], safe=True)
+    # Columns are added before create_tables, which would otherwise make their
+    # indexes on the tables as they were
+    _migrate_recording_track_ids()
+    db.create_tables(TABLES, safe=True)
+    _migrate_abc_to_settings()
+    _opened = True
 
 def close_db():
+    global _opened
     db.close()
+    _opened = False
+
+def in_use() -> bool:
+    """
+    Whether the database is open, in this thread or by the command from any thread.
+    """
+    return _opened or not db.is_closed()
+
+@contextlib.contextmanager
+def thread_connection():
+    """
+    Use the database in the block from any thread. A thread without a connection,
+    like a worker thread, gets one for the block.
+    """
+    if not db.is_closed():
+        yield
+        return
+
+    db.connect()
+    try:
+        yield
+    finally:
+        db.close()
 
 class BaseClass(Model):
     class Meta:
@@ -48,8 +105,8 @@ class Tune(BaseClass):
     # Storing full string so that looking through the database is easier
     # from an external viewer
     type = CharField(null=True, choices=[t.name for t in TuneType])
-    status = IntegerField(choices=[(s.value, s.name) for s in Status], default=Status["TODO"])
-    abc = TextField(null=True)
+    status = IntegerField(choices=[(s.value, s.name) for s in Status], default=Status.TODO.value)
+    abc = TextField(null=True) # Deprecated: abc is stored per setting in TuneSetting
     ts_id = IntegerField(null=True) # Thesession id
     #itinfo_id = IntegerField() # Someday might use irishtunes.info
     comments = TextField(null=True)
@@ -93,6 +150,369 @@ class Tune(BaseClass):
 
         return ret
 
+    def first_abc(self) -> str | None:
+        """
+        Returns:
+            The abc of the first stored setting of this tune, if any.
+        """
+        setting = self.settings.order_by(TuneSetting.position).first()
+        return setting.abc if setting else None
+
+# One abc setting of a tune. The abc itself is stored compressed, and its header
+# fields are parsed out into indexed columns when it's saved so that queries like
+# "all D mixolydian reels" don't need to decompress or regex anything.
+class TuneSetting(BaseClass):
+    tune = ForeignKeyField(Tune, backref='settings', on_delete='CASCADE')
+    position = IntegerField(default=0) # Order of the setting on TheSession, first is 0
+    abc_zlib = BlobField()
+    key = CharField(null=True, index=True) # Normalized, e.g. Dmix
+    meter = CharField(null=True, index=True)
+    unit_length = CharField(null=True)
+    rhythm = CharField(null=True, index=True)
+
+    class Meta:
+        indexes = (
+            (('tune', 'position'), True),
+            (('rhythm', 'key'), False),
+        )
+
+    @property
+    def abc(self) -> str:
+        return zlib.decompress(self.abc_zlib).decode("utf-8")
+
+    @staticmethod
+    def compress(abc_string: str) -> bytes:
+        return zlib.compress(abc_string.encode("utf-8"), 9)
+
+def save_tune_settings(tune: Tune, abc_settings: list):
+    """
+    Replaces all of a tune's stored abc settings. Parses out the header fields of
+    each setting and fills in the tune's key from the first one if it doesn't have one.
+
+    Args:
+        tune: a saved tune
+        abc_settings: list of abc strings, in order
+    """
+    rows = []
+    for position, abc_string in enumerate(abc_settings):
+        rows.append({
+            "tune": tune.id,
+            "position": position,
+            "abc_zlib": TuneSetting.compress(abc_string),
+            **abcnotation.parse_headers(abc_string),
+        })
+
+    with db.atomic():
+        TuneSetting.delete().where(TuneSetting.tune == tune.id).execute()
+        if rows:
+            TuneSetting.insert_many(rows).execute()
+        _bump_settings_version()
+
+        if not tune.key and rows and rows[0]["key"]:
+            tune.key = rows[0]["key"]
+            tune.save()
+
+def _legacy_abc_settings(abc_string: str) -> list:
+    """
+    Tune.abc used to hold either a single setting or the repr of a list of them.
+    """
+    if abc_string.startswith("["):
+        try:
+            settings = ast.literal_eval(abc_string)
+            if isinstance(settings, list):
+                return [str(s) for s in settings]
+        except (ValueError, SyntaxError):
+            pass
+
+    return [abc_string]
+
+def _migrate_abc_to_settings():
+    """
+    Move any abc still stored in Tune.abc into TuneSetting.
+    """
+    legacy_tunes = Tune.select().where(Tune.abc.is_null(False))
+    if not legacy_tunes.exists():
+        return
+
+    glog.info("Moving abc of tunes into the tune settings table")
+    with db.atomic():
+        for tune in legacy_tunes:
+            if not tune.settings.exists():
+                save_tune_settings(tune, _legacy_abc_settings(tune.abc))
+            tune.abc = None
+            tune.save()
+
+    # Give back the space the uncompressed abc took up
+    db.execute_sql("VACUUM")
+
+# Bumped by every write to the stored settings, so what's built from them can tell
+# it's out of date even when the writes leave their counts and ids as they were.
+class SettingsVersion(BaseClass):
+    version = IntegerField(default=0)
+
+def _bump_settings_version():
+    (SettingsVersion
+     .insert(id=1, version=1)
+     .on_conflict(conflict_target=[SettingsVersion.id], update={SettingsVersion.version: SettingsVersion.version + 1})
+     .execute())
+
+# A setting from a local copy of TheSession's tune data (https://github.com/adactio/TheSession-data),
+# used to identify and compare tunes that aren't in the tune database.
+class SessionSetting(BaseClass):
+    setting_id = IntegerField(unique=True)
+    ts_id = IntegerField(index=True)
+    name = CharField()
+    abc_zlib = BlobField() # Only the tune body, the header fields are stored below
+    key = CharField(null=True, index=True)
+    meter = CharField(null=True)
+    rhythm = CharField(null=True, index=True)
+
+    @property
+    def abc(self) -> str:
+        return zlib.decompress(self.abc_zlib).decode("utf-8")
+
+def import_session_settings(rows: list, batch_size: int = 500) -> int:
+    """
+    Insert or update settings from TheSession's tune data dump.
+
+    Args:
+        rows: dicts with the fields of the dump: setting_id, tune_id, name, type, meter, mode, abc
+
+    Returns:
+        Number of settings imported
+    """
+    count = 0
+    batch = []
+
+    def flush():
+        (SessionSetting.insert_many(batch)
+         .on_conflict_replace()
+         .execute())
+        batch.clear()
+
+    with db.atomic():
+        for row in rows:
+            batch.append({
+                "setting_id": int(row["setting_id"]),
+                "ts_id": int(row["tune_id"]),
+                "name": row["name"],
+                "abc_zlib": TuneSetting.compress(row["abc"]),
+                "key": abcnotation.normalize_key(row["mode"]) if row.get("mode") else None,
+                "meter": row.get("meter") or None,
+                "rhythm": row["type"].lower() if row.get("type") else None,
+            })
+            count += 1
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+        _bump_settings_version()
+
+    return count
+
+# TheSession's recordings as scraped from their pages: the tracks of each, and the
+# tunes of each track by position. The index on SessionTrackTune.ts_id finds where
+# a tune is on every recording scraped so far without fetching any pages.
+class SessionRecording(BaseClass):
+    recording_id = IntegerField(unique=True) # TheSession id
+    name = CharField(null=True)
+    artist = CharField(null=True)
+    date_scraped = DateTimeField(default=datetime.datetime.now)
+
+class SessionTrack(BaseClass):
+    recording = ForeignKeyField(SessionRecording, backref='tracks', on_delete='CASCADE')
+    number = IntegerField()
+    title = TextField() # The names of its tunes, as TheSession lists them
+
+    class Meta:
+        indexes = ((('recording', 'number'), True),)
+
+class SessionTrackTune(BaseClass):
+    track = ForeignKeyField(SessionTrack, backref='tunes', on_delete='CASCADE')
+    position = IntegerField()
+    ts_id = IntegerField(index=True)
+    name = CharField(null=True)
+
+    class Meta:
+        indexes = ((('track', 'position'), True),)
+
+def save_session_recording(recording_id: int, tracks: list, name: str = None, artist: str = None):
+    """
+    Save the tracks of a TheSession recording, in place of any saved before.
+
+    Args:
+        tracks: (title, [(tune ts_id, tune name), ...]) of each track, in order
+        name, artist: of the recording, if known
+    """
+    with db.atomic():
+        SessionRecording.delete().where(SessionRecording.recording_id == recording_id).execute()
+        recording = SessionRecording.create(recording_id=recording_id, name=name, artist=artist)
+        tune_rows = []
+        for number, (title, tunes) in enumerate(tracks, 1):
+            track = SessionTrack.create(recording=recording, number=number, title=title)
+            tune_rows.extend({"track": track.id, "position": position, "ts_id": ts_id, "name": tune_name}
+                             for position, (ts_id, tune_name) in enumerate(tunes, 1))
+        for batch in chunked(tune_rows, 100):
+            SessionTrackTune.insert_many(batch).execute()
+
+def session_track_number(recording_id: int, ts_id: int) -> dict | None:
+    """
+    Where a tune is on a TheSession recording, from the recordings saved.
+
+    Returns:
+        Like scrape.find_track_number: track_number, tune_number and track_string,
+        the numbers None if the tune isn't on it. None if the recording isn't saved.
+    """
+    row = (SessionTrackTune
+           .select(SessionTrackTune.position, SessionTrack.number, SessionTrack.title)
+           .join(SessionTrack)
+           .join(SessionRecording)
+           .where((SessionRecording.recording_id == recording_id) & (SessionTrackTune.ts_id == ts_id))
+           .order_by(SessionTrack.number, SessionTrackTune.position)
+           .dicts()
+           .first())
+    if row:
+        return {"track_number": row["number"], "tune_number": row["position"], "track_string": row["title"]}
+    if SessionRecording.select().where(SessionRecording.recording_id == recording_id).exists():
+        return {"track_number": None, "tune_number": None, "track_string": ""}
+    return None
+
+@dataclass(frozen=True)
+class SessionAppearance:
+    """
+    A track of a TheSession recording that a tune is on.
+    """
+    recording_id: int
+    album_name: str | None
+    artist_name: str | None
+    track_number: int
+    tune_number: int
+    track_string: str
+
+def session_appearances(ts_id: int) -> list:
+    """
+    Returns:
+        SessionAppearance of a tune on every recording saved, in one query.
+    """
+    query = (SessionTrackTune
+             .select(SessionRecording.recording_id, SessionRecording.name, SessionRecording.artist,
+                     SessionTrack.number, SessionTrackTune.position, SessionTrack.title)
+             .join(SessionTrack)
+             .join(SessionRecording)
+             .where(SessionTrackTune.ts_id == ts_id)
+             .order_by(SessionRecording.recording_id, SessionTrack.number, SessionTrackTune.position)
+             .tuples())
+    return [SessionAppearance(*row) for row in query]
+
+class SettingSource(Enum):
+    LIBRARY = 0 # TuneSetting
+    SESSION = 1 # SessionSetting
+
+def settings_state() -> tuple:
+    """
+    Cheap fingerprint of the stored settings, used to tell when something derived
+    from them is out of date.
+
+    Returns:
+        The number of library settings, the highest library setting id, the
+        number of TheSession settings and the SettingsVersion.
+    """
+    library_count, library_max_id = TuneSetting.select(
+        fn.COUNT(TuneSetting.id), fn.MAX(TuneSetting.id)).scalar(as_tuple=True)
+    session_count = SessionSetting.select().count()
+    version = SettingsVersion.select(SettingsVersion.version).where(SettingsVersion.id == 1).scalar()
+
+    return (library_count or 0, library_max_id or 0, session_count, version or 0)
+
+def iter_settings():
+    """
+    Yields:
+        (SettingSource value, row id, abc, key) of every stored setting, from both
+        the tune database and imported TheSession data.
+    """
+    query = TuneSetting.select(TuneSetting.id, TuneSetting.abc_zlib, TuneSetting.key)
+    for setting in query.iterator():
+        yield SettingSource.LIBRARY.value, setting.id, setting.abc, setting.key
+
+    query = SessionSetting.select(SessionSetting.id, SessionSetting.abc_zlib, SessionSetting.key)
+    for setting in query.iterator():
+        yield SettingSource.SESSION.value, setting.id, setting.abc, setting.key
+
+@dataclass
+class TuneMatch:
+    """
+    A tune found by searching the stored settings.
+    """
+    name: str
+    score: float
+    source: str
+    tune_id: int | None = None
+    ts_id: int | None = None
+    key: str | None = None
+    rhythm: str | None = None
+
+    def __str__(self):
+        details = " ".join(d for d in [self.key, self.rhythm] if d)
+        out = f"{self.name}"
+        if details:
+            out += f" ({details})"
+        out += f" [{self.source}] {self.score:.2f}"
+        if self.ts_id:
+            out += f" https://thesession.org/tunes/{self.ts_id}"
+        return out
+
+def describe_settings(scored_settings: list, limit: int) -> list:
+    """
+    Look up the tunes of the best scoring settings, keeping only the best setting of each tune.
+
+    Args:
+        scored_settings: list of ((SettingSource value, row id), score), best first
+        limit: maximum number of tunes to return
+
+    Returns:
+        List of TuneMatch, best first
+    """
+    library_rows = [row for (source, row), _ in scored_settings if source == SettingSource.LIBRARY.value]
+    session_rows = [row for (source, row), _ in scored_settings if source == SettingSource.SESSION.value]
+
+    found = {}
+    if library_rows:
+        settings = (TuneSetting
+                    .select(TuneSetting.id, TuneSetting.key, TuneSetting.rhythm, Tune.id, Tune.name, Tune.ts_id)
+                    .join(Tune)
+                    .where(TuneSetting.id.in_(library_rows)))
+        for s in settings:
+            found[(SettingSource.LIBRARY.value, s.id)] = TuneMatch(s.tune.name, 0, "library", tune_id=s.tune.id,
+                                                                   ts_id=s.tune.ts_id, key=s.key, rhythm=s.rhythm)
+    if session_rows:
+        settings = (SessionSetting
+                    .select(SessionSetting.id, SessionSetting.name, SessionSetting.ts_id,
+                            SessionSetting.key, SessionSetting.rhythm)
+                    .where(SessionSetting.id.in_(session_rows)))
+        for s in settings:
+            found[(SettingSource.SESSION.value, s.id)] = TuneMatch(s.name, 0, "thesession", ts_id=s.ts_id,
+                                                                   key=s.key, rhythm=s.rhythm)
+
+    matches = []
+    seen = set()
+    for setting, score in scored_settings:
+        match = found.get(setting)
+        if match is None:
+            continue # Deleted since it was scored
+
+        # A tune can have several settings, and be both in the library and TheSession data
+        ids = {("tune", match.tune_id), ("ts", match.ts_id)} - {("tune", None), ("ts", None)}
+        if ids & seen:
+            continue
+        seen |= ids
+
+        match.score = score
+        matches.append(match)
+        if len(matches) == limit:
+            break
+
+    return matches
+
 class RecordingSource(Enum):
     SPOTIFY = "spotify"
     YOUTUBE = "youtube"
@@ -104,6 +524,9 @@ class Recording(BaseClass):
     source = CharField(choices=[(rec_source.value, rec_source.name) for rec_source in RecordingSource])
     artist = CharField(null=True)
     album = CharField(null=True)
+    # The Spotify track id, the same however the track was linked to, for finding
+    # recordings already saved
+    track_id = CharField(null=True, index=True)
    
     def __str__(self):
         """
@@ -121,6 +544,60 @@ class Recording(BaseClass):
         out += f"\n\t{self.url}"
         return out
 
+def spotify_track_id(url: str) -> str | None:
+    """
+    Returns:
+        The track id of a Spotify track URL or URI, without any query like ?si=,
+        or None if it isn't one.
+    """
+    return util.spotify_id(url, "track")
+
+def _migrate_recording_track_ids():
+    """
+    Add Recording.track_id to databases made before it, filled in from the urls.
+    """
+    table = Recording._meta.table_name
+    if not db.table_exists(table) or "track_id" in {column.name for column in db.get_columns(table)}:
+        return
+
+    glog.info("Adding track ids to recordings")
+    with db.atomic():
+        migrate(SqliteMigrator(db).add_column(Recording._meta.table_name, "track_id", Recording.track_id))
+        for recording in Recording.select(Recording.id, Recording.url):
+            track_id = spotify_track_id(recording.url)
+            if track_id:
+                Recording.update(track_id=track_id).where(Recording.id == recording.id).execute()
+
+def save_spotify_recordings(tracks: list, batch_size: int = 100) -> tuple[list, int]:
+    """
+    Save Spotify tracks as recordings in one transaction, skipping any already saved.
+
+    Args:
+        tracks: track objects of the Spotify API, as from sp.tracks
+
+    Returns:
+        The new recordings' track ids, and the number of tracks already saved.
+    """
+    rows = {}
+    for track in tracks:
+        rows.setdefault(track["id"], {"name": track["name"],
+                                      "url": f"https://open.spotify.com/track/{track['id']}",
+                                      "source": RecordingSource.SPOTIFY.value,
+                                      "artist": ", ".join(a["name"] for a in track["artists"]),
+                                      "album": track["album"]["name"],
+                                      "track_id": track["id"]})
+
+    with db.atomic():
+        existing = set()
+        for batch in chunked(list(rows), 500):
+            existing.update(r.track_id for r in Recording.select(Recording.track_id)
+                            .where(Recording.track_id.in_(batch)))
+        new_rows = [row for track_id, row in rows.items() if track_id not in existing]
+        for batch in chunked(new_rows, batch_size):
+            Recording.insert_many(batch).execute()
+
+    return [row["track_id"] for row in new_rows], len(tracks) - len(new_rows)
+
 # jump table: find all the recordings of a tune you have, and where they start
 # or find all the tunes in a recording that you have tracked
 class RecordingTune(BaseClass):
@@ -132,14 +609,273 @@ class RecordingTune(BaseClass):
 class Set(BaseClass):
     name = CharField(null=True)
 
+    # For a single set. To list many, use sets_with_tunes.
+    def __str__(self):
+        tunes = (Tune.select(Tune.name)
+                 .join(SetTune)
+                 .where(SetTune.set_ == self)
+                 .order_by(SetTune.position))
+        out = f"{self.name}: " if self.name else ""
+        return out + " / ".join(t.name for t in tunes)
+
 class SetTune(BaseClass):
     set_ = ForeignKeyField(Set, backref='set_tunes', on_delete='CASCADE')
     tune = ForeignKeyField(Tune, backref='tune_sets', on_delete='CASCADE')
     position = IntegerField()
-    indexes = (
-        (('set', 'tune'), True),  # Ensure a tune isn't duplicated in a set
-    )
-    ordering = ['position']  # Default ordering by position field
+
+    class Meta:
+        indexes = (
+            (('set_', 'tune'), True),  # Ensure a tune isn't duplicated in a set
+        )
+
+def save_set(tunes: list, name: str = None) -> Set:
+    """
+    Save tunes, in order, as a new set.
+    """
+    with db.atomic():
+        new_set = Set.create(name=name)
+        SetTune.insert_many([{"set_": new_set.id, "tune": tune.id, "position": i}
+                             for i, tune in enumerate(tunes)]).execute()
+
+    return new_set
+
+# Lightweight rows for showing how tunes, recordings and sets link up. Each helper
+# below fetches its rows in a fixed number of queries, however many there are.
+
+def format_secs(secs: int | None) -> str:
+    return f"{secs // 60}:{secs % 60:02d}" if secs is not None else "?"
+
+@dataclass(frozen=True)
+class TuneRecordingRow:
+    """
+    A recording of a tune, and where the tune is in it.
+    """
+    recording_id: int
+    name: str | None
+    url: str
+    source: str
+    artist: str | None
+    album: str | None
+    start_time_secs: int | None
+    end_time_secs: int | None
+
+    def __str__(self):
+        out = self.name or "Untitled"
+        if self.artist:
+            out += f" by {self.artist}"
+        if self.start_time_secs is not None or self.end_time_secs is not None:
+            out += f" [{format_secs(self.start_time_secs)}-{format_secs(self.end_time_secs)}]"
+        return out + f"\n\t{self.url}"
+
+@dataclass(frozen=True)
+class LinkedTuneRow:
+    """
+    A tune in a recording or set. start_time_secs and end_time_secs are where it
+    is in a recording, position is where it is in a set.
+    """
+    tune_id: int
+    name: str
+    key: str | None
+    type: str | None
+    status: int | None
+    start_time_secs: int | None = None
+    end_time_secs: int | None = None
+    position: int | None = None
+
+    def __str__(self):
+        out = self.name
+        details = " ".join(d for d in [self.key, self.type.lower() if self.type else None] if d)
+        if details:
+            out += f" ({details})"
+        if self.start_time_secs is not None or self.end_time_secs is not None:
+            out += f" [{format_secs(self.start_time_secs)}-{format_secs(self.end_time_secs)}]"
+        return out
+
+_LINKED_TUNE_FIELDS = [Tune.id.alias("tune_id"), Tune.name, Tune.key, Tune.type, Tune.status]
+
+def tune_recordings(tune_id: int) -> list:
+    """
+    Returns:
+        A TuneRecordingRow for each recording of a tune, in one query.
+    """
+    return list(Recording
+                .select(Recording.id.alias("recording_id"), Recording.name, Recording.url, Recording.source,
+                        Recording.artist, Recording.album,
+                        RecordingTune.start_time_secs, RecordingTune.end_time_secs)
+                .join(RecordingTune)
+                .where(RecordingTune.tune == tune_id)
+                .order_by(Recording.name, Recording.id)
+                .objects(TuneRecordingRow))
+
+def recording_tunes(recording_id: int) -> list:
+    """
+    Returns:
+        A LinkedTuneRow for each tune in a recording, in the order they're played,
+        in one query.
+    """
+    return list(Tune
+                .select(*_LINKED_TUNE_FIELDS, RecordingTune.start_time_secs, RecordingTune.end_time_secs)
+                .join(RecordingTune)
+                .where(RecordingTune.recording == recording_id)
+                .order_by(RecordingTune.start_time_secs.asc(nulls="LAST"), RecordingTune.id)
+                .objects(LinkedTuneRow))
+
+def set_tunes(set_id: int) -> list:
+    """
+    Returns:
+        A LinkedTuneRow for each tune in a set, in order, in one query.
+    """
+    return list(Tune
+                .select(*_LINKED_TUNE_FIELDS, SetTune.position)
+                .join(SetTune)
+                .where(SetTune.set_ == set_id)
+                .order_by(SetTune.position)
+                .objects(LinkedTuneRow))
+
+def sets_with_tunes(tune_id: int = None) -> list:
+    """
+    Every set, or every set with a given tune in it, in two queries.
+
+    Returns:
+        List of (Set, [LinkedTuneRow in order])
+    """
+    sets = Set.select().order_by(Set.id)
+    if tune_id is not None:
+        sets = sets.where(Set.id.in_(SetTune.select(SetTune.set_).where(SetTune.tune == tune_id)))
+    sets = list(sets)
+
+    rows = (Tune
+            .select(SetTune.set_.alias("set_id"), *_LINKED_TUNE_FIELDS, SetTune.position)
+            .join(SetTune)
+            .where(SetTune.set_.in_([s.id for s in sets]))
+            .order_by(SetTune.set_, SetTune.position)
+            .dicts())
+    tunes = {s.id: [] for s in sets}
+    for row in rows:
+        tunes[row.pop("set_id")].append(LinkedTuneRow(**row))
+
+    return [(s, tunes[s.id]) for s in sets]
+
+@dataclass
+class TuneDetails:
+    tune: Tune
+    setting_count: int
+    recordings: list # TuneRecordingRow
+    sets: list # (Set, [LinkedTuneRow])
+
+def tune_details(tune_id: int) -> TuneDetails | None:
+    """
+    Everything linked to a tune, in five queries.
+    """
+    tune = Tune.get_or_none(Tune.id == tune_id)
+    if tune is None:
+        return None
+
+    return TuneDetails(tune=tune,
+                       setting_count=TuneSetting.select().where(TuneSetting.tune == tune_id).count(),
+                       recordings=tune_recordings(tune_id),
+                       sets=sets_with_tunes(tune_id))
+
+class EnrichStatus(Enum):
+    DONE = "done"
+    NOT_FOUND = "not_found"
+    UNCERTAIN = "uncertain" # Found a match, but the name was too different to trust
+    FAILED = "failed"
+
+# Checkpoint for bulk enrichment from TheSession, one row per tune that has been
+# attempted. Lets an interrupted `gtn tune enrich --all` pick up where it stopped.
+class TuneEnrichment(BaseClass):
+    tune = ForeignKeyField(Tune, backref='enrichments', unique=True, on_delete='CASCADE')
+    status = CharField(choices=[(s.value, s.name) for s in EnrichStatus], index=True)
+    ts_id = IntegerField(null=True)
+    ts_name = CharField(null=True)
+    confidence = FloatField(null=True)
+    attempts = IntegerField(default=0)
+    error = TextField(null=True)
+    date_updated = DateTimeField(default=datetime.datetime.now)
+
+class JobStatus(Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+# Work queued to run in the background by `gtn jobs run`, see jobs.py. A running
+# job is leased to the runner that claimed it until lease_expires; a job whose
+# lease has run out (its runner died) is claimed again.
+class Job(BaseClass):
+    kind = CharField(index=True)
+    args = TextField() # JSON
+    key = CharField(null=True, unique=True) # Idempotency key, see jobs.enqueue
+    status = CharField(choices=[(s.value, s.name) for s in JobStatus], default=JobStatus.QUEUED.value, index=True)
+    attempts = IntegerField(default=0)
+    max_attempts = IntegerField(default=3)
+    not_before = DateTimeField(default=datetime.datetime.now) # Retries wait until then
+    lease_owner = CharField(null=True)
+    lease_expires = DateTimeField(null=True)
+    progress = FloatField(default=0.0) # From 0 to 1
+    message = TextField(null=True)
+    result = TextField(null=True) # JSON
+    error = TextField(null=True)
+    date_added = DateTimeField(default=datetime.datetime.now)
+    date_updated = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        indexes = ((('status', 'not_before'), False),)
+
+# The recordings TheSession lists for a tune, with the Spotify track each was
+# matched to, saved by `gtn tune spot --prefetch` so the selector can open on them
+# without scraping. Recordings that weren't found on Spotify have no track_uri.
+class SpotifyCandidate(BaseClass):
+    tune = ForeignKeyField(Tune, backref='spotify_candidates', on_delete='CASCADE')
+    position = IntegerField() # Order on TheSession's recordings page
+    session_album = CharField()
+    artist = CharField(null=True)
+    track_number = IntegerField(null=True)
+    tune_number = IntegerField(null=True)
+    track_tunes = TextField(null=True)
+    album = CharField(null=True) # As Spotify names it
+    album_uri = CharField(null=True)
+    track_name = CharField(null=True)
+    track_uri = CharField(null=True)
+    score = FloatField(default=0.0) # Similarity of the album, times that of the artist
+    date_updated = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        indexes = ((('tune', 'position'), False),)
+
+class Grade(Enum):
+    AGAIN = 1 # Couldn't play it
+    HARD = 2
+    GOOD = 3
+    EASY = 4
+
+# Spaced repetition state of a tune being practiced. The index on due keeps
+# picking the next tunes to practice a range scan however many tunes there are.
+class Review(BaseClass):
+    tune = ForeignKeyField(Tune, backref='reviews', unique=True, on_delete='CASCADE')
+    ease = FloatField(default=2.5)
+    interval_days = FloatField(default=0)
+    repetitions = IntegerField(default=0) # Successful reviews in a row
+    lapses = IntegerField(default=0)
+    due = DateTimeField(default=datetime.datetime.now, index=True)
+    last_reviewed = DateTimeField(null=True)
+
+# Every practice of a tune, so schedules can be recomputed from scratch
+class ReviewLog(BaseClass):
+    tune = ForeignKeyField(Tune, backref='review_logs', on_delete='CASCADE')
+    grade = IntegerField(choices=[(g.value, g.name) for g in Grade])
+    reviewed_at = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        indexes = (
+            (('tune', 'reviewed_at'), False),
+        )
+
+# Tables created by open_db
+TABLES = [Tune, TuneSetting, SettingsVersion, SessionSetting, SessionRecording, SessionTrack, SessionTrackTune, Recording,
+          RecordingTune, Set, SetTune, TuneEnrichment, Job, SpotifyCandidate, Review, ReviewLog]
 
 def select_tune(message: str) -> Tune | None:
     """
@@ -0,0 +1,254 @@
+# Bulk enrichment of the tune database from TheSession.org.
+#
+# Each tune missing its TheSession id, key or abc is resolved in a pool of worker
+# threads (network only), and the results are written back to the database from
+# the calling thread in batches. Every attempt is checkpointed in the
+# TuneEnrichment table so an interrupted run resumes where it stopped.
+
+import collections
+import concurrent.futures
+import datetime
+import re
+import time
+from dataclasses import dataclass, field
+
+from gtunes import audio
+from gtunes import db
+from gtunes import scheduler
+from gtunes import scrape
+from gtunes import util
+
+glog = util.get_logger()
+
+DEFAULT_WORKERS = 4
+DEFAULT_BATCH_SIZE = 25
+DEFAULT_MIN_CONFIDENCE = 0.8
+
+# How many search results to compare against the tune name
+MAX_CANDIDATES = 5
+
+@dataclass
+class EnrichResult:
+    tune_id: int
+    status: db.EnrichStatus
+    tune_data: scrape.ScrapeTuneData | None = None
+    ts_id: int | None = None
+    ts_name: str | None = None
+    confidence: float | None = None
+    error: str | None = None
+
+@dataclass
+class EnrichSummary:
+    counts: collections.Counter = field(default_factory=collections.Counter)
+    confidences: list = field(default_factory=list)
+    elapsed_secs: float = 0
+    interrupted: bool = False
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+    def __str__(self):
+        rate = self.total / self.elapsed_secs if self.elapsed_secs else 0
+        out = f"Processed {self.total} tunes in {self.elapsed_secs:.1f}s ({rate:.2f} tunes/s)"
+        if self.interrupted:
+            out += " before being interrupted"
+        out += "\n"
+        out += ", ".join(f"{s.value}: {self.counts[s]}" for s in db.EnrichStatus)
+
+        if self.confidences:
+            mean = sum(self.confidences) / len(self.confidences)
+            high = len([c for c in self.confidences if c >= 0.9])
+            mid = len([c for c in self.confidences if 0.7 <= c < 0.9])
+            low = len(self.confidences) - high - mid
+            out += f"\nMatch confidence: mean {mean:.2f}, >=0.9: {high}, 0.7-0.9: {mid}, <0.7: {low}"
+
+        return out
+
+def _normalize_name(name: str) -> str:
+    """
+    Reduce a tune name to something comparable across sources, e.g.
+    "Ashplant, The" and "the ash plant" both become "ashplant".
+    """
+    name = name.lower().replace("’", "'")
+    name = re.sub(r",\s*the$", "", name.strip())
+    name = re.sub(r"^the\s+", "", name)
+    return re.sub(r"[^a-z0-9]", "", name)
+
+def name_confidence(tune_name: str, ts_name: str) -> float:
+    """
+    Returns:
+        Similarity between 0 and 1 of our name for a tune and TheSession's name for it.
+    """
+    a = _normalize_name(tune_name)
+    b = _normalize_name(ts_name)
+    if not a or not b:
+        return 0.0
+
+    return audio.levenshtein_string_similarity(a, b)
+
+def resolve_tune(tune_id: int, tune_name: str, ts_id: int | None = None,
+                 min_confidence: float = DEFAULT_MIN_CONFIDENCE) -> EnrichResult:
+    """
+    Find a tune on TheSession and scrape its data. Does no database access,
+    so it is safe to run in a worker thread.
+
+    Args:
+        tune_id: database id of the tune, passed through to the result
+        tune_name: our name for the tune
+        ts_id: TheSession id if already known. The search is skipped in that case.
+        min_confidence: matches less similar than this to tune_name are not scraped
+    """
+    try:
+        confidence = 1.0
+        ts_name = None
+        if not ts_id:
+            candidates = scrape.query_the_session(tune_name, limit=MAX_CANDIDATES)
+            if not candidates:
+                return EnrichResult(tune_id, db.EnrichStatus.NOT_FOUND)
+
+            scored = [(name_confidence(tune_name, c["name"]), c) for c in candidates]
+            confidence, best = max(scored, key=lambda s: s[0])
+            ts_id = int(best["id"])
+            ts_name = best["name"]
+
+            if confidence < min_confidence:
+                return EnrichResult(tune_id, db.EnrichStatus.UNCERTAIN, ts_id=ts_id,
+                                    ts_name=ts_name, confidence=confidence)
+
+        tune_data = scrape.get_tune_data(tune_id=ts_id)
+        if tune_data is None:
+            return EnrichResult(tune_id, db.EnrichStatus.NOT_FOUND, ts_id=ts_id)
+
+        return EnrichResult(tune_id, db.EnrichStatus.DONE, tune_data=tune_data, ts_id=ts_id,
+                            ts_name=tune_data.tune_name, confidence=confidence)
+    except Exception as e:
+        glog.debug("Failed to enrich tune %s: %s", tune_name, e)
+        return EnrichResult(tune_id, db.EnrichStatus.FAILED, error=str(e))
+
+def pending_tunes(retry: bool = False):
+    """
+    Returns:
+        Query of tunes missing a TheSession id, key or abc that don't yet have a
+        finished checkpoint. Failed attempts are always retried; tunes that weren't
+        found or were uncertain matches are only retried if retry is set.
+    """
+    finished = [db.EnrichStatus.DONE.value]
+    if not retry:
+        finished += [db.EnrichStatus.NOT_FOUND.value, db.EnrichStatus.UNCERTAIN.value]
+
+    finished_tunes = (db.TuneEnrichment
+                      .select(db.TuneEnrichment.tune)
+                      .where(db.TuneEnrichment.status.in_(finished)))
+
+    return (db.Tune
+            .select()
+            .where((db.Tune.ts_id.is_null() | db.Tune.key.is_null()
+                    | db.Tune.id.not_in(db.TuneSetting.select(db.TuneSetting.tune)))
+                   & db.Tune.id.not_in(finished_tunes))
+            .order_by(db.Tune.id))
+
+def _apply_result(tune: db.Tune, result: EnrichResult):
+    """
+    Fill in the fields the tune is missing from a successful result and save it.
+    Anything already set, including the name, is left alone.
+    """
+    data = result.tune_data
+    if not tune.ts_id:
+        tune.ts_id = result.ts_id
+    if not tune.key and data.tune_key:
+        tune.key = data.tune_key
+    if not tune.type and data.tune_type and data.tune_type.upper() in db.TuneType.__members__:
+        tune.type = data.tune_type.upper()
+    tune.save()
+
+    if data.tune_abc and not tune.settings.exists():
+        db.save_tune_settings(tune, data.tune_abc)
+
+def _write_batch(batch: list, tunes: dict):
+    """
+    Save a batch of results and their checkpoints in one transaction.
+    """
+    with db.db.atomic():
+        for result in batch:
+            if result.status == db.EnrichStatus.DONE:
+                _apply_result(tunes[result.tune_id], result)
+
+            row = {
+                db.TuneEnrichment.status: result.status.value,
+                db.TuneEnrichment.ts_id: result.ts_id,
+                db.TuneEnrichment.ts_name: result.ts_name,
+                db.TuneEnrichment.confidence: result.confidence,
+                db.TuneEnrichment.error: result.error,
+                db.TuneEnrichment.date_updated: datetime.datetime.now(),
+            }
+            (db.TuneEnrichment
+             .insert({**row, db.TuneEnrichment.tune: result.tune_id, db.TuneEnrichment.attempts: 1})
+             .on_conflict(conflict_target=[db.TuneEnrichment.tune],
+                          update={**row, db.TuneEnrichment.attempts: db.TuneEnrichment.attempts + 1})
+             .execute())
+
+def save_result(result: EnrichResult):
+    """
+    Save one result and its checkpoint, e.g. of a job run elsewhere.
+    """
+    _write_batch([result], {result.tune_id: db.Tune.get_by_id(result.tune_id)})
+
+def enrich_tunes(tunes: list, workers: int = DEFAULT_WORKERS, batch_size: int = DEFAULT_BATCH_SIZE,
+                 min_confidence: float = DEFAULT_MIN_CONFIDENCE, log_fn=print) -> EnrichSummary:
+    """
+    Resolve and scrape the given tunes concurrently, writing results in batches.
+
+    Should be called with the database already open. A KeyboardInterrupt stops the
+    run after saving everything that has finished so far.
+
+    Args:
+        tunes: db.Tune instances to enrich
+        workers: number of concurrent TheSession lookups
+        batch_size: number of results per database transaction
+        min_confidence: lowest name similarity at which a search result is trusted
+
+    Returns:
+        Summary of what was done
+    """
+    summary = EnrichSummary()
+    tunes_by_id = {t.id: t for t in tunes}
+    total = len(tunes_by_id)
+    if total == 0:
+        return summary
+
+    start = time.perf_counter()
+    batch = []
+
+    def flush():
+        if batch:
+            _write_batch(batch, tunes_by_id)
+            batch.clear()
+            log_fn(f"[{summary.total}/{total}] saved")
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [executor.submit(scheduler.with_priority, scheduler.Priority.BULK,
+                                   resolve_tune, t.id, t.name, t.ts_id, min_confidence)
+                   for t in tunes_by_id.values()]
+
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            summary.counts[result.status] += 1
+            if result.confidence is not None:
+                summary.confidences.append(result.confidence)
+
+            glog.debug("%s: %s %s", tunes_by_id[result.tune_id].name, result.status.value, result.ts_name)
+
+            batch.append(result)
+            if len(batch) >= batch_size:
+                flush()
+    except KeyboardInterrupt:
+        summary.interrupted = True
+        executor.shutdown(wait=False, cancel_futures=True)
+    finally:
+        flush()
+        executor.shutdown(wait=False)
+        summary.elapsed_secs = time.perf_counter() - start
+
+    return summary
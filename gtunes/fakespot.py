@@ -0,0 +1,277 @@
+# An in-process stand-in for the Spotify Web API client.
+#
+# FakeSpotify answers the spotipy.Spotify calls gtunes makes (search, album_tracks,
+# albums, track, tracks, playlist_items, devices, start_playback, pause_playback
+# and current_playback) from a catalog of
+# albums, so the spot pipeline can be exercised and timed without credentials or
+# network. Every call waits a simulated latency, and calls beyond a rate limit get
+# 429s, which are retried after Retry-After like spotipy does, or raised.
+#
+# Select it with GTUNES_SPOTIFY_BACKEND=fake, which makes audio.connect_to_spotify
+# return one built by from_env. The catalog is JSON of the form
+#
+#   {"albums": [{"id": ..., "name": ..., "artists": [...],
+#                "tracks": [{"id": ..., "name": ..., "duration_ms": ...}]}],
+#    "playlists": [{"id": ..., "tracks": [track id, ...]}]}
+#
+# or generated with generate_catalog.
+
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+
+import spotipy
+
+from gtunes import util
+
+glog = util.get_logger()
+
+DEFAULT_DURATION_MS = 180_000
+
+# Most ids the batch endpoints take at once
+MAX_ALBUM_IDS = 20
+MAX_TRACK_IDS = 50
+
+def default_catalog_path() -> str:
+    return os.path.join(util.get_data_dir(), "spotify_catalog.json")
+
+def generate_catalog(albums: int, tracks_per_album: int = 12, seed: int = 0) -> dict:
+    """
+    A synthetic catalog of albums of tunes, the same for the same arguments.
+    """
+    rng = random.Random(seed)
+    catalog = {"albums": []}
+    for i in range(albums):
+        catalog["albums"].append({
+            "id": f"album{i:06d}",
+            "name": f"Album {i}",
+            "artists": [f"Artist {rng.randrange(max(1, albums // 4))}"],
+            "tracks": [{"id": f"track{i:06d}{t:02d}",
+                        "name": f"Tune {rng.randrange(10000)} / Tune {rng.randrange(10000)}",
+                        "duration_ms": rng.randint(120_000, 300_000)}
+                       for t in range(tracks_per_album)],
+        })
+
+    return catalog
+
+def _artist(name: str) -> dict:
+    artist_id = re.sub(r"\W", "", name.lower())
+    return {"id": artist_id, "name": name, "uri": f"spotify:artist:{artist_id}", "type": "artist"}
+
+def _page(items: list, limit: int, offset: int) -> dict:
+    return {"items": items[offset:offset + limit], "total": len(items), "limit": limit, "offset": offset,
+            "next": None if offset + limit >= len(items) else f"offset={offset + limit}"}
+
+class FakeSpotify:
+    """
+    Answers spotipy.Spotify calls from a catalog.
+
+    Args:
+        catalog: see the module comment
+        latency: seconds every call takes
+        jitter: up to this many more seconds, at random
+        rate_limit: calls allowed per second, unlimited if 0
+        status_retries: times a rate limited call is retried before raising,
+            3 like spotipy
+        active_device: whether the device is active. If not, playback has to be
+            started on it by id, as on a phone with Spotify open but idle.
+        seed: for the jitter
+    """
+    def __init__(self, catalog: dict, latency: float = 0, jitter: float = 0, rate_limit: float = 0,
+                 status_retries: int = 3, active_device: bool = True, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.status_retries = status_retries
+        self.active_device = active_device
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = rate_limit
+        self._refilled_at = time.monotonic()
+
+        self.calls = {}
+        self.rate_limited = 0
+
+        self._albums = {}
+        self._tracks = {}
+        for album in catalog["albums"]:
+            artists = [_artist(a) for a in album.get("artists", [])]
+            simple_album = {"id": album["id"], "name": album["name"], "uri": f"spotify:album:{album['id']}",
+                            "artists": artists, "total_tracks": len(album["tracks"]), "type": "album",
+                            "images": album.get("images", [])}
+            tracks = []
+            for number, track in enumerate(album["tracks"], 1):
+                tracks.append({"id": track["id"], "name": track["name"], "uri": f"spotify:track:{track['id']}",
+                               "duration_ms": track.get("duration_ms", DEFAULT_DURATION_MS),
+                               "track_number": number, "disc_number": 1, "artists": artists, "type": "track"})
+                self._tracks[track["id"]] = dict(tracks[-1], album=simple_album)
+            self._albums[album["id"]] = (simple_album, tracks)
+        self._playlists = {p["id"]: p["tracks"] for p in catalog.get("playlists", [])}
+
+        # Playback state
+        self._playing_uri = None
+        self._position_ms = 0
+        self._started_at = None
+
+    def _call(self, name: str):
+        """
+        Count a call and simulate its latency and any rate limiting.
+        """
+        for attempt in range(self.status_retries + 1):
+            with self._lock:
+                self.calls[name] = self.calls.get(name, 0) + 1
+                delay = self.latency + self._rng.uniform(0, self.jitter)
+
+                # Token bucket holding up to a second's worth of calls
+                retry_after = 0
+                if self.rate_limit:
+                    now = time.monotonic()
+                    self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled_at) * self.rate_limit)
+                    self._refilled_at = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                    else:
+                        retry_after = (1 - self._tokens) / self.rate_limit
+                        self.rate_limited += 1
+
+            if delay:
+                time.sleep(delay)
+            if not retry_after:
+                return
+            if attempt < self.status_retries:
+                time.sleep(retry_after)
+
+        raise spotipy.SpotifyException(429, -1, "API rate limit exceeded",
+                                       headers={"Retry-After": str(math.ceil(retry_after))})
+
+    def search(self, q: str, limit: int = 10, offset: int = 0, type: str = "track", market: str = None) -> dict:
+        self._call("search")
+
+        words = q.lower().split()
+        candidates = self._tracks.values() if type == "track" else (a for a, _ in self._albums.values())
+        matches = []
+        for item in candidates:
+            text = " ".join([item["name"]] + [a["name"] for a in item["artists"]]).lower()
+            hits = sum(word in text for word in words) + (item["name"].lower() == q.lower())
+            if hits:
+                matches.append((hits, item))
+        matches.sort(key=lambda m: m[0], reverse=True)
+
+        return {f"{type}s": _page([item for _, item in matches], limit, offset)}
+
+    def album_tracks(self, album_id: str, limit: int = 50, offset: int = 0, market: str = None) -> dict:
+        self._call("album_tracks")
+        album = self._albums.get(util.spotify_id(album_id))
+        if album is None:
+            raise spotipy.SpotifyException(404, -1, "Non existing id")
+
+        return _page(album[1], limit, offset)
+
+    def albums(self, albums: list, market: str = None) -> dict:
+        self._call("albums")
+        if len(albums) > MAX_ALBUM_IDS:
+            raise spotipy.SpotifyException(400, -1, "Too many ids requested")
+
+        found = []
+        for album_id in albums:
+            album = self._albums.get(util.spotify_id(album_id))
+            found.append(dict(album[0], tracks=_page(album[1], 50, 0)) if album else None)
+
+        return {"albums": found}
+
+    def tracks(self, tracks: list, market: str = None) -> dict:
+        self._call("tracks")
+        if len(tracks) > MAX_TRACK_IDS:
+            raise spotipy.SpotifyException(400, -1, "Too many ids requested")
+
+        return {"tracks": [self._tracks.get(util.spotify_id(track_id)) for track_id in tracks]}
+
+    def playlist_items(self, playlist_id: str, fields: str = None, limit: int = 100, offset: int = 0,
+                       market: str = None, additional_types: tuple = ("track", "episode")) -> dict:
+        self._call("playlist_items")
+        track_ids = self._playlists.get(util.spotify_id(playlist_id))
+        if track_ids is None:
+            raise spotipy.SpotifyException(404, -1, "Not found.")
+
+        return _page([{"track": self._tracks.get(track_id)} for track_id in track_ids], limit, offset)
+
+    def track(self, track_id: str, market: str = None) -> dict:
+        self._call("track")
+        track = self._tracks.get(util.spotify_id(track_id))
+        if track is None:
+            raise spotipy.SpotifyException(404, -1, "Non existing id")
+
+        return track
+
+    def _progress_ms(self) -> int:
+        if self._started_at is None:
+            return self._position_ms
+        return self._position_ms + int((time.monotonic() - self._started_at) * 1000)
+
+    def devices(self) -> dict:
+        self._call("devices")
+        return {"devices": [{"id": "fake", "name": "Fake device", "type": "Computer", "is_active": self.active_device,
+                             "is_restricted": False, "volume_percent": 100}]}
+
+    def start_playback(self, device_id: str = None, context_uri: str = None, uris: list = None,
+                       offset: dict = None, position_ms: int = None):
+        self._call("start_playback")
+        if device_id is not None and device_id != "fake":
+            raise spotipy.SpotifyException(404, -1, "Device not found")
+        if not self.active_device and device_id is None:
+            raise spotipy.SpotifyException(404, -1, "Player command failed: No active device found",
+                                           reason="NO_ACTIVE_DEVICE")
+
+        with self._lock:
+            self.active_device = True
+            if uris:
+                self._playing_uri = uris[0]
+                self._position_ms = position_ms or 0
+            elif position_ms is not None:
+                self._position_ms = position_ms
+            else:
+                self._position_ms = self._progress_ms()
+            self._started_at = time.monotonic()
+
+    def pause_playback(self, device_id: str = None):
+        self._call("pause_playback")
+        with self._lock:
+            self._position_ms = self._progress_ms()
+            self._started_at = None
+
+    def current_playback(self, market: str = None, additional_types: str = None) -> dict | None:
+        self._call("current_playback")
+        with self._lock:
+            if self._playing_uri is None:
+                return None
+            track = self._tracks.get(util.spotify_id(self._playing_uri))
+            progress = self._progress_ms()
+            if track and progress >= track["duration_ms"]:
+                progress = track["duration_ms"]
+
+            return {"is_playing": self._started_at is not None, "progress_ms": progress, "item": track,
+                    "device": {"id": "fake", "name": "Fake device", "is_active": self.active_device}}
+
+def from_env() -> FakeSpotify:
+    """
+    A FakeSpotify configured by GTUNES_FAKE_SPOTIFY_CATALOG (a catalog file),
+    GTUNES_FAKE_SPOTIFY_LATENCY, GTUNES_FAKE_SPOTIFY_JITTER and
+    GTUNES_FAKE_SPOTIFY_RATE_LIMIT. Without a catalog file a small one is generated.
+    """
+    path = os.getenv("GTUNES_FAKE_SPOTIFY_CATALOG", default_catalog_path())
+    if os.path.exists(path):
+        with open(path) as catalog_file:
+            catalog = json.load(catalog_file)
+    else:
+        glog.debug("No fake Spotify catalog at %s, generating one", path)
+        catalog = generate_catalog(100)
+
+    return FakeSpotify(catalog,
+                       latency=float(os.getenv("GTUNES_FAKE_SPOTIFY_LATENCY", 0)),
+                       jitter=float(os.getenv("GTUNES_FAKE_SPOTIFY_JITTER", 0)),
+                       rate_limit=float(os.getenv("GTUNES_FAKE_SPOTIFY_RATE_LIMIT", 0)))
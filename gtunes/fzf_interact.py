@@ -1,4 +1,5 @@
 import subprocess
+from gtunes import profiling
 
 
 def fuzzy_select(select_from, header=None):
@@ -35,7 +36,10 @@ def fuzzy_select(select_from, header=None):
         select_from = [ x for x in select_from ]
 
     # Write options to fzf's stdin
-    stdout, _ = process.communicate("\n".join(select_from))
+    options = "\n".join(select_from)
+    with profiling.span("subprocess fzf", options=len(select_from)) as s:
+        stdout, _ = process.communicate(options)
+        s.add_bytes(len(options))
 
     if process.returncode == 0:  # fzf returns 0 if an item was selected
         processed_stoud = tuple(stdout.strip().split("\n"))
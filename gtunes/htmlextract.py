@@ -0,0 +1,355 @@
+# Pulling the few elements the scraper wants out of TheSession's pages.
+#
+# Every page gtunes scrapes is mostly markup it doesn't look at: it wants the
+# manifest-item list items of search, recordings and album pages, and the h1 and
+# div.notes of a tune page. Extraction finds just those elements, the targets,
+# and hands each back as a small Node tree as soon as it ends, without keeping a
+# tree of the page:
+#
+#   for item in htmlextract.iter_extract(chunks, htmlextract.MANIFEST_ITEMS):
+#       item.find("a-preview")["data-tuneid"]
+#
+# The parser is pluggable, chosen with GTUNES_HTML_PARSER:
+#
+#   lxml         (default when installed) libxml2's C parser, fed as the page
+#                arrives. Each target's elements are freed once it's extracted.
+#   selectolax   the Lexbor C parser with CSS selectors, on the whole page
+#   html.parser  the standard library's parser, fed as the page arrives
+#   bs4          BeautifulSoup on the whole page, building only the targets
+#                (a SoupStrainer)
+#
+# lxml and html.parser stream: targets come back from feed while the rest of
+# the page is still downloading. The others give them all at close.
+#
+# python -m pytest benchmarks/bench_scrape.py compares them.
+
+import codecs
+import html.parser
+import importlib.util
+import os
+
+import bs4
+
+PARSERS = ("lxml", "selectolax", "html.parser", "bs4")
+STREAMING_PARSERS = ("lxml", "html.parser")
+
+# Targets are (tag, class), class None for any
+MANIFEST_ITEMS = (("li", "manifest-item"),)
+TUNE_PAGE = (("h1", None), ("div", "notes"))
+
+# Elements that never have an end tag
+_VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+
+class Node:
+    """
+    An element of a target, with the parts of bs4's Tag interface the scraper
+    uses.
+    """
+    __slots__ = ("tag", "attrs", "children", "text")
+
+    def __init__(self, tag: str, attrs: dict, children: list = None, text: str = ""):
+        self.tag = tag
+        self.attrs = attrs
+        self.children = children if children is not None else []
+        self.text = text
+
+    def __repr__(self):
+        return f"Node({self.tag!r}, {self.attrs!r}, text={self.text!r})"
+
+    def __getitem__(self, attr: str) -> str:
+        return self.attrs[attr]
+
+    def get(self, attr: str, default=None) -> str | None:
+        return self.attrs.get(attr, default)
+
+    def find_all(self, tag: str, class_: str = None) -> list:
+        """
+        Returns:
+            Every element below this one of the tag and class, in document order.
+        """
+        found = []
+        stack = list(reversed(self.children))
+        while stack:
+            node = stack.pop()
+            if _matches(node.tag, node.attrs.get("class"), tag, class_):
+                found.append(node)
+            stack.extend(reversed(node.children))
+        return found
+
+    def find(self, tag: str, class_: str = None) -> "Node | None":
+        found = self.find_all(tag, class_)
+        return found[0] if found else None
+
+def _matches(tag: str, classes: str | None, want_tag: str, want_class: str | None) -> bool:
+    return tag == want_tag and (want_class is None or want_class in (classes or "").split())
+
+def _is_target(tag: str, classes: str | None, targets: tuple) -> bool:
+    return any(_matches(tag, classes, want_tag, want_class) for want_tag, want_class in targets)
+
+def available_parsers() -> list:
+    return [p for p in PARSERS if p not in ("lxml", "selectolax") or importlib.util.find_spec(p) is not None]
+
+def default_parser() -> str:
+    parser = os.getenv("GTUNES_HTML_PARSER")
+    if parser:
+        if parser not in PARSERS:
+            raise ValueError(f"GTUNES_HTML_PARSER must be one of {', '.join(PARSERS)}, not {parser}")
+        return parser
+    return "lxml" if "lxml" in available_parsers() else "html.parser"
+
+class Extractor:
+    """
+    Feed a page in chunks and get back the targets that have ended.
+
+    Args:
+        targets: (tag, class) of the elements wanted. Targets inside targets
+            are part of the outer one.
+    """
+    def __init__(self, targets: tuple):
+        self.targets = targets
+        self._decoder = None
+
+    def _decode(self, chunk, final: bool = False) -> str:
+        if isinstance(chunk, str):
+            return chunk
+        if self._decoder is None:
+            self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        return self._decoder.decode(chunk, final)
+
+    def feed(self, chunk: str | bytes) -> list:
+        """
+        Returns:
+            Node of each target that ended in the page so far
+        """
+        raise NotImplementedError
+
+    def close(self) -> list:
+        """
+        Returns:
+            Node of each target left
+        """
+        raise NotImplementedError
+
+class _BufferingExtractor(Extractor):
+    """
+    For parsers that need the whole page.
+    """
+    def __init__(self, targets: tuple):
+        super().__init__(targets)
+        self._chunks = []
+
+    def feed(self, chunk: str | bytes) -> list:
+        self._chunks.append(self._decode(chunk))
+        return []
+
+    def close(self) -> list:
+        if self._decoder is not None:
+            self._chunks.append(self._decoder.decode(b"", True))
+        page = "".join(self._chunks)
+        self._chunks = []
+        return self._extract(page)
+
+    def _extract(self, page: str) -> list:
+        raise NotImplementedError
+
+class _LxmlExtractor(Extractor):
+    def __init__(self, targets: tuple):
+        super().__init__(targets)
+        from lxml import etree
+
+        self._parser = etree.HTMLPullParser(events=("start", "end"))
+        self._target = None
+        self._empty = True
+
+    def feed(self, chunk: str | bytes) -> list:
+        if not chunk:
+            return []
+        # lxml decodes bytes itself
+        self._parser.feed(chunk)
+        self._empty = False
+        return self._read()
+
+    def close(self) -> list:
+        # lxml won't close an empty document, like the body of an error
+        if self._empty:
+            return []
+        self._parser.close()
+        return self._read()
+
+    def _read(self) -> list:
+        found = []
+        for event, element in self._parser.read_events():
+            if not isinstance(element.tag, str):
+                # Comments and processing instructions
+                continue
+            if event == "start":
+                if self._target is None and _is_target(element.tag, element.get("class"), self.targets):
+                    self._target = element
+            elif element is self._target:
+                found.append(self._node(element))
+                self._target = None
+                # Free the target and everything parsed before it
+                element.clear()
+                parent = element.getparent()
+                while parent is not None:
+                    while element.getprevious() is not None:
+                        del parent[0]
+                    element, parent = parent, parent.getparent()
+        return found
+
+    def _node(self, element) -> Node:
+        children = [self._node(child) for child in element if isinstance(child.tag, str)]
+        return Node(element.tag, dict(element.attrib), children, "".join(element.itertext()))
+
+class _SelectolaxExtractor(_BufferingExtractor):
+    def _extract(self, page: str) -> list:
+        from selectolax.lexbor import LexborHTMLParser
+
+        tree = LexborHTMLParser(page)
+        selector = ", ".join(f"{tag}.{class_}" if class_ else tag for tag, class_ in self.targets)
+        found = []
+        last = None
+        for element in tree.css(selector):
+            # Targets inside a target are already part of it
+            if last is not None and self._inside(element, last):
+                continue
+            found.append(self._node(element))
+            last = element
+        return found
+
+    @staticmethod
+    def _inside(element, ancestor) -> bool:
+        parent = element.parent
+        while parent is not None:
+            if parent == ancestor:
+                return True
+            parent = parent.parent
+        return False
+
+    def _node(self, element) -> Node:
+        children = [self._node(child) for child in element.iter(include_text=False)]
+        return Node(element.tag, dict(element.attributes), children, element.text(deep=True))
+
+class _StdlibExtractor(Extractor):
+    def __init__(self, targets: tuple):
+        super().__init__(targets)
+        self._parser = _TargetParser(targets)
+
+    def feed(self, chunk: str | bytes) -> list:
+        self._parser.feed(self._decode(chunk))
+        return self._parser.take()
+
+    def close(self) -> list:
+        if self._decoder is not None:
+            self._parser.feed(self._decoder.decode(b"", True))
+        self._parser.close()
+        self._parser.end_open_target()
+        return self._parser.take()
+
+class _TargetParser(html.parser.HTMLParser):
+    """
+    Builds Nodes of the targets only, skipping everything else.
+    """
+    def __init__(self, targets: tuple):
+        super().__init__(convert_charrefs=True)
+        self.targets = targets
+        # The open elements of the target being parsed, and their text so far
+        self._stack = []
+        self._texts = []
+        self._found = []
+
+    def take(self) -> list:
+        found, self._found = self._found, []
+        return found
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {name: value or "" for name, value in attrs}
+        if not self._stack:
+            if not _is_target(tag, attrs.get("class"), self.targets):
+                return
+        node = Node(tag, attrs)
+        if self._stack:
+            self._stack[-1].children.append(node)
+        if tag in _VOID_TAGS:
+            return
+        self._stack.append(node)
+        self._texts.append([])
+
+    def handle_endtag(self, tag):
+        if not any(node.tag == tag for node in self._stack):
+            return
+        # End any elements left open inside it
+        while self._stack:
+            node = self._stack.pop()
+            node.text = "".join(self._texts.pop())
+            if self._texts:
+                self._texts[-1].append(node.text)
+            else:
+                self._found.append(node)
+            if node.tag == tag:
+                break
+
+    def handle_data(self, data):
+        if self._texts:
+            self._texts[-1].append(data)
+
+    def end_open_target(self):
+        if self._stack:
+            self.handle_endtag(self._stack[0].tag)
+
+class _SoupExtractor(_BufferingExtractor):
+    def _extract(self, page: str) -> list:
+        strainer = bs4.SoupStrainer([tag for tag, _ in self.targets])
+        soup = bs4.BeautifulSoup(page, "html.parser", parse_only=strainer)
+
+        def is_target(tag):
+            return _is_target(tag.name, " ".join(tag.get("class", [])), self.targets)
+
+        found = [self._node(tag) for tag in soup.find_all(is_target)
+                 if not any(is_target(parent) for parent in tag.parents if parent is not soup)]
+        soup.decompose()
+        return found
+
+    def _node(self, tag: bs4.Tag) -> Node:
+        attrs = {name: " ".join(value) if isinstance(value, list) else value for name, value in tag.attrs.items()}
+        children = [self._node(child) for child in tag.children if isinstance(child, bs4.Tag)]
+        return Node(tag.name, attrs, children, tag.get_text())
+
+_EXTRACTORS = {"lxml": _LxmlExtractor, "selectolax": _SelectolaxExtractor, "html.parser": _StdlibExtractor,
+               "bs4": _SoupExtractor}
+
+def extractor(targets: tuple, parser: str = None) -> Extractor:
+    """
+    Args:
+        parser: one of PARSERS, default_parser() if None
+    """
+    return _EXTRACTORS[parser or default_parser()](targets)
+
+def iter_extract(chunks, targets: tuple, parser: str = None):
+    """
+    Yields:
+        Node of each target in a page given in chunks (str or bytes), as soon as
+        the parser has it
+    """
+    ex = extractor(targets, parser)
+    for chunk in chunks:
+        yield from ex.feed(chunk)
+    yield from ex.close()
+
+async def aiter_extract(chunks, targets: tuple, parser: str = None):
+    """
+    iter_extract for a page given by an async iterator, like httpx's aiter_text.
+    """
+    ex = extractor(targets, parser)
+    async for chunk in chunks:
+        for node in ex.feed(chunk):
+            yield node
+    for node in ex.close():
+        yield node
+
+def extract(page: str, targets: tuple, parser: str = None) -> list:
+    """
+    Returns:
+        Node of each target in a page
+    """
+    return list(iter_extract([page], targets, parser))
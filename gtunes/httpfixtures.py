@@ -0,0 +1,364 @@
+# Recorded HTTP responses, for running the scraper without the network.
+#
+# A fixture archive is every response captured from a site, keyed by method, path
+# and query so the same archive replays against the real site or a local stand-in.
+# It's stored as one lzma compressed JSON document, since the pages of a site share
+# most of their markup and compress far better together than apart.
+#
+# Responses are captured and replayed by requests transport adapters mounted on a
+# session, or httpx transports for async clients, chosen with GTUNES_HTTP_MODE:
+#
+#   live    (default) go to the network
+#   record  go to the network and save every response to the archive
+#   replay  answer only from the archive, never touching the network
+#
+# The stand-in server serves an archive over real HTTP with configurable latency,
+# jitter and error rate, so concurrency and retries can be load tested offline:
+#
+#   python -m gtunes.httpfixtures serve thesession.json.xz --latency 0.2 --error-rate 0.05
+#   GTUNES_SESSION_URL=http://127.0.0.1:8000 gtn tune enrich --all
+
+import argparse
+import atexit
+import http.server
+import json
+import lzma
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+import httpx
+import requests
+import requests.adapters
+import requests.structures
+
+from gtunes import util
+
+glog = util.get_logger()
+
+MODES = ("live", "record", "replay")
+
+# Open archives by path, so requests and httpx clients recording together save
+# to the same one
+_archives = {}
+_archives_lock = threading.Lock()
+
+def default_archive_path() -> str:
+    return os.path.join(util.get_data_dir(), "http_fixtures.json.xz")
+
+def request_key(method: str, url: str) -> str:
+    """
+    Returns:
+        The archive key of a request, independent of the host it was sent to.
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+    return f"{method.upper()} {parts.path or '/'}{'?' + query if query else ''}"
+
+class FixtureArchive:
+    """
+    Captured responses, keyed by request_key. Entries are dicts of "status",
+    "content_type" and "body".
+    """
+    def __init__(self, path: str = None):
+        self.path = path
+        self.entries = {}
+        self.changed = False
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            with lzma.open(path, "rt", encoding="utf-8") as archive_file:
+                self.entries = json.load(archive_file)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: str) -> dict | None:
+        return self.entries.get(key)
+
+    def put(self, key: str, status: int, body: str, content_type: str = "text/html; charset=utf-8"):
+        with self._lock:
+            self.entries[key] = {"status": status, "content_type": content_type, "body": body}
+            self.changed = True
+
+    def save(self, path: str = None):
+        path = path or self.path
+        with self._lock:
+            tmp_path = path + ".tmp"
+            with lzma.open(tmp_path, "wt", encoding="utf-8", preset=9) as archive_file:
+                json.dump(self.entries, archive_file, sort_keys=True, separators=(",", ":"))
+            os.replace(tmp_path, path)
+            self.changed = False
+
+        glog.debug("Saved %d responses to %s", len(self.entries), path)
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+    """
+    Answers requests from an archive. Requests that weren't recorded get a 404.
+    """
+    def __init__(self, archive: FixtureArchive):
+        super().__init__()
+        self.archive = archive
+
+    def send(self, request, **kwargs):
+        key = request_key(request.method, request.url)
+        entry = self.archive.get(key)
+        if entry is None:
+            glog.debug("No recorded response for %s", key)
+            entry = {"status": 404, "content_type": "text/plain", "body": ""}
+
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.headers = requests.structures.CaseInsensitiveDict({"Content-Type": entry["content_type"]})
+        response._content = entry["body"].encode("utf-8")
+        response._content_consumed = True
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.reason = http.HTTPStatus(entry["status"]).phrase
+
+        return response
+
+    def close(self):
+        pass
+
+class RecordingAdapter(requests.adapters.HTTPAdapter):
+    """
+    Sends requests over the network as usual, saving every final response
+    (after any retries) to an archive.
+    """
+    def __init__(self, archive: FixtureArchive, **kwargs):
+        super().__init__(**kwargs)
+        self.archive = archive
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        self.archive.put(request_key(request.method, request.url), response.status_code, response.text,
+                         response.headers.get("Content-Type", "text/html; charset=utf-8"))
+        return response
+
+def _mode(mode: str | None) -> str:
+    mode = mode or os.getenv("GTUNES_HTTP_MODE", "live")
+    if mode not in MODES:
+        raise ValueError(f"GTUNES_HTTP_MODE must be one of {', '.join(MODES)}, not {mode}")
+    return mode
+
+def _archive(mode: str, path: str | None) -> FixtureArchive:
+    path = path or os.getenv("GTUNES_HTTP_FIXTURES", default_archive_path())
+    with _archives_lock:
+        archive = _archives.get(path)
+        if archive is None:
+            archive = _archives[path] = FixtureArchive(path)
+            if mode == "record":
+                atexit.register(lambda: archive.changed and archive.save())
+    glog.debug("HTTP %s using %s", mode, archive.path)
+
+    return archive
+
+def mount(session: requests.Session, mode: str = None, path: str = None, **adapter_kwargs) -> FixtureArchive | None:
+    """
+    Mount the adapter for a mode on every URL of a session.
+
+    Args:
+        session: the session to mount on
+        mode: one of MODES, defaults to GTUNES_HTTP_MODE or live
+        path: the archive, defaults to GTUNES_HTTP_FIXTURES or the data dir
+        adapter_kwargs: passed to HTTPAdapter in live and record modes, e.g. max_retries
+
+    Returns:
+        The archive in record and replay modes. Recorded responses are saved at exit.
+    """
+    mode = _mode(mode)
+
+    archive = None
+    if mode == "live":
+        adapter = requests.adapters.HTTPAdapter(**adapter_kwargs)
+    else:
+        archive = _archive(mode, path)
+        if mode == "record":
+            adapter = RecordingAdapter(archive, **adapter_kwargs)
+        else:
+            adapter = ReplayAdapter(archive)
+
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return archive
+
+class AsyncReplayTransport(httpx.AsyncBaseTransport):
+    """
+    ReplayAdapter for httpx async clients.
+    """
+    def __init__(self, archive: FixtureArchive):
+        self.archive = archive
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        key = request_key(request.method, str(request.url))
+        entry = self.archive.get(key)
+        if entry is None:
+            glog.debug("No recorded response for %s", key)
+            entry = {"status": 404, "content_type": "text/plain", "body": ""}
+
+        return httpx.Response(entry["status"], headers={"Content-Type": entry["content_type"]},
+                              content=entry["body"].encode("utf-8"), request=request)
+
+class AsyncRecordingTransport(httpx.AsyncHTTPTransport):
+    """
+    RecordingAdapter for httpx async clients.
+    """
+    def __init__(self, archive: FixtureArchive, **kwargs):
+        super().__init__(**kwargs)
+        self.archive = archive
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await super().handle_async_request(request)
+        await response.aread()
+        self.archive.put(request_key(request.method, str(request.url)), response.status_code, response.text,
+                         response.headers.get("Content-Type", "text/html; charset=utf-8"))
+        return response
+
+def async_transport(mode: str = None, path: str = None, **transport_kwargs) -> httpx.AsyncBaseTransport:
+    """
+    The httpx transport for a mode, like mount.
+
+    Args:
+        transport_kwargs: passed to AsyncHTTPTransport in live and record modes, e.g. limits
+    """
+    mode = _mode(mode)
+    if mode == "live":
+        return httpx.AsyncHTTPTransport(**transport_kwargs)
+    if mode == "record":
+        return AsyncRecordingTransport(_archive(mode, path), **transport_kwargs)
+    return AsyncReplayTransport(_archive(mode, path))
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    """
+    Serves the responses of an archive, as if it were the site they came from.
+
+    Each request waits latency seconds plus up to jitter seconds, and fails with
+    error_status with probability error_rate. Delays and failures come from a
+    seeded generator so runs are repeatable.
+    """
+    daemon_threads = True
+
+    def __init__(self, archive: FixtureArchive, host: str = "127.0.0.1", port: int = 0,
+                 latency: float = 0, jitter: float = 0, error_rate: float = 0,
+                 error_status: int = 503, seed: int = 0):
+        super().__init__((host, port), _StandInHandler)
+        self.archive = archive
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def next_outcome(self) -> tuple:
+        """
+        Returns:
+            (delay in seconds, whether to fail) for the next request
+        """
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._rng.uniform(0, self.jitter)
+            fail = self._rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+
+        return delay, fail
+
+    def start(self) -> "StandInServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+class _StandInHandler(http.server.BaseHTTPRequestHandler):
+    server: StandInServer
+    # Keep connections alive, like the real site
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        delay, fail = self.server.next_outcome()
+        if delay:
+            time.sleep(delay)
+
+        entry = self.server.archive.get(request_key("GET", self.path))
+        if fail:
+            entry = {"status": self.server.error_status, "content_type": "text/plain", "body": ""}
+        elif entry is None:
+            entry = {"status": 404, "content_type": "text/plain", "body": ""}
+
+        body = entry["body"].encode("utf-8")
+        self.send_response(entry["status"])
+        self.send_header("Content-Type", entry["content_type"])
+        self.send_header("Content-Length", str(len(body)))
+        if fail:
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        glog.debug("Stand-in server: " + format, *args)
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or serve a fixture archive of recorded HTTP responses")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_ls = subparsers.add_parser("ls", help="List the recorded requests")
+    parser_ls.add_argument("archive")
+
+    parser_serve = subparsers.add_parser("serve", help="Serve the archive as a stand-in for the site it came from")
+    parser_serve.add_argument("archive")
+    parser_serve.add_argument("--host", default="127.0.0.1")
+    parser_serve.add_argument("--port", type=int, default=8000)
+    parser_serve.add_argument("--latency", type=float, default=0, help="Seconds before every response")
+    parser_serve.add_argument("--jitter", type=float, default=0, help="Up to this many more seconds, at random")
+    parser_serve.add_argument("--error-rate", type=float, default=0, help="Share of requests that fail, 0-1")
+    parser_serve.add_argument("--error-status", type=int, default=503)
+    parser_serve.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    archive = FixtureArchive(args.archive)
+
+    if args.command == "ls":
+        for key, entry in sorted(archive.entries.items()):
+            print(f"{entry['status']} {key} ({len(entry['body'])} chars)")
+        return 0
+
+    server = StandInServer(archive, args.host, args.port, args.latency, args.jitter,
+                           args.error_rate, args.error_status, args.seed)
+    print(f"Serving {len(archive)} responses at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Served {server.requests} requests, {server.errors} failed on purpose")
+
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
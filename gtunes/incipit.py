@@ -0,0 +1,263 @@
+# Melodic incipit index: identify a tune from a few bars of abc.
+#
+# Every stored setting, from the tune database and from any imported TheSession
+# data, is reduced to the key invariant sequence of intervals between its notes.
+# Each run of NGRAM intervals is packed into a single integer, and an inverted
+# index maps those n-grams to the settings they occur in. A query is reduced the
+# same way and candidates are ranked by the idf weighted share of its n-grams
+# they contain.
+#
+# The index is a flat file of unsigned 32 bit arrays so it can be memory-mapped
+# rather than read in:
+#
+#   header
+#   grams[num_grams]          sorted n-gram codes
+#   offsets[num_grams + 1]    start of each gram's postings
+#   postings[num_postings]    document numbers, ascending within each gram
+#   doc_kind[num_docs]        db.SettingSource value
+#   doc_row[num_docs]         TuneSetting or SessionSetting id
+
+import array
+import bisect
+import collections
+import heapq
+import math
+import mmap
+import os
+import struct
+
+from gtunes import abcnotation
+from gtunes import db
+from gtunes import util
+
+glog = util.get_logger()
+
+MAGIC = b"GTII"
+VERSION = 2
+NGRAM = 4
+
+# Intervals are clamped to +/- this many semitones so each fits in INTERVAL_BITS
+MAX_INTERVAL = 15
+INTERVAL_BITS = 5
+
+# magic, version, ngram, num_docs, num_grams, num_postings, then the DB state the
+# index was built from: library_count, library_max_id, session_count, settings version
+_HEADER = struct.Struct("<4sIIIIIIIII")
+
+# In indexes of at least MIN_DOCS_FOR_CUTOFF documents, n-grams in more than
+# MAX_DOC_SHARE of them say little about which tune a query is and are skipped.
+# This also keeps their long postings lists out of queries.
+MAX_DOC_SHARE = 0.5
+MIN_DOCS_FOR_CUTOFF = 100
+
+# Key signatures to try a query in when it doesn't say its key: F, C, G, D and A major.
+# Between them these cover the usual keys of Irish tunes.
+_QUERY_KEYS = ["Fmaj", "Cmaj", "Gmaj", "Dmaj", "Amaj"]
+
+def default_index_path() -> str:
+    return os.path.join(util.get_data_dir(), "incipit.idx")
+
+def ngrams(steps: list, n: int = NGRAM) -> set:
+    """
+    Returns:
+        The distinct n-grams of a list of intervals, each packed into an int.
+    """
+    codes = []
+    for step in steps:
+        codes.append(max(-MAX_INTERVAL, min(MAX_INTERVAL, step)) + MAX_INTERVAL)
+
+    grams = set()
+    for i in range(len(codes) - n + 1):
+        gram = 0
+        for code in codes[i:i + n]:
+            gram = (gram << INTERVAL_BITS) | code
+        grams.add(gram)
+
+    return grams
+
+def build_index(path: str = None, documents=None, state: tuple = None) -> str:
+    """
+    Build the index file from the stored settings. Should be called with the database open.
+
+    Args:
+        path: where to write the index, defaults to the data dir
+        documents: iterable of (db.SettingSource value, row id, pitches), defaults
+            to every stored setting
+
+    Returns:
+        Path of the index
+    """
+    path = path or default_index_path()
+    if documents is None:
+        state = db.settings_state()
+        documents = ((source, row_id, abcnotation.pitches(abc_string, key=key))
+                     for source, row_id, abc_string, key in db.iter_settings())
+    state = state or (0, 0, 0, 0)
+
+    postings = collections.defaultdict(list)
+    doc_kind = array.array("I")
+    doc_row = array.array("I")
+    for doc, (kind, row_id, pitch_list) in enumerate(documents):
+        doc_kind.append(kind)
+        doc_row.append(row_id)
+        for gram in ngrams(abcnotation.intervals(pitch_list)):
+            postings[gram].append(doc)
+
+    grams = array.array("I", sorted(postings))
+    offsets = array.array("I", [0])
+    flat_postings = array.array("I")
+    for gram in grams:
+        flat_postings.extend(postings[gram])
+        offsets.append(len(flat_postings))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as index_file:
+        index_file.write(_HEADER.pack(MAGIC, VERSION, NGRAM, len(doc_kind), len(grams),
+                                      len(flat_postings), *state))
+        for part in (grams, offsets, flat_postings, doc_kind, doc_row):
+            part.tofile(index_file)
+    os.replace(tmp_path, path)
+
+    glog.debug("Built incipit index of %d settings and %d n-grams at %s", len(doc_kind), len(grams), path)
+
+    return path
+
+class IncipitIndex:
+    """
+    A memory-mapped incipit index file.
+    """
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, ngram, num_docs, num_grams, num_postings, *state = _HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a version {VERSION} incipit index")
+
+        self.ngram = ngram
+        self.num_docs = num_docs
+        self.state = tuple(state)
+
+        # Every view of the mmap has to be released before it can be closed
+        self._views = [memoryview(self._mmap)]
+        self._views.append(self._views[0][_HEADER.size:].cast("I"))
+        sizes = [num_grams, num_grams + 1, num_postings, num_docs, num_docs]
+        parts = []
+        start = 0
+        for size in sizes:
+            parts.append(self._views[1][start:start + size])
+            start += size
+        self._views.extend(parts)
+        self._grams, self._offsets, self._postings, self.doc_kind, self.doc_row = parts
+
+    def close(self):
+        for view in reversed(getattr(self, "_views", [])):
+            view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def postings(self, gram: int):
+        """
+        Returns:
+            The document numbers containing the n-gram.
+        """
+        i = bisect.bisect_left(self._grams, gram)
+        if i == len(self._grams) or self._grams[i] != gram:
+            return self._postings[0:0]
+
+        return self._postings[self._offsets[i]:self._offsets[i + 1]]
+
+    def score(self, pitch_variants: list) -> dict:
+        """
+        Score every document sharing an n-gram with the query.
+
+        Args:
+            pitch_variants: one or more readings of the query as pitches, e.g. in
+                different key signatures. Each document keeps its best score.
+
+        Returns:
+            Map of document number to the idf weighted share of the query's n-grams
+            it contains, from 0 to 1.
+        """
+        best = {}
+        for pitch_list in pitch_variants:
+            grams = ngrams(abcnotation.intervals(pitch_list), self.ngram)
+
+            scores = collections.defaultdict(float)
+            total = 0
+            for gram in grams:
+                docs = self.postings(gram)
+                if self.num_docs >= MIN_DOCS_FOR_CUTOFF and len(docs) > MAX_DOC_SHARE * self.num_docs:
+                    continue
+                # Grams nobody has still count against the query, as if they were rare
+                idf = math.log(1 + self.num_docs / max(1, len(docs)))
+                total += idf
+                for doc in docs:
+                    scores[doc] += idf
+
+            for doc, score in scores.items():
+                score /= total
+                if score > best.get(doc, 0):
+                    best[doc] = score
+
+        return best
+
+def open_index(path: str = None, rebuild: bool = False, log_fn=print) -> IncipitIndex:
+    """
+    Open the index, building it first if it's missing, out of date or rebuild is set.
+    Should be called with the database open.
+    """
+    path = path or default_index_path()
+
+    index = None
+    if os.path.exists(path) and not rebuild:
+        try:
+            index = IncipitIndex(path)
+        except ValueError as e:
+            glog.debug(e)
+
+        if index and index.state != db.settings_state():
+            index.close()
+            index = None
+
+    if index is None:
+        log_fn("Building incipit index...")
+        build_index(path)
+        index = IncipitIndex(path)
+
+    return index
+
+def identify(abc_fragment: str, key: str = None, limit: int = 10, index: IncipitIndex = None) -> list:
+    """
+    Find the stored tunes whose settings best match a fragment of abc.
+
+    Args:
+        abc_fragment: a few bars of abc, optionally with a K: field
+        key: key of the fragment if it has no K: field. If neither is given the
+            fragment is tried in the common Irish key signatures.
+        limit: maximum number of tunes to return
+        index: an open index, defaults to opening the one in the data dir
+
+    Returns:
+        List of db.TuneMatch, best first
+    """
+    if key or "K:" in abc_fragment:
+        pitch_variants = [abcnotation.pitches(abc_fragment, key=key)]
+    else:
+        pitch_variants = [abcnotation.pitches(abc_fragment, key=k) for k in _QUERY_KEYS]
+
+    if len(abcnotation.intervals(pitch_variants[0])) < NGRAM:
+        raise ValueError(f"Need at least {NGRAM + 1} different notes in a row to identify a tune")
+
+    should_close = index is None
+    index = index or open_index()
+    try:
+        scores = index.score(pitch_variants)
+        # Take a few extra in case several settings of the same tune make the cut
+        best = heapq.nlargest(limit * 5, scores.items(), key=lambda s: s[1])
+        return db.describe_settings([((index.doc_kind[doc], index.doc_row[doc]), score)
+                                     for doc, score in best], limit)
+    finally:
+        if should_close:
+            index.close()
@@ -0,0 +1,471 @@
+# Long running work, queued in the database and run in worker processes.
+#
+# Anything too slow to do inline, like enriching the whole library or finding
+# Spotify candidates for it, can be queued as jobs from any command:
+#
+#   jobs.enqueue("enrich", {"tune_id": tune.id, "name": tune.name}, key=f"enrich:{tune.id}")
+#
+# and `gtn jobs run` works through the queue. Jobs survive the process that
+# queued them and the one running them: a runner claims jobs in a transaction
+# and holds a lease on each, renewed while it runs. If the runner dies, its
+# leases run out and the next runner claims the jobs again.
+#
+# A kind of job (KINDS) is a function run in a process pool, one process per
+# core by default, and optionally a function applying its result to the
+# database, run by the runner. Worker processes never touch the database: they
+# report progress through a queue, and the runner writes progress, lease
+# renewals and finished jobs together in one transaction every FLUSH_SECS.
+#
+# A job that raises is tried again after a backoff, up to its max_attempts. A
+# key makes queueing idempotent: a job is only queued again for a key once the
+# last one queued for it has finished.
+#
+# Each worker process schedules its own requests (see scheduler.py), so the
+# per host limits apply per process.
+
+import concurrent.futures
+import datetime
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import subprocess
+import tempfile
+import time
+import traceback
+import uuid
+from dataclasses import dataclass, field
+
+from gtunes import db
+from gtunes import util
+
+glog = util.get_logger()
+
+# How long a claimed job is leased to its runner. Renewed every flush.
+LEASE_SECS = 120
+# Seconds between writes of progress, leases and finished jobs
+FLUSH_SECS = 1.0
+# Finished jobs that make the runner write before FLUSH_SECS are up
+DEFAULT_BATCH_SIZE = 25
+# Jobs claimed per worker, so the pool has the next one ready
+CLAIM_AHEAD = 2
+DEFAULT_MAX_ATTEMPTS = 3
+# A failed job waits RETRY_BACKOFF_SECS, then twice that, and so on
+RETRY_BACKOFF_SECS = 10
+
+FINISHED = (db.JobStatus.DONE, db.JobStatus.FAILED, db.JobStatus.CANCELLED)
+
+@dataclass(frozen=True)
+class JobKind:
+    """
+    Args:
+        run: called in a worker process as run(args, progress), where progress
+            is called with the fraction done and an optional message. Must be a
+            module level function, and return something picklable.
+        apply: called by the runner as apply(args, value) with what run
+            returned, in the transaction marking the job done. Returns what's
+            saved as the job's result, as JSON. value itself is saved if None.
+    """
+    run: object
+    apply: object = None
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS
+
+# ==========
+# Job kinds
+# ==========
+
+def _run_enrich(args: dict, progress):
+    from gtunes import enrich
+    from gtunes import scheduler
+
+    with scheduler.priority(scheduler.Priority.BULK):
+        result = enrich.resolve_tune(args["tune_id"], args["name"], args.get("ts_id"),
+                                     args.get("min_confidence", enrich.DEFAULT_MIN_CONFIDENCE))
+    if result.status == db.EnrichStatus.FAILED:
+        raise RuntimeError(result.error)
+    return result
+
+def _apply_enrich(args: dict, result) -> dict:
+    from gtunes import enrich
+
+    enrich.save_result(result)
+    return {"status": result.status.value, "ts_id": result.ts_id, "ts_name": result.ts_name,
+            "confidence": result.confidence}
+
+# The Spotify client of a worker process, connected on its first job
+_spotify = None
+
+def _run_spot_candidates(args: dict, progress) -> dict:
+    from gtunes import audio
+    from gtunes import scheduler
+    from gtunes import scrape
+    from gtunes import spotcandidates
+
+    global _spotify
+    if _spotify is None:
+        _spotify = audio.connect_to_spotify()
+
+    rows = []
+    albums = []
+    with scheduler.priority(scheduler.Priority.BULK):
+        recordings = scrape.scrape_recording_data(tune_name=args["name"], tune_id=args.get("ts_id"), albums=albums)
+        for position, recording in enumerate(recordings):
+            track = spotcandidates.match_recording(recording, _spotify)
+            rows.append(spotcandidates.candidate_row(args["tune_id"], position, recording, track))
+            progress((position + 1) / len(recordings), recording.album_name)
+    return {"rows": rows, "albums": albums}
+
+def _apply_spot_candidates(args: dict, value: dict) -> dict:
+    from gtunes import spotcandidates
+
+    rows = value["rows"]
+    spotcandidates.save_candidates(args["tune_id"], rows)
+    for recording_id, tracks, name, artist in value["albums"]:
+        db.save_session_recording(recording_id, tracks, name=name, artist=artist)
+    return {"recordings": len(rows), "matched": len([r for r in rows if r["track_uri"]])}
+
+def _run_render_abc(args: dict, progress) -> str:
+    """
+    Render abc to args["output"]001.svg with abcm2ps.
+    """
+    with tempfile.NamedTemporaryFile("w", suffix=".abc", delete=False) as abc_file:
+        abc_file.write(args["abc"])
+    try:
+        # -g means svg, one tune per file
+        subprocess.run(["abcm2ps", "-g", abc_file.name, "-O", args["output"]], check=True,
+                       capture_output=True)
+    finally:
+        os.remove(abc_file.name)
+    return os.path.abspath(args["output"] + "001.svg")
+
+KINDS = {
+    "enrich": JobKind(_run_enrich, _apply_enrich),
+    "spot-candidates": JobKind(_run_spot_candidates, _apply_spot_candidates),
+    "render-abc": JobKind(_run_render_abc),
+}
+
+# ======
+# Queue
+# ======
+
+def enqueue(kind: str, args: dict, key: str = None, max_attempts: int = None) -> db.Job:
+    """
+    Queue a job, unless a job with the same key is queued, running or done.
+    A job of the key that failed or was cancelled is queued again.
+
+    Returns:
+        The job queued, or the one already there for the key
+    """
+    if kind not in KINDS:
+        raise ValueError(f"Unknown job kind {kind}, must be one of {', '.join(KINDS)}")
+
+    now = datetime.datetime.now()
+    row = {"kind": kind, "args": json.dumps(args), "key": key,
+           "max_attempts": max_attempts or KINDS[kind].max_attempts,
+           "date_added": now, "date_updated": now, "not_before": now}
+    with db.db.atomic("IMMEDIATE"):
+        if key is None:
+            return db.Job.create(**row)
+
+        job = db.Job.get_or_none(db.Job.key == key)
+        if job is None:
+            return db.Job.create(**row)
+        if db.JobStatus(job.status) in (db.JobStatus.FAILED, db.JobStatus.CANCELLED):
+            (db.Job.update(status=db.JobStatus.QUEUED.value, args=row["args"], attempts=0, progress=0.0,
+                           message=None, error=None, result=None, lease_owner=None, lease_expires=None,
+                           not_before=now, date_updated=now)
+             .where(db.Job.id == job.id)
+             .execute())
+            job = db.Job.get_by_id(job.id)
+        return job
+
+def claim(owner: str, n: int, kinds=None) -> list:
+    """
+    Lease up to n jobs to a runner, oldest first: queued jobs that are due, and
+    running jobs whose lease has run out. Atomic across processes.
+
+    Args:
+        owner: the runner, see new_owner
+        kinds: only jobs of these kinds if given
+
+    Returns:
+        The jobs claimed
+    """
+    if n <= 0:
+        return []
+
+    now = datetime.datetime.now()
+    claimable = (((db.Job.status == db.JobStatus.QUEUED.value) & (db.Job.not_before <= now))
+                 | ((db.Job.status == db.JobStatus.RUNNING.value) & (db.Job.lease_expires < now)))
+    if kinds is not None:
+        claimable &= db.Job.kind.in_(list(kinds))
+
+    with db.db.atomic("IMMEDIATE"):
+        ids = [job.id for job in db.Job.select(db.Job.id).where(claimable).order_by(db.Job.id).limit(n)]
+        if not ids:
+            return []
+        (db.Job.update(status=db.JobStatus.RUNNING.value, lease_owner=owner,
+                       lease_expires=now + datetime.timedelta(seconds=LEASE_SECS),
+                       attempts=db.Job.attempts + 1, date_updated=now)
+         .where(db.Job.id.in_(ids))
+         .execute())
+        return list(db.Job.select().where(db.Job.id.in_(ids)).order_by(db.Job.id))
+
+def cancel(ids: list = None) -> int:
+    """
+    Cancel queued and running jobs, every one if ids is None. A running job
+    finishes, but its result is dropped.
+
+    Returns:
+        The number of jobs cancelled
+    """
+    query = db.Job.update(status=db.JobStatus.CANCELLED.value, lease_owner=None, lease_expires=None,
+                          date_updated=datetime.datetime.now())
+    unfinished = db.Job.status.in_([db.JobStatus.QUEUED.value, db.JobStatus.RUNNING.value])
+    if ids is not None:
+        unfinished &= db.Job.id.in_(ids)
+    return query.where(unfinished).execute()
+
+def list_jobs(status: db.JobStatus = None, kind: str = None):
+    """
+    Returns:
+        Query of jobs, newest first
+    """
+    query = db.Job.select()
+    if status is not None:
+        query = query.where(db.Job.status == status.value)
+    if kind is not None:
+        query = query.where(db.Job.kind == kind)
+    return query.order_by(db.Job.id.desc())
+
+def new_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# =======
+# Runner
+# =======
+
+class _Progress:
+    """
+    The progress callback of a job, sending updates to the runner.
+    """
+    def __init__(self, updates, job_id: int):
+        self.updates = updates
+        self.job_id = job_id
+
+    def __call__(self, fraction: float, message: str = None):
+        self.updates.put((self.job_id, fraction, message))
+
+@dataclass
+class RunSummary:
+    done: int = 0
+    failed: int = 0
+    retried: int = 0
+    cancelled: int = 0
+    elapsed_secs: float = 0
+    interrupted: bool = False
+    errors: list = field(default_factory=list)
+
+    @property
+    def total(self) -> int:
+        return self.done + self.failed + self.retried + self.cancelled
+
+    def __str__(self):
+        out = f"Ran {self.total} jobs in {self.elapsed_secs:.1f}s"
+        if self.interrupted:
+            out += " before being interrupted"
+        out += f"\ndone: {self.done}, failed: {self.failed}, to retry: {self.retried}, cancelled: {self.cancelled}"
+        return out
+
+def _error(e: BaseException) -> str:
+    return "".join(traceback.format_exception_only(type(e), e)).strip()
+
+def _backoff(attempts: int) -> datetime.timedelta:
+    return datetime.timedelta(seconds=RETRY_BACKOFF_SECS * 2 ** (attempts - 1))
+
+def _seconds_until_due(kinds=None) -> float | None:
+    """
+    Returns:
+        Seconds until the next queued job is due, 0 if one is, None if none is queued
+    """
+    query = db.Job.select(db.Job.not_before).where(db.Job.status == db.JobStatus.QUEUED.value)
+    if kinds is not None:
+        query = query.where(db.Job.kind.in_(list(kinds)))
+    job = query.order_by(db.Job.not_before).first()
+    if job is None:
+        return None
+    return max(0.0, (job.not_before - datetime.datetime.now()).total_seconds())
+
+def _flush(owner: str, finished: list, progress: dict, in_flight: list, summary: RunSummary, log_fn):
+    """
+    Write progress, renew leases and save finished jobs, in one transaction.
+
+    Args:
+        finished: (job, future) of jobs whose run has returned or raised
+        progress: (fraction, message) by job id
+        in_flight: ids of jobs still running
+
+    Returns:
+        Ids of the in flight jobs that were cancelled
+    """
+    now = datetime.datetime.now()
+    with db.db.atomic("IMMEDIATE"):
+        # Only jobs still leased to this runner are ours to save
+        ids = [job.id for job, _ in finished] + list(in_flight)
+        ours = {job.id for job in db.Job.select(db.Job.id)
+                .where(db.Job.id.in_(ids) & (db.Job.lease_owner == owner)
+                       & (db.Job.status == db.JobStatus.RUNNING.value))}
+
+        for job_id, (fraction, message) in progress.items():
+            if job_id in ours:
+                db.Job.update(progress=fraction, message=message, date_updated=now).where(db.Job.id == job_id).execute()
+        progress.clear()
+
+        live = [job_id for job_id in in_flight if job_id in ours]
+        if live:
+            (db.Job.update(lease_expires=now + datetime.timedelta(seconds=LEASE_SECS))
+             .where(db.Job.id.in_(live))
+             .execute())
+
+        for job, future in finished:
+            if job.id not in ours:
+                summary.cancelled += 1
+                continue
+            _save_finished(job, future, now, summary, log_fn)
+
+    return [job_id for job_id in in_flight if job_id not in ours]
+
+def _save_finished(job: db.Job, future: concurrent.futures.Future, now: datetime.datetime, summary: RunSummary,
+                   log_fn):
+    kind = KINDS[job.kind]
+    try:
+        value = future.result()
+        with db.db.atomic():
+            result = kind.apply(json.loads(job.args), value) if kind.apply else value
+            (db.Job.update(status=db.JobStatus.DONE.value, progress=1.0, result=json.dumps(result),
+                           error=None, lease_owner=None, lease_expires=None, date_updated=now)
+             .where(db.Job.id == job.id)
+             .execute())
+        summary.done += 1
+        glog.debug("Job %s %s done: %s", job.id, job.kind, result)
+        return
+    except Exception as e:
+        error = _error(e)
+
+    summary.errors.append((job.id, error))
+    update = {db.Job.error: error, db.Job.lease_owner: None, db.Job.lease_expires: None, db.Job.date_updated: now}
+    if job.attempts >= job.max_attempts:
+        update[db.Job.status] = db.JobStatus.FAILED.value
+        summary.failed += 1
+        log_fn(f"Job {job.id} ({job.kind}) failed after {job.attempts} attempts: {error}")
+    else:
+        update[db.Job.status] = db.JobStatus.QUEUED.value
+        update[db.Job.not_before] = now + _backoff(job.attempts)
+        summary.retried += 1
+        glog.debug("Job %s %s failed, retrying: %s", job.id, job.kind, error)
+    db.Job.update(update).where(db.Job.id == job.id).execute()
+
+def _release(owner: str, ids: list):
+    """
+    Put jobs this runner didn't finish back in the queue, as if never tried.
+    """
+    if not ids:
+        return
+    (db.Job.update(status=db.JobStatus.QUEUED.value, lease_owner=None, lease_expires=None,
+                   attempts=db.Job.attempts - 1, date_updated=datetime.datetime.now())
+     .where(db.Job.id.in_(ids) & (db.Job.lease_owner == owner) & (db.Job.status == db.JobStatus.RUNNING.value))
+     .execute())
+
+def run_jobs(workers: int = None, kinds=None, batch_size: int = DEFAULT_BATCH_SIZE, log_fn=print) -> RunSummary:
+    """
+    Run queued jobs in a process pool until none are left, waiting for those
+    retrying.
+
+    Should be called with the database already open. A KeyboardInterrupt stops
+    the run after saving every job that finished, and puts the rest back in the
+    queue.
+
+    Args:
+        workers: number of worker processes, one per core if None
+        kinds: only run jobs of these kinds if given
+        batch_size: finished jobs saved per transaction, at most
+    """
+    workers = workers or os.cpu_count() or 1
+    # Jobs of kinds this version doesn't know are left queued
+    kinds = [kind for kind in (kinds or KINDS) if kind in KINDS]
+    summary = RunSummary()
+    owner = new_owner()
+    start = time.perf_counter()
+
+    # spawn, since forking a process with threads and an open database isn't safe
+    context = multiprocessing.get_context("spawn")
+    manager = context.Manager()
+    updates = manager.Queue()
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+    in_flight = {}
+    finished = []
+    progress = {}
+    last_flush = time.monotonic()
+
+    def drain():
+        while True:
+            try:
+                job_id, fraction, message = updates.get_nowait()
+            except queue.Empty:
+                return
+            progress[job_id] = (fraction, message)
+
+    def flush():
+        nonlocal last_flush
+        drain()
+        cancelled = _flush(owner, finished, progress, [job.id for job in in_flight.values()], summary, log_fn)
+        if finished:
+            log_fn(f"[{summary.total}] saved")
+        finished.clear()
+        for future, job in list(in_flight.items()):
+            if job.id in cancelled:
+                future.cancel()
+                del in_flight[future]
+                summary.cancelled += 1
+        last_flush = time.monotonic()
+
+    try:
+        while True:
+            if len(in_flight) <= workers:
+                for job in claim(owner, workers * CLAIM_AHEAD - len(in_flight), kinds):
+                    future = executor.submit(KINDS[job.kind].run, json.loads(job.args), _Progress(updates, job.id))
+                    in_flight[future] = job
+
+            if not in_flight:
+                if finished or progress:
+                    flush()
+                due = _seconds_until_due(kinds)
+                if due is None:
+                    break
+                time.sleep(min(due, FLUSH_SECS))
+                continue
+
+            timeout = max(0.0, last_flush + FLUSH_SECS - time.monotonic())
+            done, _ = concurrent.futures.wait(in_flight, timeout=timeout,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                finished.append((in_flight.pop(future), future))
+
+            if len(finished) >= batch_size or not in_flight or time.monotonic() - last_flush >= FLUSH_SECS:
+                flush()
+    except KeyboardInterrupt:
+        summary.interrupted = True
+        executor.shutdown(wait=False, cancel_futures=True)
+    finally:
+        try:
+            if finished or progress:
+                flush()
+            _release(owner, [job.id for job in in_flight.values()])
+        finally:
+            executor.shutdown(wait=False)
+            manager.shutdown()
+            summary.elapsed_secs = time.perf_counter() - start
+
+    return summary
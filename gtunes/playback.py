@@ -0,0 +1,155 @@
+# Spotify playback commands that don't block the caller.
+#
+# A key press in a TUI shouldn't wait on the Spotify API, let alone on retries
+# for a device to wake up. PlaybackQueue takes play and pause commands without
+# blocking, and a task on the event loop sends them from a thread:
+#
+#   playback = PlaybackQueue(sp, notify=app.notify)
+#   app.run_worker(playback.run())
+#   playback.play(track_uri)
+#
+# Only the latest command matters. Presses are debounced, so a burst of them is
+# one API call once they stop, and a command that leaves things as they were
+# (play then pause before either is sent) is dropped. Results and errors are
+# reported through notify.
+#
+# The device to play on is picked from a list of the user's devices, cached for
+# DEVICE_CACHE_SECS and refreshed when Spotify says there's no active device.
+
+import asyncio
+import time
+from dataclasses import dataclass
+
+import requests
+import spotipy
+
+from gtunes import audio
+from gtunes import util
+
+glog = util.get_logger()
+
+# Commands wait this long for another to replace them
+DEBOUNCE_SECS = 0.25
+
+DEVICE_CACHE_SECS = 30
+
+@dataclass(frozen=True)
+class _State:
+    track_uri: str | None
+    position_ms: int = 0
+    label: str = ""
+
+_PAUSED = _State(None)
+
+class PlaybackQueue:
+    """
+    Sends the latest play or pause command to Spotify in the background.
+
+    Args:
+        sp: Spotify client
+        notify: called with a message and severity ("information", "warning" or
+            "error") for each command's result, like textual's App.notify
+        debounce_secs: see DEBOUNCE_SECS
+    """
+    def __init__(self, sp: spotipy.Spotify, notify=None, debounce_secs: float = DEBOUNCE_SECS):
+        self._sp = sp
+        self._notify = notify or (lambda message, severity="information": print(message))
+        self.debounce_secs = debounce_secs
+
+        self._wanted = None
+        self._applied = _PAUSED
+        self._changed = asyncio.Event()
+        self._changed_at = 0.0
+
+        self._devices = []
+        self._devices_at = None
+
+        self.sent = 0
+
+    def play(self, track_uri: str, position_ms: int = 0, label: str = None) -> None:
+        """
+        Args:
+            label: the track in the notification it's playing, its uri if None
+        """
+        self._want(_State(track_uri, position_ms, label or track_uri))
+
+    def pause(self) -> None:
+        self._want(_PAUSED)
+
+    def _want(self, state: _State) -> None:
+        self._wanted = state
+        self._changed_at = time.monotonic()
+        self._changed.set()
+
+    async def run(self) -> None:
+        """
+        Send commands until cancelled.
+        """
+        while True:
+            await self._changed.wait()
+
+            # Wait for the presses to stop
+            while (wait := self._changed_at + self.debounce_secs - time.monotonic()) > 0:
+                await asyncio.sleep(wait)
+            self._changed.clear()
+
+            state = self._wanted
+            if state == self._applied:
+                glog.debug(f"Playback already {state}")
+                continue
+
+            try:
+                await self._send(state)
+            except spotipy.SpotifyException as e:
+                glog.debug(f"Playback command {state} failed: {e}")
+                self._notify(f"Spotify: {e.msg}", severity="error")
+            except requests.RequestException as e:
+                glog.debug(f"Playback command {state} failed: {e}")
+                self._notify(f"Couldn't reach Spotify: {e}", severity="error")
+
+    async def warm(self) -> None:
+        """
+        Fetch the device list ahead of the first play.
+        """
+        try:
+            await self._device_id()
+        except (spotipy.SpotifyException, requests.RequestException) as e:
+            glog.debug(f"Couldn't fetch Spotify devices: {e}")
+
+    async def _send(self, state: _State) -> None:
+        self.sent += 1
+        if state.track_uri is None:
+            await asyncio.to_thread(self._sp.pause_playback)
+            self._applied = state
+            self._notify("Paused")
+            return
+
+        device_id = await self._device_id()
+        if device_id is None:
+            self._notify("No Spotify device to play on. Try opening Spotify on one.", severity="warning")
+            return
+
+        try:
+            await asyncio.to_thread(self._sp.start_playback, device_id=device_id, uris=[state.track_uri],
+                                    position_ms=state.position_ms)
+        except spotipy.SpotifyException as e:
+            # The cached device may have gone away
+            if e.reason != "NO_ACTIVE_DEVICE" and e.http_status != 404:
+                raise
+            device_id = await self._device_id(refresh=True)
+            if device_id is None:
+                self._notify("No Spotify device to play on. Try opening Spotify on one.", severity="warning")
+                return
+            await asyncio.to_thread(self._sp.start_playback, device_id=device_id, uris=[state.track_uri],
+                                    position_ms=state.position_ms)
+
+        self._applied = state
+        self._notify(f"Playing {state.label}")
+
+    async def _device_id(self, refresh: bool = False) -> str | None:
+        if refresh or self._devices_at is None or time.monotonic() - self._devices_at > DEVICE_CACHE_SECS:
+            self._devices = (await asyncio.to_thread(self._sp.devices))["devices"]
+            self._devices_at = time.monotonic()
+            glog.debug(f"Spotify devices: {[d['name'] for d in self._devices]}")
+
+        return audio.spot_pick_device(self._devices)
@@ -0,0 +1,282 @@
+# Spaced repetition practice scheduling.
+#
+# A variant of SM-2 with four grades (again, hard, good, easy), as used by Anki.
+# Each tune being practiced has a Review row holding its current state and due
+# date, and every practice is appended to ReviewLog. Schedules can be recomputed
+# from the log in one vectorized pass over all tunes at once.
+
+import datetime
+from dataclasses import dataclass
+
+import numpy as np
+from peewee import Value, chunked
+
+from gtunes import db
+from gtunes import util
+
+glog = util.get_logger()
+
+DEFAULT_EASE = 2.5
+MIN_EASE = 1.3
+FIRST_INTERVAL_DAYS = 1
+SECOND_INTERVAL_DAYS = 6
+HARD_FACTOR = 1.2
+EASY_BONUS = 1.3
+
+EASE_CHANGES = {
+    db.Grade.AGAIN: -0.2,
+    db.Grade.HARD: -0.15,
+    db.Grade.GOOD: 0,
+    db.Grade.EASY: 0.15,
+}
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+@dataclass
+class ReviewState:
+    ease: float = DEFAULT_EASE
+    interval_days: float = 0
+    repetitions: int = 0
+    lapses: int = 0
+
+def next_state(state: ReviewState, grade: db.Grade) -> ReviewState:
+    """
+    Returns:
+        The review state after practicing a tune with the given grade.
+    """
+    if grade == db.Grade.AGAIN:
+        return ReviewState(ease=max(MIN_EASE, state.ease + EASE_CHANGES[grade]),
+                           interval_days=FIRST_INTERVAL_DAYS,
+                           repetitions=0,
+                           lapses=state.lapses + 1)
+
+    if grade == db.Grade.HARD:
+        interval = max(FIRST_INTERVAL_DAYS, state.interval_days * HARD_FACTOR)
+    elif state.repetitions == 0:
+        interval = FIRST_INTERVAL_DAYS
+    elif state.repetitions == 1:
+        interval = SECOND_INTERVAL_DAYS
+    else:
+        interval = state.interval_days * state.ease
+
+    if grade == db.Grade.EASY:
+        interval *= EASY_BONUS
+
+    return ReviewState(ease=max(MIN_EASE, state.ease + EASE_CHANGES[grade]),
+                       interval_days=interval,
+                       repetitions=state.repetitions + 1,
+                       lapses=state.lapses)
+
+def next_states(states: dict, grades: np.ndarray) -> dict:
+    """
+    Vectorized next_state: applies one grade to each of many review states.
+
+    Args:
+        states: dict of "ease", "interval_days", "repetitions" and "lapses" arrays
+        grades: db.Grade values, one per state. 0 leaves the state as it is.
+
+    Returns:
+        The new states, in the same form
+    """
+    ease = states["ease"]
+    interval = states["interval_days"]
+    repetitions = states["repetitions"]
+    lapses = states["lapses"]
+
+    again = grades == db.Grade.AGAIN.value
+    hard = grades == db.Grade.HARD.value
+    easy = grades == db.Grade.EASY.value
+    graded = grades > 0
+
+    passed_interval = np.select(
+        [hard, repetitions == 0, repetitions == 1],
+        [np.maximum(FIRST_INTERVAL_DAYS, interval * HARD_FACTOR), FIRST_INTERVAL_DAYS, SECOND_INTERVAL_DAYS],
+        interval * ease)
+    passed_interval = np.where(easy, passed_interval * EASY_BONUS, passed_interval)
+
+    ease_change = np.zeros(len(grades))
+    for grade, change in EASE_CHANGES.items():
+        ease_change[grades == grade.value] = change
+
+    return {
+        "ease": np.where(graded, np.maximum(MIN_EASE, ease + ease_change), ease),
+        "interval_days": np.where(graded, np.where(again, FIRST_INTERVAL_DAYS, passed_interval), interval),
+        "repetitions": np.where(graded, np.where(again, 0, repetitions + 1), repetitions),
+        "lapses": np.where(again, lapses + 1, lapses),
+    }
+
+def replay_logs(tune_ids: np.ndarray, grades: np.ndarray, reviewed_at: np.ndarray) -> dict:
+    """
+    Compute the current review state of every tune from its full practice history.
+
+    Rather than replaying each tune in turn, the logs are laid out as a matrix with
+    a row per tune and a column per practice, and next_states is applied a column
+    at a time, so the work is vectorized across all tunes.
+
+    Args:
+        tune_ids, grades, reviewed_at: the review log as arrays sorted by tune and
+            then time, with reviewed_at as POSIX timestamps
+
+    Returns:
+        dict of "tune", "ease", "interval_days", "repetitions", "lapses",
+        "last_reviewed" and "due" arrays, one entry per tune
+    """
+    tunes, starts, counts = np.unique(tune_ids, return_index=True, return_counts=True)
+    rows = np.repeat(np.arange(len(tunes)), counts)
+    columns = np.arange(len(tune_ids)) - np.repeat(starts, counts)
+
+    grade_matrix = np.zeros((len(tunes), counts.max() if len(counts) else 0), dtype=np.int64)
+    grade_matrix[rows, columns] = grades
+
+    states = {
+        "ease": np.full(len(tunes), DEFAULT_EASE),
+        "interval_days": np.zeros(len(tunes)),
+        "repetitions": np.zeros(len(tunes), dtype=np.int64),
+        "lapses": np.zeros(len(tunes), dtype=np.int64),
+    }
+    for column in range(grade_matrix.shape[1]):
+        states = next_states(states, grade_matrix[:, column])
+
+    last_reviewed = reviewed_at[starts + counts - 1] if len(tunes) else np.zeros(0)
+    states["tune"] = tunes
+    states["last_reviewed"] = last_reviewed
+    states["due"] = last_reviewed + states["interval_days"] * SECONDS_PER_DAY
+
+    return states
+
+def recompute_schedules() -> int:
+    """
+    Rebuild the Review row of every practiced tune from the review log.
+
+    Returns:
+        Number of tunes rescheduled
+    """
+    logs = (db.ReviewLog
+            .select(db.ReviewLog.tune, db.ReviewLog.grade, db.ReviewLog.reviewed_at)
+            .order_by(db.ReviewLog.tune, db.ReviewLog.reviewed_at)
+            .tuples())
+
+    tune_ids, grades, reviewed_at = [], [], []
+    for tune_id, grade, reviewed in logs.iterator():
+        tune_ids.append(tune_id)
+        grades.append(grade)
+        reviewed_at.append(reviewed.timestamp())
+
+    if not tune_ids:
+        return 0
+
+    states = replay_logs(np.array(tune_ids), np.array(grades), np.array(reviewed_at))
+
+    fields = ["ease", "interval_days", "repetitions", "lapses", "last_reviewed", "due"]
+    rows = []
+    for i, tune_id in enumerate(states["tune"]):
+        rows.append({
+            "tune": int(tune_id),
+            "ease": float(states["ease"][i]),
+            "interval_days": float(states["interval_days"][i]),
+            "repetitions": int(states["repetitions"][i]),
+            "lapses": int(states["lapses"][i]),
+            "last_reviewed": datetime.datetime.fromtimestamp(states["last_reviewed"][i]),
+            "due": datetime.datetime.fromtimestamp(states["due"][i]),
+        })
+
+    with db.db.atomic():
+        for batch in chunked(rows, 100):
+            (db.Review
+             .insert_many(batch)
+             .on_conflict(conflict_target=[db.Review.tune],
+                          preserve=[getattr(db.Review, f) for f in fields])
+             .execute())
+
+    return len(rows)
+
+def enroll_tunes(min_status: db.Status = db.Status.CAN_PLAY) -> int:
+    """
+    Start practicing every tune known at least as well as min_status that isn't
+    being practiced yet. They're due straight away.
+
+    Returns:
+        Number of tunes added
+    """
+    now = datetime.datetime.now()
+    new_tunes = (db.Tune
+                 .select(db.Tune.id, Value(DEFAULT_EASE), Value(0), Value(0), Value(0), Value(now))
+                 .where((db.Tune.status >= min_status.value)
+                        & db.Tune.id.not_in(db.Review.select(db.Review.tune))))
+
+    count = new_tunes.count()
+    if count:
+        (db.Review
+         .insert_from(new_tunes, fields=[db.Review.tune, db.Review.ease, db.Review.interval_days,
+                                         db.Review.repetitions, db.Review.lapses, db.Review.due])
+         .execute())
+
+    return count
+
+def due_reviews(limit: int, now: datetime.datetime = None) -> list:
+    """
+    Returns:
+        Up to limit reviews that are due, most overdue first, with their tunes.
+    """
+    now = now or datetime.datetime.now()
+    return list(db.Review
+                .select(db.Review, db.Tune)
+                .join(db.Tune)
+                .where(db.Review.due <= now)
+                .order_by(db.Review.due)
+                .limit(limit))
+
+class PracticeSession:
+    """
+    Grades tunes during a practice session, holding the changes in memory until
+    they're written together by flush.
+    """
+    def __init__(self):
+        self._reviews = []
+        self._logs = []
+
+    def grade(self, review: db.Review, grade: db.Grade, now: datetime.datetime = None) -> db.Review:
+        """
+        Update a review for a practice of its tune.
+
+        Returns:
+            The review, now scheduled for its next practice
+        """
+        now = now or datetime.datetime.now()
+        state = next_state(ReviewState(review.ease, review.interval_days, review.repetitions, review.lapses), grade)
+
+        review.ease = state.ease
+        review.interval_days = state.interval_days
+        review.repetitions = state.repetitions
+        review.lapses = state.lapses
+        review.last_reviewed = now
+        review.due = now + datetime.timedelta(days=state.interval_days)
+
+        self._reviews.append(review)
+        self._logs.append({"tune": review.tune_id, "grade": grade.value, "reviewed_at": now})
+
+        return review
+
+    def flush(self) -> int:
+        """
+        Write every graded review and its log entry in one transaction.
+
+        Returns:
+            Number of reviews written
+        """
+        count = len(self._reviews)
+        if not count:
+            return 0
+
+        with db.db.atomic():
+            db.Review.bulk_update(self._reviews, fields=[db.Review.ease, db.Review.interval_days,
+                                                         db.Review.repetitions, db.Review.lapses,
+                                                         db.Review.last_reviewed, db.Review.due],
+                                  batch_size=100)
+            for batch in chunked(self._logs, 100):
+                db.ReviewLog.insert_many(batch).execute()
+
+        self._reviews = []
+        self._logs = []
+
+        return count
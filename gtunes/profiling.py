@@ -0,0 +1,183 @@
+# Lightweight timing spans, for finding out where a command spends its time.
+#
+#   with profiling.span("thesession GET", url=url) as s:
+#       response = session.get(url)
+#       s.add_bytes(len(response.content))
+#
+# Spans nest, and are aggregated by their path from the root into a tree of wall
+# time, call count and bytes that's printed at exit. Each span can also be kept
+# as a Chrome trace event, viewable in chrome://tracing or https://ui.perfetto.dev.
+#
+# Profiling is off unless enable is called (gtn --profile). Then span returns a
+# shared do-nothing context manager, so instrumented code costs a function call.
+
+import atexit
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+
+enabled = False
+
+_lock = threading.Lock()
+# The nodes of the spans being timed, innermost last. A context variable rather
+# than a thread local so spans in concurrent asyncio tasks nest correctly too.
+_stack = contextvars.ContextVar("profiling_stack", default=())
+_trace_path = None
+_trace_events = []
+
+class _Node:
+    """
+    Totals of every span with the same path from the root.
+    """
+    __slots__ = ("name", "count", "seconds", "bytes", "children")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.children = {}
+
+    def child(self, name: str) -> "_Node":
+        node = self.children.get(name)
+        if node is None:
+            node = self.children[name] = _Node(name)
+        return node
+
+_root = _Node("")
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add_bytes(self, n: int):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    __slots__ = ("name", "args", "bytes", "_node", "_start", "_token")
+
+    def __init__(self, name: str, args: dict):
+        self.name = name
+        self.args = args
+        self.bytes = 0
+
+    def add_bytes(self, n: int):
+        self.bytes += n
+
+    def __enter__(self):
+        stack = _stack.get()
+        # Spans of other threads start at the root
+        parent = stack[-1] if stack else _root
+        with _lock:
+            self._node = parent.child(self.name)
+        self._token = _stack.set(stack + (self._node,))
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        _stack.reset(self._token)
+        with _lock:
+            self._node.count += 1
+            self._node.seconds += end - self._start
+            self._node.bytes += self.bytes
+            if _trace_path:
+                args = dict(self.args, bytes=self.bytes) if self.bytes else self.args
+                _trace_events.append({"name": self.name, "ph": "X", "pid": os.getpid(),
+                                      "tid": threading.get_ident(), "ts": self._start * 1e6,
+                                      "dur": (end - self._start) * 1e6,
+                                      "args": {k: str(v) for k, v in args.items()}})
+        return False
+
+def span(name: str, **args):
+    """
+    Time a block of code as a span of the given name, a child of the span it's in.
+
+    Args:
+        name: what's being done. Spans are totalled by name, so keep ids and
+            urls out of it and pass them as args.
+        args: details kept in the trace
+
+    Returns:
+        A context manager. Call add_bytes on it to count bytes sent or received.
+    """
+    if not enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+def enable(trace_path: str = None, summary_file=sys.stderr):
+    """
+    Start recording spans. A summary is printed to summary_file at exit, and the
+    spans are written as a Chrome trace to trace_path if given.
+    """
+    global enabled, _trace_path
+    enabled = True
+    _trace_path = trace_path
+    atexit.register(_at_exit, summary_file)
+
+def _at_exit(summary_file):
+    if summary_file:
+        print_summary(summary_file)
+    if _trace_path:
+        write_trace(_trace_path)
+
+def _format_bytes(n: int) -> str:
+    for unit in ("B", "KB", "MB"):
+        if n < 1024:
+            return f"{n:.0f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GB"
+
+def summary() -> list:
+    """
+    Returns:
+        (depth, name, count, seconds, bytes) for every node of the span tree,
+        depth first, slowest first among siblings.
+    """
+    rows = []
+
+    def visit(node, depth):
+        for child in sorted(node.children.values(), key=lambda c: c.seconds, reverse=True):
+            rows.append((depth, child.name, child.count, child.seconds, child.bytes))
+            visit(child, depth + 1)
+
+    with _lock:
+        visit(_root, 0)
+
+    return rows
+
+def print_summary(file=sys.stderr):
+    rows = summary()
+    if not rows:
+        return
+
+    width = max(2 * depth + len(name) for depth, name, *_ in rows)
+    print(f"\n{'span':<{width}}  {'total':>9}  {'calls':>6}  {'bytes':>9}", file=file)
+    for depth, name, count, seconds, n_bytes in rows:
+        label = "  " * depth + name
+        print(f"{label:<{width}}  {seconds:>8.3f}s  {count:>6}  {_format_bytes(n_bytes) if n_bytes else '':>9}",
+              file=file)
+
+def write_trace(path: str):
+    with _lock:
+        events = list(_trace_events)
+    with open(path, "w") as trace_file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+
+def reset():
+    """
+    Forget every span recorded so far.
+    """
+    global _root
+    with _lock:
+        _root = _Node("")
+        _trace_events.clear()
+    _stack.set(())
@@ -0,0 +1,136 @@
+# SQL statement logging, for catching slow queries and N+1 query patterns.
+#
+# While a QueryLog is capturing, every statement db.Database runs is counted and
+# timed under its shape: the SQL with parameter lists collapsed, so the same query
+# for different rows has the same shape. A SELECT shape that's run over and over
+# in one command is usually a loop touching a foreign key or backref per row (an
+# N+1), better done with a join or prefetch.
+#
+# gtn reports on every command when GTUNES_LOG_LEVEL=DEBUG, and tests can hold a
+# block of code to a query budget:
+#
+#   with querylog.budget(3):
+#       rec_info(args)
+
+import collections
+import contextlib
+import os
+import re
+import threading
+import time
+
+from gtunes import util
+
+glog = util.get_logger()
+
+# Statements slower than this are listed in the report
+SLOW_QUERY_SECS = float(os.getenv("GTUNES_SLOW_QUERY_MS", 50)) / 1000
+
+# A SELECT run this many times in one command is reported as an N+1
+REPEAT_THRESHOLD = 5
+
+# The logs capturing statements. Checked before any timing is done, so there's
+# nothing to pay when nothing is capturing.
+_active = []
+_lock = threading.Lock()
+
+_PARAMETER_LIST = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+
+def shape(sql: str) -> str:
+    """
+    Returns:
+        The SQL with lists of parameters collapsed to one, so queries that only
+        differ in their parameters have the same shape.
+    """
+    return _PARAMETER_LIST.sub("(?, ...)", sql)
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+class QueryLog:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = collections.Counter()
+        self.shape_seconds = collections.defaultdict(float)
+        self.slow = []
+
+    def record(self, sql: str, seconds: float):
+        query_shape = shape(sql)
+        self.count += 1
+        self.seconds += seconds
+        self.shapes[query_shape] += 1
+        self.shape_seconds[query_shape] += seconds
+        if seconds >= SLOW_QUERY_SECS:
+            self.slow.append((seconds, sql))
+
+    def repeated(self, threshold: int = REPEAT_THRESHOLD) -> list:
+        """
+        Returns:
+            (shape, count) of every SELECT run at least threshold times, most first.
+        """
+        return [(s, n) for s, n in self.shapes.most_common()
+                if n >= threshold and s.lstrip().upper().startswith("SELECT")]
+
+    def report(self) -> str:
+        lines = [f"{self.count} queries in {self.seconds * 1000:.1f}ms"]
+        for seconds, sql in sorted(self.slow, reverse=True):
+            lines.append(f"  slow ({seconds * 1000:.1f}ms): {sql}")
+        for query_shape, count in self.repeated():
+            lines.append(f"  repeated {count} times ({self.shape_seconds[query_shape] * 1000:.1f}ms), "
+                         f"possible N+1: {query_shape}")
+        return "\n".join(lines)
+
+def capturing() -> bool:
+    return bool(_active)
+
+def record(sql: str, seconds: float):
+    """
+    Add a statement to every capturing log.
+    """
+    with _lock:
+        for log in _active:
+            log.record(sql, seconds)
+
+@contextlib.contextmanager
+def capture():
+    """
+    Log every statement run in the block, from any thread.
+
+    Yields:
+        The QueryLog
+    """
+    log = QueryLog()
+    with _lock:
+        _active.append(log)
+    try:
+        yield log
+    finally:
+        with _lock:
+            _active.remove(log)
+
+@contextlib.contextmanager
+def budget(max_queries: int, max_repeats: int = None):
+    """
+    Raise QueryBudgetExceeded if the block runs more than max_queries statements,
+    or, if max_repeats is given, any SELECT more than max_repeats times.
+    """
+    with capture() as log:
+        yield log
+
+    if log.count > max_queries:
+        raise QueryBudgetExceeded(f"Ran {log.count} queries, budget was {max_queries}:\n{log.report()}")
+
+    repeats = log.repeated(max_repeats + 1) if max_repeats is not None else []
+    if repeats:
+        raise QueryBudgetExceeded(f"Ran a query {repeats[0][1]} times, budget was {max_repeats}:\n{log.report()}")
+
+def timed(execute, sql: str):
+    """
+    Run execute(), recording it as sql in every capturing log.
+    """
+    start = time.perf_counter()
+    try:
+        return execute()
+    finally:
+        record(sql, time.perf_counter() - start)
@@ -0,0 +1,389 @@
+# One queue for every request gtunes makes to a host, so background work can't
+# crowd out a command someone is waiting on.
+#
+# Requests are in one of three priority classes, set for a block of code with
+# priority() and inherited by the threads and tasks it starts through
+# contextvars:
+#
+#   interactive  (the default) a command or a TUI waiting on the answer
+#   prefetch     looking ahead for a TUI, like gtn tune spot --prefetch
+#   bulk         library wide jobs, like gtn tune enrich --all
+#
+#   with scheduler.priority(scheduler.Priority.BULK):
+#       enrich.enrich_tunes(tunes)
+#
+# Each host has a number of slots (requests in flight at once) and a rate
+# limit. A few slots are kept for interactive requests, and interactive
+# requests go ahead of every queued background one, so a lookup never waits
+# behind more than a handful of background fetches. The background classes
+# share the rest by weight (WEIGHTS), in the order each asked.
+#
+# Sessions and transports are scheduled by wrapping their adapters:
+#
+#   scheduler.schedule(session)
+#   httpx.AsyncClient(transport=scheduler.ScheduledAsyncTransport(transport))
+#
+# both through the scheduler they're given, or the one shared by the process.
+#
+# A slot is held until the response's headers are in, so a streamed body
+# doesn't keep one. How long each class waited for its slots is logged as a
+# histogram at exit with GTUNES_LOG_LEVEL=debug.
+
+import asyncio
+import atexit
+import bisect
+import collections
+import contextlib
+import contextvars
+import enum
+import logging
+import threading
+import time
+import urllib.parse
+from dataclasses import dataclass, field
+
+import httpx
+import requests
+import requests.adapters
+
+from gtunes import util
+
+glog = util.get_logger()
+
+class Priority(enum.IntEnum):
+    INTERACTIVE = 0
+    PREFETCH = 1
+    BULK = 2
+
+@dataclass(frozen=True)
+class HostLimits:
+    concurrency: int = 8
+    # Requests started per second, unlimited if 0
+    rate: float = 0
+    # Slots only interactive requests may take
+    reserved: int = 2
+
+HOST_LIMITS = {
+    "thesession.org": HostLimits(concurrency=8, rate=10, reserved=2),
+    "api.spotify.com": HostLimits(concurrency=16, reserved=4),
+}
+DEFAULT_LIMITS = HostLimits()
+
+# How many slots each background class gets in turn while both are waiting
+WEIGHTS = {Priority.PREFETCH: 4, Priority.BULK: 1}
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+_priority = contextvars.ContextVar("request_priority", default=Priority.INTERACTIVE)
+
+@contextlib.contextmanager
+def priority(request_priority: Priority):
+    """
+    Make the requests of a block of code, and of threads and tasks started from
+    it with their context, in a priority class.
+    """
+    token = _priority.set(request_priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+def current_priority() -> Priority:
+    return _priority.get()
+
+def with_priority(request_priority: Priority, fn, *args, **kwargs):
+    """
+    Call fn in a priority class, e.g. as the function submitted to an executor,
+    whose threads don't inherit the submitter's context.
+    """
+    with priority(request_priority):
+        return fn(*args, **kwargs)
+
+@dataclass
+class Histogram:
+    counts: list = field(default_factory=lambda: [0] * (len(HISTOGRAM_BOUNDS_MS) + 1))
+    total: int = 0
+
+    def add(self, seconds: float):
+        self.counts[bisect.bisect_left(HISTOGRAM_BOUNDS_MS, seconds * 1000)] += 1
+        self.total += 1
+
+    def percentile(self, p: float) -> float:
+        """
+        Returns:
+            The upper bound, in ms, of the bucket the percentile falls in. Inf
+            if it's past the last bound.
+        """
+        if not self.total:
+            return 0.0
+        rank = p * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return float(HISTOGRAM_BOUNDS_MS[i]) if i < len(HISTOGRAM_BOUNDS_MS) else float("inf")
+        return float("inf")
+
+    def __str__(self) -> str:
+        labels = [f"<{b}ms" for b in HISTOGRAM_BOUNDS_MS] + [f">={HISTOGRAM_BOUNDS_MS[-1]}ms"]
+        return " ".join(f"{label}:{count}" for label, count in zip(labels, self.counts) if count)
+
+@dataclass
+class ClassStats:
+    requests: int = 0
+    # From asking for a slot to getting it
+    wait: Histogram = field(default_factory=Histogram)
+    # From asking for a slot to giving it back
+    latency: Histogram = field(default_factory=Histogram)
+
+    def __str__(self) -> str:
+        return (f"{self.requests} requests, wait p50 {self.wait.percentile(0.5):.0f}ms "
+                f"p95 {self.wait.percentile(0.95):.0f}ms, latency p50 {self.latency.percentile(0.5):.0f}ms "
+                f"p95 {self.latency.percentile(0.95):.0f}ms\n  wait:    {self.wait}\n  latency: {self.latency}")
+
+class _Waiter:
+    __slots__ = ("priority", "asked_at", "granted", "_grant")
+
+    def __init__(self, request_priority: Priority, grant):
+        self.priority = request_priority
+        self.asked_at = time.monotonic()
+        self.granted = False
+        self._grant = grant
+
+class _Host:
+    def __init__(self, limits: HostLimits):
+        self.limits = limits
+        self.in_flight = 0
+        self.queues = {p: collections.deque() for p in Priority}
+        self.turns = dict(WEIGHTS)
+        self.tokens = float(max(1, limits.rate))
+        self.refilled_at = time.monotonic()
+        self.timer = None
+
+    def next_class(self) -> Priority | None:
+        """
+        The class of the next request to get a slot, if one can now.
+        """
+        if self.queues[Priority.INTERACTIVE] and self.in_flight < self.limits.concurrency:
+            return Priority.INTERACTIVE
+        if self.in_flight >= self.limits.concurrency - self.limits.reserved:
+            return None
+
+        waiting = [p for p in WEIGHTS if self.queues[p]]
+        if not waiting:
+            return None
+        if not any(self.turns[p] for p in waiting):
+            self.turns = dict(WEIGHTS)
+        chosen = next(p for p in waiting if self.turns[p])
+        self.turns[chosen] -= 1
+        return chosen
+
+    def take_token(self) -> float:
+        """
+        Returns:
+            0 if a request may start now, otherwise the seconds until one may
+        """
+        if not self.limits.rate:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(max(1, self.limits.rate),
+                          self.tokens + (now - self.refilled_at) * self.limits.rate)
+        self.refilled_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.limits.rate
+
+class Scheduler:
+    """
+    Gives out request slots by host and priority class. See the module comment.
+    """
+    def __init__(self, host_limits: dict = None, default_limits: HostLimits = DEFAULT_LIMITS):
+        self.host_limits = dict(HOST_LIMITS if host_limits is None else host_limits)
+        self.default_limits = default_limits
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self._stats = {p: ClassStats() for p in Priority}
+
+    def _host(self, host: str) -> _Host:
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = _Host(self.host_limits.get(host, self.default_limits))
+        return state
+
+    def _ask(self, host: str, waiter: _Waiter):
+        with self._lock:
+            self._host(host).queues[waiter.priority].append(waiter)
+            self._dispatch(host)
+
+    def _dispatch(self, host: str):
+        """
+        Grant every slot that can be. Called with the lock held.
+        """
+        state = self._host(host)
+        while True:
+            request_priority = state.next_class()
+            if request_priority is None:
+                return
+
+            wait = state.take_token()
+            if wait:
+                # Undo the turn next_class took, it's taken again when the timer fires
+                if request_priority in WEIGHTS:
+                    state.turns[request_priority] += 1
+                if state.timer is None:
+                    state.timer = threading.Timer(wait, self._on_timer, args=(host,))
+                    state.timer.daemon = True
+                    state.timer.start()
+                return
+
+            waiter = state.queues[request_priority].popleft()
+            state.in_flight += 1
+            waiter.granted = True
+            self._stats[request_priority].wait.add(time.monotonic() - waiter.asked_at)
+            waiter._grant()
+
+    def _on_timer(self, host: str):
+        with self._lock:
+            self._host(host).timer = None
+            self._dispatch(host)
+
+    def _release(self, host: str, waiter: _Waiter):
+        with self._lock:
+            self._host(host).in_flight -= 1
+            stats = self._stats[waiter.priority]
+            stats.requests += 1
+            stats.latency.add(time.monotonic() - waiter.asked_at)
+            self._dispatch(host)
+
+    @contextlib.contextmanager
+    def slot(self, host: str, request_priority: Priority = None):
+        """
+        Wait for a slot on a host, blocking the thread, and hold it for the block.
+
+        Args:
+            request_priority: current_priority() if None
+        """
+        granted = threading.Event()
+        waiter = _Waiter(request_priority if request_priority is not None else current_priority(), granted.set)
+        self._ask(host, waiter)
+        try:
+            granted.wait()
+        except BaseException:
+            # e.g. KeyboardInterrupt
+            self._give_up(host, waiter)
+            raise
+
+        try:
+            yield
+        finally:
+            self._release(host, waiter)
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, host: str, request_priority: Priority = None):
+        """
+        slot for asyncio: waits without blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def grant():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        waiter = _Waiter(request_priority if request_priority is not None else current_priority(), grant)
+        self._ask(host, waiter)
+        try:
+            await granted
+        except asyncio.CancelledError:
+            self._give_up(host, waiter)
+            raise
+
+        try:
+            yield
+        finally:
+            self._release(host, waiter)
+
+    def _give_up(self, host: str, waiter: _Waiter):
+        """
+        Stop waiting for a slot, giving it back if it was granted meanwhile.
+        """
+        with self._lock:
+            if not waiter.granted:
+                self._host(host).queues[waiter.priority].remove(waiter)
+                return
+        self._release(host, waiter)
+
+    def in_flight(self, host: str) -> int:
+        with self._lock:
+            return self._host(host).in_flight
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            ClassStats by priority class, of the requests finished so far
+        """
+        with self._lock:
+            return {p: ClassStats(s.requests, Histogram(list(s.wait.counts), s.wait.total),
+                                  Histogram(list(s.latency.counts), s.latency.total))
+                    for p, s in self._stats.items()}
+
+    def log_stats(self):
+        for request_priority, stats in self.stats().items():
+            if stats.requests:
+                glog.debug(f"Requests {request_priority.name.lower()}: {stats}")
+
+# The scheduler every session and transport shares
+shared = Scheduler()
+
+@atexit.register
+def _log_stats_at_exit():
+    if glog.isEnabledFor(logging.DEBUG):
+        shared.log_stats()
+
+def _host_of(url) -> str:
+    return urllib.parse.urlsplit(str(url)).hostname or ""
+
+class ScheduledAdapter(requests.adapters.BaseAdapter):
+    """
+    Sends each request through another adapter once it has a slot.
+    """
+    def __init__(self, adapter: requests.adapters.BaseAdapter, scheduler: Scheduler = None):
+        super().__init__()
+        self.adapter = adapter
+        self.scheduler = scheduler
+
+    def send(self, request, **kwargs):
+        with (self.scheduler or shared).slot(_host_of(request.url)):
+            return self.adapter.send(request, **kwargs)
+
+    def close(self):
+        self.adapter.close()
+
+def schedule(session: requests.Session, scheduler: Scheduler = None) -> requests.Session:
+    """
+    Schedule every request of a session, wrapping the adapters mounted on it.
+    """
+    for prefix, adapter in list(session.adapters.items()):
+        if not isinstance(adapter, ScheduledAdapter):
+            session.mount(prefix, ScheduledAdapter(adapter, scheduler))
+    return session
+
+class ScheduledAsyncTransport(httpx.AsyncBaseTransport):
+    """
+    Sends each request through another transport once it has a slot.
+    """
+    def __init__(self, transport: httpx.AsyncBaseTransport, scheduler: Scheduler = None):
+        self.transport = transport
+        self.scheduler = scheduler
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        async with (self.scheduler or shared).aslot(_host_of(request.url)):
+            return await self.transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    def __getattr__(self, name):
+        # e.g. the archive of a recording transport
+        return getattr(self.transport, name)
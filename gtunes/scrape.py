@@ -1,68 +1,280 @@
 #!/usr/bin/env python3
 
+import asyncio
+import concurrent.futures
+import contextlib
+import math
+import os
 import re
+import httpx
 import requests
 import queue
 import threading
 from dataclasses import dataclass
-from bs4 import BeautifulSoup
 import logging
+from urllib3.util.retry import Retry
+import peewee
+from gtunes import abcnotation
+from gtunes import db
+from gtunes import htmlextract
+from gtunes import httpfixtures
+from gtunes import profiling
+from gtunes import scheduler
 
 debug=False
 TUNE_DELIMITER = " / "
 
-def print_debug(debug_str):
-    global debug
-    if debug:
-        print(debug_str)
+# Point at a stand-in server (see httpfixtures) to scrape without the network
+BASE_URL = os.getenv("GTUNES_SESSION_URL", "https://thesession.org").rstrip("/")
+TIMEOUT_SECS = 30
 
-def query_the_session(tune_name: str) -> list | None:
-    global debug
-    ret = []
-    split_name = [word.lower() for word in tune_name.split()]
-    url = f"https://thesession.org/tunes/search?q={split_name.pop(0)}"
+# Retry rate limiting and server errors, honoring Retry-After
+RETRIES = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
 
-    for word in split_name:
-        url += f"+{word}"
+# One session shared by every request, so connections are reused, and
+# scheduled with the rest of the process's requests
+session = requests.Session()
+httpfixtures.mount(session, max_retries=RETRIES, pool_maxsize=16)
+scheduler.schedule(session)
 
-    response = requests.get(url)
+# Requests in flight at once from an async client
+MAX_CONNECTIONS = 8
 
-    soup = BeautifulSoup(response.text, 'html.parser')
+# Bytes read at a time from streamed pages
+STREAM_CHUNK_SIZE = 16 * 1024
 
-    tune_items = soup.find_all('li', class_='manifest-item')
+# Pages of a list fetched at once after the first, to be polite to TheSession
+PAGE_CONCURRENCY = 4
 
-    if len(tune_items) == 0:
-        print_debug(f"Did not find any tunes to match tune name {tune_name}")
+# Links to the pages of a list: /tunes/1/recordings?page=2, /tunes/search?q=kesh&amp;page=2
+PAGE_LINK = re.compile(rb"[?&;]page=(\d+)")
 
-        return {"name": None, "id": None}
+def _get(path: str) -> requests.Response:
+    with profiling.span("thesession GET", path=path) as s:
+        response = session.get(BASE_URL + path, timeout=TIMEOUT_SECS)
+        s.add_bytes(len(response.content))
+    return response
 
-    print_debug(f"Found {len(tune_items)} tunes matching your query.")
-    for tune_data in tune_items:
-        # print(tune_data.prettify())
+@contextlib.contextmanager
+def _stream(path: str):
+    """
+    _get, but the body is read as it's used, from the chunks given.
+    """
+    with profiling.span("thesession GET", path=path, stream=True) as s:
+        with session.get(BASE_URL + path, timeout=TIMEOUT_SECS, stream=True) as response:
+            def chunks():
+                for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                    s.add_bytes(len(chunk))
+                    yield chunk
+            yield response, chunks()
+
+def async_client(transport: httpx.AsyncBaseTransport = None) -> httpx.AsyncClient:
+    """
+    An async client for TheSession, pooling up to MAX_CONNECTIONS connections.
+    Use it as an async context manager, so the connections are closed.
 
-        id = tune_data.find("a-preview").get("data-tuneid")
-        name_and_alt = tune_data.find_all('a')
-        name = name_and_alt[0] if len(name_and_alt) == 1 else \
-            f"{name_and_alt[0]} {name_and_alt[1]}"
-        
-        ret.append({"name" : name, "id": id})
+    Args:
+        transport: defaults to the one for GTUNES_HTTP_MODE
+    """
+    limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS)
+    if transport is None:
+        transport = httpfixtures.async_transport(limits=limits)
+    return httpx.AsyncClient(base_url=BASE_URL, timeout=TIMEOUT_SECS, limits=limits,
+                             transport=scheduler.ScheduledAsyncTransport(transport))
+
+async def _aget(client: httpx.AsyncClient, path: str) -> httpx.Response:
+    """
+    _get for an async client, retrying like RETRIES.
+    """
+    for attempt in range(RETRIES.total + 1):
+        with profiling.span("thesession GET", path=path) as s:
+            response = await client.get(path)
+            s.add_bytes(len(response.content))
+
+        if response.status_code not in RETRIES.status_forcelist:
+            return response
+        if attempt == RETRIES.total:
+            response.raise_for_status()
+
+        retry_after = response.headers.get("Retry-After")
+        delay = float(retry_after) if retry_after and retry_after.isdigit() else RETRIES.backoff_factor * 2 ** attempt
+        logging.debug(f"{response.status_code} for {path}, retrying in {delay}s")
+        await asyncio.sleep(delay)
+
+@contextlib.asynccontextmanager
+async def _astream(client: httpx.AsyncClient, path: str):
+    """
+    _aget, but the body is read as it's used, with response.aiter_bytes.
+    """
+    for attempt in range(RETRIES.total + 1):
+        with profiling.span("thesession GET", path=path, stream=True):
+            async with client.stream("GET", path) as response:
+                if response.status_code not in RETRIES.status_forcelist:
+                    yield response
+                    return
+                if attempt == RETRIES.total:
+                    response.raise_for_status()
+
+        retry_after = response.headers.get("Retry-After")
+        delay = float(retry_after) if retry_after and retry_after.isdigit() else RETRIES.backoff_factor * 2 ** attempt
+        logging.debug(f"{response.status_code} for {path}, retrying in {delay}s")
+        await asyncio.sleep(delay)
+
+def _page_path(path: str, page: int) -> str:
+    return f"{path}{'&' if '?' in path else '?'}page={page}" if page > 1 else path
+
+class _PageLinks:
+    """
+    Passes the chunks of a page through, noting the last page of the list it
+    links to.
+    """
+    def __init__(self):
+        self.last_page = 1
+        self._tail = b""
+
+    def _scan(self, chunk: bytes) -> bytes:
+        # Keep the end of the chunk in case a link is split between chunks
+        for match in PAGE_LINK.finditer(self._tail + chunk):
+            self.last_page = max(self.last_page, int(match.group(1)))
+        self._tail = chunk[-32:]
+        return chunk
+
+    def scan(self, chunks):
+        for chunk in chunks:
+            yield self._scan(chunk)
+
+    async def ascan(self, chunks):
+        async for chunk in chunks:
+            yield self._scan(chunk)
+
+def _pages_to_fetch(last_page: int, per_page: int, limit: int | None) -> range:
+    """
+    Returns:
+        The pages after the first still needed for limit items, when the first
+        page had per_page of them.
+    """
+    if not per_page:
+        return range(0)
+    pages = range(2, last_page + 1)
+    if limit:
+        pages = pages[:math.ceil((limit - per_page) / per_page)]
+    return pages
+
+def _iter_list(path: str, limit: int = None):
+    """
+    The manifest items of every page of a list, like a tune's recordings or
+    search results. The first page is streamed and gives the number of pages,
+    then the rest are fetched PAGE_CONCURRENCY at a time.
+
+    Args:
+        limit: stop after this many, fetching no more pages than needed
+
+    Yields:
+        htmlextract.Node of each item, in the order of the list
+    """
+    count = 0
+    links = _PageLinks()
+    with _stream(path) as (response, chunks):
+        for item in htmlextract.iter_extract(links.scan(chunks), htmlextract.MANIFEST_ITEMS):
+            yield item
+            count += 1
+            if count == limit:
+                return
+
+    pages = _pages_to_fetch(links.last_page, count, limit)
+    if not pages:
+        return
+    logging.debug(f"Fetching pages {pages.start}-{pages.stop - 1} of {path}")
+
+    with concurrent.futures.ThreadPoolExecutor(PAGE_CONCURRENCY, thread_name_prefix="thesession pages") as executor:
+        futures = [executor.submit(scheduler.with_priority, scheduler.current_priority(), _get, _page_path(path, page))
+                   for page in pages]
+        try:
+            for future in futures:
+                for item in htmlextract.extract(future.result().text, htmlextract.MANIFEST_ITEMS):
+                    yield item
+                    count += 1
+                    if count == limit:
+                        return
+        finally:
+            for future in futures:
+                future.cancel()
+
+async def _aiter_list(client: httpx.AsyncClient, path: str, limit: int = None, semaphore: asyncio.Semaphore = None):
+    """
+    _iter_list for an async client, fetching the pages after the first under
+    semaphore.
+    """
+    count = 0
+    links = _PageLinks()
+    async with _astream(client, path) as response:
+        items = htmlextract.aiter_extract(links.ascan(response.aiter_bytes()), htmlextract.MANIFEST_ITEMS)
+        async for item in items:
+            yield item
+            count += 1
+            if count == limit:
+                return
+
+    pages = _pages_to_fetch(links.last_page, count, limit)
+    semaphore = semaphore or asyncio.Semaphore(PAGE_CONCURRENCY)
+
+    async def fetch(page):
+        async with semaphore:
+            return await _aget(client, _page_path(path, page))
+
+    tasks = [asyncio.ensure_future(fetch(page)) for page in pages]
+    try:
+        for task in tasks:
+            for item in htmlextract.extract((await task).text, htmlextract.MANIFEST_ITEMS):
+                yield item
+                count += 1
+                if count == limit:
+                    return
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def print_debug(debug_str):
+    global debug
+    if debug:
+        print(debug_str)
+
+def query_the_session(tune_name: str, limit: int = None) -> list | None:
+    """
+    Returns:
+        {"name", "id"} of each tune found by searching for the name, on every
+        page of results, or only the first limit of them
+    """
+    ret = [_search_result(item) for item in _iter_list(_search_path(tune_name), limit)]
+
+    if len(ret) == 0:
+        print_debug(f"Did not find any tunes to match tune name {tune_name}")
+    else:
+        print_debug(f"Found {len(ret)} tunes matching your query.")
 
     return ret
 
+def _search_path(tune_name: str) -> str:
+    return "/tunes/search?q=" + "+".join(word.lower() for word in tune_name.split())
+
+def _search_result(tune_data: htmlextract.Node) -> dict:
+    id = tune_data.find("a-preview").get("data-tuneid")
+    name_and_alt = tune_data.find_all('a')
+    name = name_and_alt[0].text if len(name_and_alt) == 1 else \
+        f"{name_and_alt[0].text} {name_and_alt[1].text}"
+
+    return {"name" : name, "id": id}
+
         
 
 def get_abc(tune_id, should_print=False):
-    url = f"https://thesession.org/tunes/{tune_id}"
-    response = requests.get(url)
-    soup = BeautifulSoup(response.text, 'html.parser')
-
-    divs = soup.find_all('div', class_='notes')
+    response = _get(f"/tunes/{tune_id}")
+    divs = htmlextract.extract(response.text, (("div", "notes"),))
 
     return [div.text.strip() for div in divs]
 
 def _get_tune_id(tune_name):
-    tunes = query_the_session(tune_name)
-    # TODO: if this doesn't find anything it actually returns "{'name': None, 'id': None}"
+    tunes = query_the_session(tune_name, limit=1)
     if len(tunes) == 0:
         return None
     id = tunes[0]['id']
@@ -77,33 +289,75 @@ def get_abc_by_name(name, interactive=False):
 # has an internal link, a-preview, pointing to the tunes of the track.
 # This has an internal "data-tunid" which we can compare to our input tune_id to
 # find the appropriate track. 
-def find_track_number(recording_id, tune_id):
+#
+# Every album page parsed is saved in the recording catalog (db.SessionRecording),
+# and the catalog is checked first, so each album is only fetched once. The
+# catalog is only used when the command has the database open. Given a list of
+# albums, the pages are added to it for the caller to save instead, as
+# (recording id, tracks, album name, artist name).
+def find_track_number(recording_id, tune_id, album_name: str = None, artist_name: str = None,
+                      albums: list = None):
     print_debug(f"Finding track number for recording_id={recording_id} and tune_id={tune_id}")
-    response = requests.get(f"https://thesession.org/recordings/{recording_id}")
-    soup = BeautifulSoup(response.text, 'html.parser')
-
-    track_number = None
-    tune_number = None
-    tracks = soup.find_all("li", class_="manifest-item")
-    target_track = None
-    for i, track in enumerate(tracks, 1):
-        track_tunes = track.find_all("a-preview")
-        for j, tt in enumerate(track_tunes, 1):
-            if int(tt["data-tuneid"]) == tune_id:
-                track_number = i
-                tune_number = j
-                target_track = track
-                break
+    cached = _catalog_track_number(recording_id, tune_id)
+    if cached is not None:
+        return cached
+
+    response = _get(f"/recordings/{recording_id}")
+    tracks = _parse_album(response.text)
+    if response.ok:
+        if albums is not None:
+            if tracks:
+                albums.append((int(recording_id), tracks, album_name, artist_name))
+        else:
+            _catalog_save(recording_id, tracks, album_name, artist_name)
+    return _track_number(tracks, tune_id)
+
+def _parse_album(html: str) -> list:
+    """
+    Returns:
+        (title, [(tune id, tune name), ...]) of each track on an album page
+    """
+    tracks = []
+    for track in htmlextract.extract(html, htmlextract.MANIFEST_ITEMS):
+        links = [a.text for a in track.find_all("a")]
+        tune_ids = [int(tt["data-tuneid"]) for tt in track.find_all("a-preview")]
+        names = links if len(links) == len(tune_ids) else [None] * len(tune_ids)
+        tracks.append((TUNE_DELIMITER.join(links), list(zip(tune_ids, names))))
+
+    return tracks
+
+def _track_number(tracks: list, tune_id) -> dict:
+    """
+    Returns:
+        Where a tune first is in the tracks of an album, as find_track_number.
+    """
+    for i, (title, tunes) in enumerate(tracks, 1):
+        for j, (ts_id, _) in enumerate(tunes, 1):
+            if ts_id == int(tune_id):
+                return {"track_number": i, "tune_number": j, "track_string": title}
 
-    set_string = ""
-    if target_track:
-        track_tune_links = target_track.find_all("a")
-        for a in track_tune_links:
-            set_string += a.text + TUNE_DELIMITER
-        set_string = set_string[:-len(TUNE_DELIMITER)] # Remove the last delimiter
+    return {"track_number": None, "tune_number": None, "track_string": ""}
 
+# The catalog is only used when the command has the database open, from whichever
+# thread is scraping
+def _catalog_track_number(recording_id, tune_id) -> dict | None:
+    if not db.in_use():
+        return None
+    try:
+        with db.thread_connection():
+            return db.session_track_number(int(recording_id), int(tune_id))
+    except peewee.DatabaseError as e:
+        logging.debug(f"Recording catalog unavailable: {e}")
+        return None
 
-    return { "track_number": track_number, "tune_number": tune_number, "track_string": set_string }
+def _catalog_save(recording_id, tracks: list, album_name: str = None, artist_name: str = None):
+    if not db.in_use() or not tracks:
+        return
+    try:
+        with db.thread_connection():
+            db.save_session_recording(int(recording_id), tracks, name=album_name, artist=artist_name)
+    except peewee.DatabaseError as e:
+        logging.debug(f"Couldn't save recording {recording_id} to the catalog: {e}")
     
 @dataclass
 class ScrapeRecordingData:
@@ -114,7 +368,8 @@ class ScrapeRecordingData:
     artist_name: str
 
 def scrape_recording_data(tune_name: str = None, tune_id: str = None, limit: int = None, 
-                          data_queue: queue.Queue = None, stop_event: threading.Event = None) -> queue.Queue | list:
+                          data_queue: queue.Queue = None, stop_event: threading.Event = None,
+                          albums: list = None) -> queue.Queue | list:
     """
     For a given tune name or id (one required)
      - scrape the page of all recordings of that tune from the session
@@ -128,6 +383,8 @@ def scrape_recording_data(tune_name: str = None, tune_id: str = None, limit: int
         data_queue: optionally return ScrapRecordingData to the input queue instead of
             returning it as a list at the end
         stop_event: optionally stop this function part way through if being run in a thread
+        albums: optionally add the album pages scraped to this list, for the caller
+            to save in the catalog, instead of saving them (see find_track_number)
     
     Returns:
         Either a list of ScrapeRecordingData, or None if a queue is being used.
@@ -142,62 +399,134 @@ def scrape_recording_data(tune_name: str = None, tune_id: str = None, limit: int
     
     print(f"Scraping album data for tune {tune_name if tune_name else "with id " + tune_id}...")
 
-    response = requests.get(f"https://thesession.org/tunes/{tune_id}/recordings")
-    soup = BeautifulSoup(response.text, 'html.parser')
+    output = []
+    logging.debug(f"Limiting to max_items={limit}")
+
+    # The first page of recordings is parsed as it arrives, so the first
+    # recording is looked up before the rest of the list is in
+    recordings = _iter_list(f"/tunes/{tune_id}/recordings", limit)
+    try:
+        for item in recordings:
+            if stop_event is not None and stop_event.is_set():
+                logging.debug("Stop event detected")
+                break
 
-    # Each recording list
-    recording_list_items = soup.find_all("li", class_="manifest-item")
+            entry = _scrape_recording(_recording(item), tune_id, albums)
+            if data_queue:
+                logging.debug("Putting entry to queue")
+                data_queue.put(entry)
+            else:
+                output.append(entry)
+    finally:
+        recordings.close()
 
-    logging.debug(f"len(recording_list_items)={len(recording_list_items)}")
+    if data_queue:
+        data_queue.put(None) # Tell the thread we're done.
 
-    max_items = len(recording_list_items) if not limit else min(len(recording_list_items), limit)
-    output = []
+    return output
 
-    logging.debug(f"Limiting to max_items={max_items}")
+def _scrape_recording(recording: tuple, tune_id, albums: list = None) -> ScrapeRecordingData:
+    name, album_id, artist_name = recording
 
-    for i in range(max_items):
-        if stop_event is not None:
-            if stop_event.is_set():
-                logging.debug("Stop event detected")
-                break
-            else:
-                logging.debug("not stopped")
+    # Unfortunately, in order to find the track number we need to scrape the
+    # album page itself. this could be solved by using irishtunes.info which
+    # has the album data and track number on the same page.
+    track_data = find_track_number(album_id, tune_id, name, artist_name, albums)
 
-        li = recording_list_items[i]
+    return ScrapeRecordingData(album_name=name,
+                               track_number=track_data["track_number"],
+                               tune_number=track_data["tune_number"],
+                               track_tunes=track_data["track_string"],
+                               artist_name=artist_name)
 
-        album_link = li.find("a", class_="manifest-item-title")
+def _recording(li: htmlextract.Node) -> tuple:
+    """
+    Returns:
+        (album name, album id, artist name) of a recordings page's list item
+    """
+    album_link = li.find("a", class_="manifest-item-title")
 
-        name = album_link.text
+    name = album_link.text
 
-        # the id is inside an href of the form: /recordings/3192?tune_id=3210
-        href = album_link["href"]
-        album_id = int(href.split("?")[0].split("/")[2])
+    # the id is inside an href of the form: /recordings/3192?tune_id=3210
+    href = album_link["href"]
+    album_id = int(href.split("?")[0].split("/")[2])
 
-        # the Artist is in the same list item under a span "bill-cost", perhaps
-        # because this html was reused from some commircial template. each one is
-        # a link
-        artist_name = li.find("span", class_="bill-item-cost").find("a").text
+    # the Artist is in the same list item under a span "bill-cost", perhaps
+    # because this html was reused from some commircial template. each one is
+    # a link
+    artist_name = li.find("span", class_="bill-item-cost").find("a").text
 
-        # Unfortunately, in order to find the track number we need to scrape the
-        # album page itself. this could be solved by using irishtunes.info which
-        # has the album data and track number on the same page.
-        track_data = find_track_number(album_id, tune_id)
+    return (name, album_id, artist_name)
 
-        entry = ScrapeRecordingData(album_name=name, 
-                                    track_number=track_data["track_number"], 
-                                    tune_number=track_data["tune_number"],
-                                    track_tunes=track_data["track_string"],
-                                    artist_name=artist_name)
+async def iter_recording_data(client: httpx.AsyncClient, tune_name: str = None, tune_id: int = None,
+                              limit: int = None, concurrency: int = MAX_CONNECTIONS):
+    """
+    scrape_recording_data for asyncio: the album pages are fetched concurrently,
+    and cancelling the task iterating stops every request in flight.
 
-        if data_queue:
-            logging.debug("Putting entry to queue")
-            data_queue.put(entry)
-        else:
-            output.append(entry)
-    if data_queue:
-        data_queue.put(None) # Tell the thread we're done.
+    Args:
+        client: from async_client
+        concurrency: album pages fetched at once
 
-    return output
+    Yields:
+        ScrapeRecordingData, in the order of the recordings page
+    """
+    if not tune_id:
+        tunes = [_search_result(item) async for item in _aiter_list(client, _search_path(tune_name), limit=1)]
+        if not tunes:
+            logging.debug(f"Did not find a tune id for tune name {tune_name}")
+            return
+        tune_id = int(tunes[0]["id"])
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def track_number(name, album_id, artist_name):
+        cached = _catalog_track_number(album_id, tune_id)
+        if cached is not None:
+            return cached
+
+        async with semaphore:
+            response = await _aget(client, f"/recordings/{album_id}")
+        tracks = _parse_album(response.text)
+        if response.is_success:
+            _catalog_save(album_id, tracks, name, artist_name)
+        return _track_number(tracks, tune_id)
+
+    # Album pages are fetched as the recordings page is parsed, before the rest
+    # of it has arrived
+    tasks = []
+    listed = asyncio.Queue()
+
+    async def list_recordings():
+        try:
+            items = _aiter_list(client, f"/tunes/{tune_id}/recordings", limit, semaphore)
+            try:
+                async for item in items:
+                    recording = _recording(item)
+                    tasks.append(asyncio.ensure_future(track_number(*recording)))
+                    listed.put_nowait((recording, tasks[-1]))
+            finally:
+                await items.aclose()
+        finally:
+            listed.put_nowait(None)
+
+    lister = asyncio.ensure_future(list_recordings())
+    try:
+        while (entry := await listed.get()) is not None:
+            (name, _, artist_name), task = entry
+            track_data = await task
+            yield ScrapeRecordingData(album_name=name,
+                                      track_number=track_data["track_number"],
+                                      tune_number=track_data["tune_number"],
+                                      track_tunes=track_data["track_string"],
+                                      artist_name=artist_name)
+        # Raise anything that stopped the listing
+        await lister
+    finally:
+        lister.cancel()
+        for task in tasks:
+            task.cancel()
 
 @dataclass
 class ScrapeTuneData:
@@ -207,33 +536,34 @@ class ScrapeTuneData:
     tune_abc: list
     tune_key: str
 
-def get_tune_data(tune_name: str) -> ScrapeTuneData | None:
-    tune_id = _get_tune_id(tune_name)
+def get_tune_data(tune_name: str = None, tune_id: int = None) -> ScrapeTuneData | None:
+    """
+    Scrape the tune page of TheSession for a tune's name, type, key and abc settings.
+
+    Args:
+        tune_name: name of the tune, used to search for the id if tune_id isn't passed
+        tune_id: TheSession id of the tune. Saves a search request when already known.
+    """
+    if not tune_id:
+        tune_id = _get_tune_id(tune_name)
     if not tune_id:
         logging.debug(f"Did not find a tune id for tune name {tune_name}")
         return None
     
-    url = f"https://thesession.org/tunes/{tune_id}"
-    response = requests.get(url)
-    soup = BeautifulSoup(response.text, 'html.parser')
+    response = _get(f"/tunes/{tune_id}")
+    page = htmlextract.extract(response.text, htmlextract.TUNE_PAGE)
 
     ts_id = tune_id
 
-    title = soup.find("h1")
+    title = next(node for node in page if node.tag == "h1")
     tune_name = title.text.strip()
     tune_type = title.find("a").text.strip()
 
-
-    abc_divs = soup.find_all('div', class_='notes')
+    abc_divs = [node for node in page if node.tag == "div"]
     tune_abc = [div.text.strip() for div in abc_divs]
 
-    first_tune_abc = tune_abc[0]
-    match = re.search(r'K:\s*(\S+)', first_tune_abc)
-
-    tune_key = None
-    if match:
-        tune_key = match.group(1)
-        print(tune_key)
+    first_tune_abc = tune_abc[0] if tune_abc else ""
+    tune_key = abcnotation.parse_headers(first_tune_abc)["key"]
     
     ret = ScrapeTuneData(tune_name, ts_id, tune_type, tune_abc, tune_key)
 
@@ -10,6 +10,17 @@ from gtunes import db
 from gtunes import audio
 from gtunes import util
 from gtunes import spot_select
+from gtunes import spotcandidates
+from gtunes import enrich
+from gtunes import jobs
+from gtunes import abcnotation
+from gtunes import incipit
+from gtunes import similarity
+from gtunes import practice as practice_
+from gtunes import sets
+from gtunes import profiling
+from gtunes import querylog
+import cProfile
 import dotenv
 import argparse
 import csv
@@ -20,6 +31,8 @@ import json
 import urllib.request
 import re
 import questionary
+import logging
+import time
 
 # ================
 # Tune subcommands
@@ -67,17 +80,19 @@ def _edit_and_save_tune_interactively(tune: db.Tune):
 
     tune.name = questionary.text("Name", default=_str_default(tune.name)).ask()
 
+    abc_settings = None
     should_init_from_session = questionary.confirm("Initialize from TheSession.org?").ask()
     if should_init_from_session:
         print("Scraping tune data from TheSession.org...")
         tune_data = scrape.get_tune_data(tune.name)
         if tune_data is not None:
             tune.name = tune_data.tune_name
-            tune.abc = tune_data.tune_abc
+            abc_settings = tune_data.tune_abc
             tune.key = tune_data.tune_key
             tune.ts_id = tune_data.ts_id
             print(f"Loaded tune data: Name: {tune.name} Key: {tune.key}")
-            print(tune.abc[0])
+            if abc_settings:
+                print(abc_settings[0])
             tune.status = _select_from_enum_values("Status", db.Status, tune.status, return_as_value=True)
             tune.comments = questionary.text("Comment", default=_str_default(tune.comments)).ask()
         else:
@@ -91,6 +106,8 @@ def _edit_and_save_tune_interactively(tune: db.Tune):
     should_save = questionary.confirm(f"Save tune: {tune}").ask()
     if should_save:
         tune.save()
+        if abc_settings:
+            db.save_tune_settings(tune, abc_settings)
         print(f"Saved tune {tune}")
         should_add_rec = questionary.confirm(f"Add recording associated with this tune?").ask()
         if should_add_rec:
@@ -200,6 +217,39 @@ def tune_edit(args):
 
     return 0
 
+def tune_info(args):
+    """
+    Show a tune with its recordings and the sets it's in.
+    """
+    db.open_db()
+
+    if args.name:
+        tune = db.Tune.get_or_none(db.Tune.name == args.name)
+    else:
+        tune = db.select_tune("Select a tune to show info of")
+    details = db.tune_details(tune.id) if tune else None
+    if not details:
+        print(f"No tune named {args.name}" if args.name else "No tune selected")
+        db.close_db()
+        return 1
+
+    print(details.tune)
+    if details.tune.ts_id:
+        print(f"TheSession: https://thesession.org/tunes/{details.tune.ts_id}")
+    print(f"{details.setting_count} abc settings")
+
+    print(f"Recordings ({len(details.recordings)}):")
+    for recording_row in details.recordings:
+        print(f"  {recording_row}")
+
+    print(f"Sets ({len(details.sets)}):")
+    for s, tune_rows in details.sets:
+        out = f"{s.name}: " if s.name else ""
+        print("  " + out + " / ".join(t.name for t in tune_rows))
+
+    db.close_db()
+    return 0
+
 def tune_list(args):
     db.open_db()
     sel = db.Tune.select()
@@ -212,6 +262,14 @@ def tune_list(args):
         sel = sel.where(db.Tune.type == args.type)
     if args.status:
         sel = sel.where(db.Tune.status == args.status)
+    if args.key or args.rhythm:
+        # Match tunes with any setting in the key or rhythm, using the setting indexes
+        settings = db.TuneSetting.select(db.TuneSetting.tune)
+        if args.key:
+            settings = settings.where(db.TuneSetting.key == abcnotation.normalize_key(args.key))
+        if args.rhythm:
+            settings = settings.where(db.TuneSetting.rhythm == args.rhythm.lower())
+        sel = sel.where(db.Tune.id.in_(settings))
 
     for tune in sel:
         print(tune)
@@ -220,24 +278,60 @@ def tune_abc(args):
     db.open_db()
     tune= db.select_tune("Choose a tune to get the abc of.")
 
-    if not tune.abc:
-        _add_first_abc_setting_to_tune(tune)
+    abc_string = tune.first_abc()
+    if not abc_string:
+        abc_string = _add_first_abc_setting_to_tune(tune)
     else:
         print("Using stored abc setting")
 
     filename = tune.name.replace(" ", "-")
 
-    _convert_abc_to_svg(tune.abc, filename)
+    _convert_abc_to_svg(abc_string, filename)
 
     db.close_db()
 
+def _tune_spot_prefetch(args) -> int:
+    """
+    Find the Spotify candidates of every tune of a status ahead of time.
+    """
+    status = db.Status[args.status]
+    tunes = list(spotcandidates.tunes_to_prefetch(status, refresh=args.refresh))
+    if args.queue:
+        for tune in tunes:
+            jobs.enqueue("spot-candidates", {"tune_id": tune.id, "name": tune.name, "ts_id": tune.ts_id},
+                         key=f"spot-candidates:{tune.id}")
+        print(f"Queued {len(tunes)} tunes. Run them with gtn jobs run.")
+        return 0
+
+    print(f"Finding Spotify tracks of {len(tunes)} {status.name} tunes with {args.workers} workers...")
+
+    summary = spotcandidates.prefetch_tunes(tunes, workers=args.workers)
+    print(summary)
+    if summary.interrupted:
+        print("Progress saved. Run again to resume.")
+
+    return 0
+
 def tune_spot(args):
+    """
+    Find recordings of a tune on TheSession and pick their Spotify tracks to save.
+
+    The selector opens on the tune's candidates if they were prefetched, and only
+    looks for new recordings with --refresh. With --prefetch, candidates are found
+    for every tune of --status instead.
+    """
     db.open_db()
 
+    if args.prefetch:
+        ret = _tune_spot_prefetch(args)
+        db.close_db()
+        return ret
+
     tune_name = None
     tune: db.Tune | None = None
     if args.name:
         tune_name = args.name
+        tune = db.Tune.get_or_none(db.Tune.name == tune_name)
     else:
         tune = db.select_tune(message="Select tune to find on Spotify")
         if not tune:
@@ -247,7 +341,16 @@ def tune_spot(args):
 
     
     if tune_name:
-        output = spot_select.select_spotify_track(tune_name) # Launch the interface to play and integrate spotify tracks
+        candidates, known_recordings = spotcandidates.load_candidates(tune.id) if tune else ([], set())
+        found = []
+        # Launch the interface to play and integrate spotify tracks
+        output = spot_select.select_spotify_track(tune_name, candidates=candidates or None,
+                                                  known_recordings=known_recordings,
+                                                  refresh=args.refresh, found=found)
+        if tune and found:
+            rows = [spotcandidates.candidate_row(tune.id, position, scrape_data, track)
+                    for position, (scrape_data, track) in enumerate(found, len(known_recordings))]
+            spotcandidates.save_candidates(tune.id, rows, replace=False)
 
         sp = audio.connect_to_spotify()
         for i in range(len(output)):
@@ -280,12 +383,124 @@ def tune_spot(args):
 
     db.close_db()
 
-# Scrapes the session for abc, and adds it to the tune with the specified name.
-def _add_first_abc_setting_to_tune(tune):
+def tune_enrich(args):
+    """
+    Fill in the TheSession id, key and abc of tunes from TheSession.org.
+
+    With --all, every tune missing any of these is looked up concurrently. Progress
+    is checkpointed so an interrupted run can be resumed by running it again. With
+    --queue, they're queued as jobs for gtn jobs run instead.
+    """
+    db.open_db()
+
+    if args.all:
+        tunes = list(enrich.pending_tunes(retry=args.retry))
+        if args.queue:
+            for tune in tunes:
+                jobs.enqueue("enrich", {"tune_id": tune.id, "name": tune.name, "ts_id": tune.ts_id,
+                                        "min_confidence": args.min_confidence},
+                             key=f"enrich:{tune.id}")
+            print(f"Queued {len(tunes)} tunes. Run them with gtn jobs run.")
+            db.close_db()
+            return 0
+        print(f"Enriching {len(tunes)} tunes from TheSession.org with {args.workers} workers...")
+    else:
+        tune = db.select_tune("Select tune to enrich")
+        if not tune:
+            print("No tune selected.")
+            db.close_db()
+            return 1
+        tunes = [tune]
+
+    summary = enrich.enrich_tunes(tunes, workers=args.workers, batch_size=args.batch_size,
+                                  min_confidence=args.min_confidence)
+    print(summary)
+    if summary.interrupted:
+        print("Progress saved. Run again to resume.")
+
+    db.close_db()
+
+    return 0
+
+def tune_identify(args):
+    """
+    Name a tune from a few bars of its abc, using the settings in the tune database
+    and any imported TheSession data.
+    """
+    db.open_db()
+
+    index = None
+    try:
+        index = incipit.open_index(rebuild=args.rebuild)
+        matches = incipit.identify(args.abc, key=args.key, limit=args.n, index=index)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
+    finally:
+        if index is not None:
+            index.close()
+        db.close_db()
+
+    if not matches:
+        print("No matching tunes found.")
+        return 1
+
+    for i, match in enumerate(matches, 1):
+        print(f"{i}. {match}")
+
+    return 0
+
+def tune_similar(args):
+    """
+    Find tunes that sound like a tune, from the tune database and any imported
+    TheSession data.
+    """
+    db.open_db()
+
+    tune = None
+    session_settings = []
+    if args.name:
+        tune = db.Tune.select().where(db.Tune.name == args.name).get_or_none()
+        if not tune:
+            session_settings = list(db.SessionSetting.select()
+                                    .where(peewee.fn.LOWER(db.SessionSetting.name) == args.name.lower()))
+    else:
+        tune = db.select_tune("Find tunes similar to")
+
+    if tune:
+        if not tune.settings.exists():
+            _add_first_abc_setting_to_tune(tune)
+        settings = [(s.abc, s.key) for s in tune.settings]
+        tune_id, ts_id = tune.id, tune.ts_id
+    elif session_settings:
+        settings = [(s.abc, s.key) for s in session_settings]
+        tune_id, ts_id = None, session_settings[0].ts_id
+    else:
+        print("Tune not found.")
+        db.close_db()
+        return 1
+
+    index = similarity.update_index()
+    matches = similarity.similar_tunes(settings, limit=args.n, index=index,
+                                       exclude_tune_id=tune_id, exclude_ts_id=ts_id)
+    db.close_db()
+
+    for i, match in enumerate(matches, 1):
+        print(f"{i}. {match}")
+
+    return 0
+
+# Scrapes the session for abc, saves every setting to the tune, and returns the first.
+def _add_first_abc_setting_to_tune(tune) -> str:
     print(f"Searching the session for abc for {tune.name}...")
-    abc_settings = scrape.get_abc_by_name(tune.name)
+    if tune.ts_id:
+        abc_settings = scrape.get_abc(tune.ts_id)
+    else:
+        abc_settings = scrape.get_abc_by_name(tune.name)
+
+    db.save_tune_settings(tune, abc_settings)
 
-    tune.abc = abc_settings[0]
+    return abc_settings[0]
 
 def _convert_abc_to_svg(abc_string, output_file_name):
     tmp_name = "tmp.abc"
@@ -293,7 +508,9 @@ def _convert_abc_to_svg(abc_string, output_file_name):
         tmpfile.write(abc_string)
 
     # -g means svg, one tune per file
-    subprocess.run(["abcm2ps", "-g", tmp_name, "-O", output_file_name])
+    with profiling.span("subprocess abcm2ps", output=output_file_name) as s:
+        subprocess.run(["abcm2ps", "-g", tmp_name, "-O", output_file_name])
+        s.add_bytes(len(abc_string))
 
 def _ac_request(action, **params):
     return {'action': action, 'params': params, 'version': 6}
@@ -332,8 +549,9 @@ def tune_flash(args):
         db.close_db()
         return 1
 
-    if not tune.abc:
-        _add_first_abc_setting_to_tune(tune)
+    abc_string = tune.first_abc()
+    if not abc_string:
+        abc_string = _add_first_abc_setting_to_tune(tune)
     else:
         print("Using stored abc for tune.")
 
@@ -341,7 +559,7 @@ def tune_flash(args):
     
     # Remove the name for the abc so that the flashcard doesn't give away the tune name.
     # TODO: remove the tmp file
-    _convert_abc_to_svg(_remove_title_from_abc(tune.abc), tune_name_for_file)
+    _convert_abc_to_svg(_remove_title_from_abc(abc_string), tune_name_for_file)
 
     file_name = tune_name_for_file + "001.svg" # For some reason abcm2svg appends "001" to the filename
     file_path = os.path.abspath(file_name)
@@ -410,12 +628,210 @@ def export(args):
     else:
         print("Error: no export option specified")
 
+# ================
+# Practice command
+# ================
+
+def practice(args):
+    """
+    Practice the tunes that are due, grading how each one went to schedule when
+    it comes up next.
+    """
+    db.open_db()
+
+    enrolled = practice_.enroll_tunes(db.Status[args.status])
+    if enrolled:
+        print(f"Started practicing {enrolled} new tunes.")
+
+    if args.recompute:
+        print(f"Recomputed the schedules of {practice_.recompute_schedules()} tunes from the review log.")
+
+    reviews = practice_.due_reviews(args.n)
+    if not reviews:
+        next_review = db.Review.select().order_by(db.Review.due).first()
+        print("Nothing to practice right now.")
+        if next_review:
+            print(f"Next up is {next_review.tune.name} on {next_review.due:%Y-%m-%d}.")
+        db.close_db()
+        return 0
+
+    grade_choices = [g.name.capitalize() for g in db.Grade]
+    session = practice_.PracticeSession()
+    try:
+        for i, review in enumerate(reviews, 1):
+            print(f"{i}/{len(reviews)}: {review.tune}")
+            choice = questionary.select("How did it go?", choices=grade_choices + ["Skip", "Quit"]).ask()
+            if choice is None or choice == "Quit":
+                break
+            if choice == "Skip":
+                continue
+
+            review = session.grade(review, db.Grade[choice.upper()])
+            print(f"Next practice in {review.interval_days:.0f} days.")
+    finally:
+        print(f"Saved {session.flush()} reviews.")
+        db.close_db()
+
+    return 0
+
+# ==============
+# Corpus command
+# ==============
+
+def corpus_import(args):
+    """
+    Import TheSession's tune data dump (tunes.json or tunes.csv from
+    https://github.com/adactio/TheSession-data) for identifying and comparing tunes.
+    """
+    print(f"Importing TheSession settings from {args.infile}")
+    with open(args.infile, newline="") as infile:
+        if args.infile.endswith(".csv"):
+            rows = csv.DictReader(infile)
+        else:
+            rows = json.load(infile)
+
+        db.open_db()
+        count = db.import_session_settings(rows)
+        db.close_db()
+
+    print(f"Imported {count} settings")
+
+    return 0
+
+# ============
+# Job commands
+# ============
+
+def jobs_run(args):
+    """
+    Run queued jobs until none are left. Jobs left running by a runner that died
+    are picked up once their lease runs out.
+    """
+    db.open_db()
+
+    workers = args.workers or os.cpu_count()
+    print(f"Running jobs with {workers} workers...")
+    summary = jobs.run_jobs(workers=workers, kinds=args.kind)
+    print(summary)
+    if summary.interrupted:
+        print("Unfinished jobs were put back in the queue. Run again to resume.")
+
+    db.close_db()
+    return 1 if summary.failed else 0
+
+def jobs_ls(args):
+    db.open_db()
+
+    status = db.JobStatus(args.status) if args.status else None
+    for job in jobs.list_jobs(status, args.kind).limit(args.n):
+        out = f"{job.id} {job.kind} {job.status}"
+        if job.status == db.JobStatus.RUNNING.value:
+            out += f" {job.progress:.0%}"
+        if job.attempts > 1:
+            out += f" (attempt {job.attempts} of {job.max_attempts})"
+        out += f" {job.args}"
+        if job.message and job.status == db.JobStatus.RUNNING.value:
+            out += f": {job.message}"
+        if job.error and job.status != db.JobStatus.DONE.value:
+            out += f"\n    {job.error}"
+        print(out)
+
+    db.close_db()
+    return 0
+
+def jobs_cancel(args):
+    if not args.ids and not args.all:
+        print("Give the ids of the jobs to cancel, or --all.")
+        return 1
+
+    db.open_db()
+    count = jobs.cancel(None if args.all else args.ids)
+    print(f"Cancelled {count} jobs")
+    db.close_db()
+
+    return 0
+
 # ===========
 # Set command
 # ===========
 
 def set_add(args):
-    pass
+    """
+    Build a set by picking tunes from the tune database, in order.
+    """
+    db.open_db()
+
+    tunes = []
+    while True:
+        tune = db.select_tune(f"Tune {len(tunes) + 1} (leave empty to finish):")
+        if tune is None:
+            break
+        if tune in tunes:
+            print(f"{tune.name} is already in the set.")
+            continue
+        tunes.append(tune)
+
+    if tunes:
+        name = questionary.text("Name of the set (optional):").ask() or None
+        new_set = db.save_set(tunes, name)
+        print(f"Added set {new_set}")
+
+    db.close_db()
+    return 0
+
+def set_ls(args):
+    db.open_db()
+    for s, tune_rows in db.sets_with_tunes():
+        out = f"{s.name}: " if s.name else ""
+        print(out + " / ".join(t.name for t in tune_rows))
+    db.close_db()
+
+    return 0
+
+def set_suggest(args):
+    """
+    Suggest sets of tunes of the same type that start with a tune.
+    """
+    db.open_db()
+
+    if args.start:
+        start = db.Tune.select().where(db.Tune.name == args.start).get_or_none()
+        if start is None:
+            print(f"No tune named {args.start}")
+            db.close_db()
+            return 1
+    else:
+        start = db.select_tune("First tune of the set:")
+        if start is None:
+            db.close_db()
+            return 1
+
+    graph = sets.load_graph(db.Status[args.status])
+    suggestions = graph.suggest(start.id, args.length, count=args.n)
+    if not suggestions:
+        print(f"No sets found for {start.name}. It needs a type and a status of at least {args.status} "
+              "and there must be other tunes like that of the same type.")
+        db.close_db()
+        return 0
+
+    names = dict(db.Tune
+                 .select(db.Tune.id, db.Tune.name)
+                 .where(db.Tune.id.in_({i for _, path in suggestions for i in path}))
+                 .tuples())
+    choices = []
+    for score, path in suggestions:
+        choices.append(f"{' / '.join(names[i] for i in path)} ({score:.2f})")
+        print(choices[-1])
+
+    choice = questionary.select("Save one of these sets?", choices=choices + ["No"]).ask()
+    if choice and choice != "No":
+        path = suggestions[choices.index(choice)][1]
+        tunes = {t.id: t for t in db.Tune.select().where(db.Tune.id.in_(path))}
+        new_set = db.save_set([tunes[i] for i in path])
+        print(f"Saved set {new_set}")
+
+    db.close_db()
+    return 0
 
 # =============
 # Rec command
@@ -438,12 +854,14 @@ def _rec_add(url: str, prompt_to_add_tune: bool = False) -> db.Recording:
         name = track_data["name"]
         print(f"Found Spotify track {name} off album {album} by {artist}.")
 
-        existing_rec = db.Recording.select().where(db.Recording.url == url).get_or_none()
+        track_id = db.spotify_track_id(url)
+        existing_rec = db.Recording.select().where(db.Recording.track_id == track_id).get_or_none()
         if existing_rec:
             print("Already have this recording in the database:")
             print(existing_rec)
         else:
-            this_rec = db.Recording(name=name, url=url, source=db.RecordingSource.SPOTIFY, album=album, artist=artist)
+            this_rec = db.Recording(name=name, url=url, source=db.RecordingSource.SPOTIFY, album=album, artist=artist,
+                                    track_id=track_id)
 
     # https://www.youtube.com/watch?v=zHqC__xzSkI
     elif re.match(r"^https://www.youtube.com.*", url):
@@ -483,6 +901,37 @@ def _rec_add(url: str, prompt_to_add_tune: bool = False) -> db.Recording:
 
     return this_rec
 
+def _rec_add_many(args) -> int:
+    """
+    Save every track of a Spotify playlist, album or file of track URLs as a
+    recording, without prompting.
+    """
+    start = time.monotonic()
+    sp = audio.connect_to_spotify()
+
+    if args.playlist:
+        track_ids = audio.spot_playlist_track_ids(args.playlist, sp)
+    elif args.album:
+        track_ids = audio.spot_album_track_ids(args.album, sp)
+    else:
+        with open(args.from_file) as url_file:
+            urls = [line.strip() for line in url_file if line.strip() and not line.startswith("#")]
+        track_ids = [db.spotify_track_id(url) for url in urls]
+        for url, track_id in zip(urls, track_ids):
+            if not track_id:
+                print(f"Skipping {url}, not a Spotify track")
+        track_ids = [track_id for track_id in track_ids if track_id]
+
+    # Looked up once each, in the order found
+    track_ids = list(dict.fromkeys(track_ids))
+    tracks = audio.spot_tracks(track_ids, sp)
+    added, already_saved = db.save_spotify_recordings(tracks)
+
+    print(f"Added {len(added)} recordings, {already_saved} already saved, "
+          f"{len(track_ids) - len(tracks)} not found, in {time.monotonic() - start:.1f}s")
+
+    return 0
+
 def rec_add(args):
     """
     Add a recording to the tune database.
@@ -491,9 +940,21 @@ def rec_add(args):
 
     Args:
         args.url: Either a filepath, a Spotify URL, or a Youtube URL
+        args.playlist, args.album, args.from_file: add every track of a
+            Spotify playlist or album, or every Spotify track URL in a file, instead
     """
     db.open_db()
 
+    if args.playlist or args.album or args.from_file:
+        ret = _rec_add_many(args)
+        db.close_db()
+        return ret
+
+    if not args.url:
+        print("Must give a url, --playlist, --album or --from-file")
+        db.close_db()
+        return 1
+
     rec = _rec_add(args.url)
 
     db.close_db()
@@ -515,12 +976,18 @@ def rec_ls(args):
 def rec_info(args):
     db.open_db()
     recording = db.select_recording("Select a recording to show info of")
+    if not recording:
+        print("No recording selected")
+        db.close_db()
+        return 1
 
+    print(recording)
     print("Tunes:")
-    for rectune in db.RecordingTune.select().where(db.Recording == recording):
-        print(rectune.tune)
+    for tune_row in db.recording_tunes(recording.id):
+        print(f"  {tune_row}")
 
     db.close_db()
+    return 0
 
 def rec_edit(args):
     db.open_db()
@@ -545,8 +1012,44 @@ def rec_link(args):
     _add_recording_to_tune_interactively(None, None)
     db.close_db()
 
+PROFILE_PATH = "gtn.pstats"
+
+glog = util.get_logger()
+
+def _run(args):
+    """
+    Run a command, reporting on its queries when debug logging.
+    """
+    if not glog.isEnabledFor(logging.DEBUG):
+        return args.func(args)
+
+    with querylog.capture() as log:
+        try:
+            return args.func(args)
+        finally:
+            glog.debug("%s: %s", args.func.__name__, log.report())
+
+def _run_profiled(args):
+    """
+    Run a command under cProfile, writing its stats to PROFILE_PATH, and print
+    the tree of spans it went through at exit.
+    """
+    profiling.enable(trace_path=args.trace)
+    profiler = cProfile.Profile()
+    try:
+        with profiling.span(f"gtn {args.func.__name__.strip('_').replace('_', ' ')}"):
+            return profiler.runcall(_run, args)
+    finally:
+        profiler.dump_stats(PROFILE_PATH)
+        print(f"Wrote {PROFILE_PATH}, view it with python -m pstats {PROFILE_PATH}", file=sys.stderr)
+        if args.trace:
+            print(f"Writing Chrome trace to {args.trace}", file=sys.stderr)
+
 def main():
     parser = argparse.ArgumentParser(description="Add and manipulate traditional tunes.")
+    parser.add_argument("--profile", action="store_true",
+                        help=f"Profile the command into {PROFILE_PATH} and show where the time went")
+    parser.add_argument("--trace", metavar="PATH", help="Profile the command and write a Chrome trace to PATH")
 
     subparsers = parser.add_subparsers(dest="command", help="Subcommands")
 
@@ -572,15 +1075,31 @@ def main():
     parser_tune_edit.add_argument("--new-name", help="Name to set the tune to.")
     parser_tune_edit.set_defaults(func=tune_edit)
 
+    parser_tune_info = subparser_tune.add_parser("info", help="Show a tune with its recordings and sets")
+    parser_tune_info.set_defaults(func=tune_info)
+    parser_tune_info.add_argument("name", nargs="?", help="Name of the tune. Search interactively if not given.")
+
     parser_tune_list = subparser_tune.add_parser("ls", help="List tunes")
     parser_tune_list.set_defaults(func=tune_list)
     parser_tune_list.add_argument("-n", dest="name", help="Name of tune")
     parser_tune_list.add_argument("-t", dest="type", help="Type of tune (jig, reel, etc.)")
     parser_tune_list.add_argument("-s", dest="status", help="Status of tune. How well the tune is known, int from 1-5.")
+    parser_tune_list.add_argument("-k", dest="key", help="Key of any abc setting of the tune, e.g. Dmix or \"D mixolydian\"")
+    parser_tune_list.add_argument("-r", dest="rhythm", help="Rhythm of any abc setting of the tune (reel, jig, etc.)")
 
     parser_spot = subparser_tune.add_parser("spot", help="Scrape albums of thesession.org by name and search for them on spotify.")
     parser_spot.set_defaults(func=tune_spot)
     parser_spot.add_argument("--name", help="Name of the tune.", required=False)
+    parser_spot.add_argument("--prefetch", action="store_true",
+                             help="Find the Spotify tracks of every tune of --status now, for opening later")
+    parser_spot.add_argument("--status", default=db.Status.TODO.name, choices=[s.name for s in db.Status],
+                             help="Tunes to prefetch")
+    parser_spot.add_argument("--workers", type=int, default=spotcandidates.DEFAULT_WORKERS,
+                             help="Tunes to prefetch at once")
+    parser_spot.add_argument("--queue", action="store_true",
+                             help="With --prefetch, queue the tunes as jobs for gtn jobs run instead")
+    parser_spot.add_argument("--refresh", action="store_true",
+                             help="Look for recordings again, even for tunes already prefetched")
 
     parser_flash = subparser_tune.add_parser("flash", help="Make tune flashcards")
     parser_flash.set_defaults(func=tune_flash)
@@ -590,12 +1109,38 @@ def main():
     parser_abc.add_argument("-f", action="store_true", help="Use the first abc without confirming")
 
 
+    parser_enrich = subparser_tune.add_parser("enrich", help="Fill in tune data from TheSession.org")
+    parser_enrich.set_defaults(func=tune_enrich)
+    parser_enrich.add_argument("--all", action="store_true", help="Enrich every tune missing its TheSession id, key or abc")
+    parser_enrich.add_argument("--retry", action="store_true", help="Also retry tunes that weren't found or had uncertain matches")
+    parser_enrich.add_argument("--queue", action="store_true", help="With --all, queue the tunes as jobs for gtn jobs run instead")
+    parser_enrich.add_argument("--workers", type=int, default=enrich.DEFAULT_WORKERS, help="Number of concurrent lookups")
+    parser_enrich.add_argument("--batch-size", type=int, default=enrich.DEFAULT_BATCH_SIZE, help="Number of tunes saved per transaction")
+    parser_enrich.add_argument("--min-confidence", type=float, default=enrich.DEFAULT_MIN_CONFIDENCE,
+                               help="Lowest name similarity (0-1) at which a TheSession match is trusted")
+
+    parser_identify = subparser_tune.add_parser("identify", help="Identify a tune from a few bars of abc")
+    parser_identify.set_defaults(func=tune_identify)
+    parser_identify.add_argument("abc", help="The start of the tune in abc, e.g. \"|:ABcd efge|\"")
+    parser_identify.add_argument("-k", dest="key", help="Key of the abc if it has no K: field. Tries common keys otherwise.")
+    parser_identify.add_argument("-n", type=int, default=10, help="Number of candidates to show")
+    parser_identify.add_argument("--rebuild", action="store_true", help="Rebuild the index first")
+
+    parser_similar = subparser_tune.add_parser("similar", help="Find tunes that sound like a tune")
+    parser_similar.set_defaults(func=tune_similar)
+    parser_similar.add_argument("name", nargs="?", help="Name of the tune, in the tune database or imported TheSession data")
+    parser_similar.add_argument("-n", type=int, default=10, help="Number of tunes to show")
+
     # Rec subparser
     parser_rec = subparsers.add_parser("rec", help="Manage recordings")
     rec_subparser = parser_rec.add_subparsers(required=True)
 
     parser_rec_add = rec_subparser.add_parser("add", help="Add new recording")
-    parser_rec_add.add_argument("url", help="File, Spotify, or YouTube url of the recording")
+    parser_rec_add.add_argument("url", nargs="?", help="File, Spotify, or YouTube url of the recording")
+    rec_add_many = parser_rec_add.add_mutually_exclusive_group()
+    rec_add_many.add_argument("--playlist", help="Add every track of a Spotify playlist (id, URI or URL)")
+    rec_add_many.add_argument("--album", help="Add every track of a Spotify album (id, URI or URL)")
+    rec_add_many.add_argument("--from-file", help="Add every Spotify track URL in a file, one per line")
     parser_rec_add.set_defaults(func=rec_add)
 
     parser_rec_ls = rec_subparser.add_parser("ls", help="List recordings")
@@ -616,6 +1161,52 @@ def main():
     parser_set_add = subparser_set.add_parser("add", help="Add a set of tunes. composed of tunes in your tune database")
     parser_set_add.set_defaults(func=set_add)
 
+    parser_set_ls = subparser_set.add_parser("ls", help="List sets")
+    parser_set_ls.set_defaults(func=set_ls)
+
+    parser_set_suggest = subparser_set.add_parser("suggest", help="Suggest sets that start with a tune")
+    parser_set_suggest.set_defaults(func=set_suggest)
+    parser_set_suggest.add_argument("--start", help="Name of the first tune")
+    parser_set_suggest.add_argument("--length", type=int, default=3, help="Number of tunes in the set")
+    parser_set_suggest.add_argument("-n", type=int, default=5, help="Number of sets to suggest")
+    parser_set_suggest.add_argument("--status", default=db.Status.CAN_PLAY.name, choices=[s.name for s in db.Status],
+                                    help="Only use tunes known at least this well")
+
+    # Practice subparser
+    parser_practice = subparsers.add_parser("practice", help="Practice the tunes that are due")
+    parser_practice.set_defaults(func=practice)
+    parser_practice.add_argument("-n", type=int, default=10, help="Number of tunes to practice")
+    parser_practice.add_argument("--status", default=db.Status.CAN_PLAY.name, choices=[s.name for s in db.Status],
+                                 help="Practice tunes known at least this well")
+    parser_practice.add_argument("--recompute", action="store_true", help="Recompute every schedule from the review log first")
+
+    # Corpus subparser
+    parser_corpus = subparsers.add_parser("corpus", help="Manage local TheSession tune data")
+    subparser_corpus = parser_corpus.add_subparsers(required=True)
+    parser_corpus_import = subparser_corpus.add_parser("import", help="Import tunes.json or tunes.csv from TheSession's data dump")
+    parser_corpus_import.set_defaults(func=corpus_import)
+    parser_corpus_import.add_argument("infile", help="Path to the tunes.json or tunes.csv file")
+
+    # Jobs subparser
+    parser_jobs = subparsers.add_parser("jobs", help="Run and manage queued background jobs")
+    subparser_jobs = parser_jobs.add_subparsers(required=True)
+
+    parser_jobs_run = subparser_jobs.add_parser("run", help="Run queued jobs until none are left")
+    parser_jobs_run.set_defaults(func=jobs_run)
+    parser_jobs_run.add_argument("--workers", type=int, help="Number of worker processes, one per core by default")
+    parser_jobs_run.add_argument("--kind", action="append", choices=list(jobs.KINDS), help="Only run jobs of this kind")
+
+    parser_jobs_ls = subparser_jobs.add_parser("ls", help="List jobs, newest first")
+    parser_jobs_ls.set_defaults(func=jobs_ls)
+    parser_jobs_ls.add_argument("--status", choices=[s.value for s in db.JobStatus], help="Only jobs of this status")
+    parser_jobs_ls.add_argument("--kind", choices=list(jobs.KINDS), help="Only jobs of this kind")
+    parser_jobs_ls.add_argument("-n", type=int, default=50, help="Number of jobs to show")
+
+    parser_jobs_cancel = subparser_jobs.add_parser("cancel", help="Cancel queued and running jobs")
+    parser_jobs_cancel.set_defaults(func=jobs_cancel)
+    parser_jobs_cancel.add_argument("ids", nargs="*", type=int, help="Ids of the jobs")
+    parser_jobs_cancel.add_argument("--all", action="store_true", help="Cancel every queued and running job")
+
     # Parse subparser
     parser_parse = subparsers.add_parser("parse", parents=[parent_parser_add_edit], help="Add list")
     parser_parse.set_defaults(func=parse_)
@@ -628,8 +1219,10 @@ def main():
     parser_export.add_argument("-c", help="Export to csv", action="store_true")
 
     args = parser.parse_args()
-    if args.command:
-        args.func(args)
+    if args.command and (args.profile or args.trace):
+        _run_profiled(args)
+    elif args.command:
+        _run(args)
     else:
         parser.print_help()
 
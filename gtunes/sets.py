@@ -0,0 +1,280 @@
+# Set builder: suggest sets of tunes that go well together.
+#
+# Playable tunes form a compatibility graph. An edge from one tune to another
+# means the second can follow the first in a set: they are the same type, and the
+# edge is weighted by how good the change of key is, how well the second tune is
+# known and how many sets it's already in. Each tune keeps only its best
+# MAX_NEIGHBORS edges, as parallel arrays of target tune ids and weights.
+#
+# The graph is saved in the data dir and refreshed incrementally: only tunes whose
+# type, key, status or set count changed have their edges recomputed, and other
+# tunes only have their edges to those tunes updated. Suggestions are a beam
+# search over the graph from a starting tune.
+
+import os
+from dataclasses import dataclass
+
+import numpy as np
+from peewee import fn
+
+from gtunes import abcnotation
+from gtunes import db
+from gtunes import util
+
+glog = util.get_logger()
+
+MAX_NEIGHBORS = 64
+BEAM_WIDTH = 32
+
+MODES = ["maj", "min", "dor", "mix", "phr", "lyd", "loc"]
+
+# How good a change of key is, from one tune to the next
+UNKNOWN_KEY = 0.3
+SAME_KEY = 0.4
+SAME_TONIC = 0.6 # e.g. D major to D mixolydian
+SAME_SIGNATURE = 0.7 # e.g. G major to E minor
+UP_A_TONE = 0.9 # e.g. G major to A major
+FOURTH_OR_FIFTH = 1.0 # e.g. G major to D major
+OTHER_KEY = 0.5
+
+@dataclass(frozen=True)
+class Node:
+    """
+    Everything about a tune that its edges depend on.
+    """
+    tune_type: str
+    tonic: int # -1 if unknown
+    mode: int # Index into MODES, -1 if unknown
+    sharps: int # Only meaningful if the tonic is known
+    status: int
+    set_count: int
+
+def default_graph_path() -> str:
+    return os.path.join(util.get_data_dir(), "set_graph.npz")
+
+def _node(tune_type: str, key: str | None, status: int, set_count: int) -> Node:
+    key = abcnotation.normalize_key(key) if key else None
+    tonic = abcnotation.tonic_semitone(key)
+    sharps = abcnotation.key_sharps(key)
+    if tonic is None or sharps is None:
+        return Node(tune_type.upper(), -1, -1, 0, status, set_count)
+
+    return Node(tune_type.upper(), tonic, MODES.index(key[-3:]), sharps, status, set_count)
+
+def playable_nodes(min_status: db.Status = db.Status.CAN_PLAY) -> dict:
+    """
+    Returns:
+        Map of tune id to Node for every tune with a type that is known at least
+        as well as min_status.
+    """
+    set_counts = dict(db.SetTune
+                      .select(db.SetTune.tune, fn.COUNT(db.SetTune.id))
+                      .group_by(db.SetTune.tune)
+                      .tuples())
+
+    tunes = (db.Tune
+             .select(db.Tune.id, db.Tune.type, db.Tune.key, db.Tune.status)
+             .where((db.Tune.status >= min_status.value) & db.Tune.type.is_null(False) & (db.Tune.type != ""))
+             .tuples())
+
+    return {tune_id: _node(tune_type, key, status, set_counts.get(tune_id, 0))
+            for tune_id, tune_type, key, status in tunes}
+
+class _Group:
+    """
+    The nodes of one tune type as arrays, for computing many edge weights at once.
+    """
+    def __init__(self, nodes: dict, ids: list):
+        self.ids = np.array(ids, dtype=np.int64)
+        self.tonic = np.array([nodes[i].tonic for i in ids], dtype=np.int64)
+        self.mode = np.array([nodes[i].mode for i in ids], dtype=np.int64)
+        self.sharps = np.array([nodes[i].sharps for i in ids], dtype=np.int64)
+        self.status = np.array([nodes[i].status for i in ids], dtype=np.float64)
+        self.set_count = np.array([nodes[i].set_count for i in ids], dtype=np.float64)
+
+    def weights_from(self, tune_id: int, node: Node) -> np.ndarray:
+        """
+        Returns:
+            The weight of the edge from the node to each node of the group.
+        """
+        interval = (self.tonic - node.tonic) % 12
+        known = (self.tonic >= 0) & (node.tonic >= 0)
+        key_score = np.select(
+            [~known,
+             (interval == 0) & (self.mode == node.mode),
+             interval == 0,
+             (interval == 5) | (interval == 7),
+             interval == 2,
+             self.sharps == node.sharps],
+            [UNKNOWN_KEY, SAME_KEY, SAME_TONIC, FOURTH_OR_FIFTH, UP_A_TONE, SAME_SIGNATURE],
+            OTHER_KEY)
+
+        # Prefer tunes that are known well and aren't in many sets yet
+        weights = key_score * (0.5 + 0.1 * self.status) / (1 + 0.5 * self.set_count)
+        weights[self.ids == tune_id] = 0
+
+        return weights
+
+def _best(targets: np.ndarray, weights: np.ndarray) -> tuple:
+    keep = weights > 0
+    targets, weights = targets[keep], weights[keep]
+    if len(targets) > MAX_NEIGHBORS:
+        best = np.argpartition(-weights, MAX_NEIGHBORS - 1)[:MAX_NEIGHBORS]
+        targets, weights = targets[best], weights[best]
+
+    order = np.argsort(-weights, kind="stable")
+    return targets[order], weights[order].astype(np.float32)
+
+class SetGraph:
+    def __init__(self, nodes: dict = None, adjacency: dict = None):
+        self.nodes = nodes or {}
+        # Tune id to (target tune ids, weights), best first
+        self.adjacency = adjacency or {}
+
+    def refresh(self, nodes: dict) -> int:
+        """
+        Bring the graph up to date with the current playable tunes.
+
+        Returns:
+            Number of tunes whose edges were recomputed from scratch
+        """
+        removed = self.nodes.keys() - nodes.keys()
+        changed = {i for i, node in nodes.items() if self.nodes.get(i) != node}
+        if not removed and not changed:
+            return 0
+
+        previous = self.nodes
+        self.nodes = nodes
+        for tune_id in removed:
+            del self.adjacency[tune_id]
+
+        by_type = {}
+        for tune_id, node in nodes.items():
+            by_type.setdefault(node.tune_type, []).append(tune_id)
+        groups = {tune_type: _Group(nodes, ids) for tune_type, ids in by_type.items()}
+
+        for tune_id in changed:
+            group = groups[nodes[tune_id].tune_type]
+            self.adjacency[tune_id] = _best(group.ids, group.weights_from(tune_id, nodes[tune_id]))
+
+        # Everyone else only needs their edges to changed tunes redone
+        stale = removed | changed
+        changed_by_type = {}
+        for tune_id in changed:
+            changed_by_type.setdefault(nodes[tune_id].tune_type, []).append(tune_id)
+        changed_groups = {t: _Group(nodes, ids) for t, ids in changed_by_type.items()}
+
+        for tune_id, node in nodes.items():
+            if tune_id in changed:
+                continue
+            targets, weights = self.adjacency[tune_id]
+            keep = ~np.isin(targets, list(stale))
+            if len(targets) == MAX_NEIGHBORS and not keep.all():
+                # Edges that didn't make the cut before might now, so start over
+                group = groups[node.tune_type]
+                self.adjacency[tune_id] = _best(group.ids, group.weights_from(tune_id, node))
+                continue
+            targets, weights = targets[keep], weights[keep]
+
+            group = changed_groups.get(node.tune_type)
+            if group is not None:
+                targets = np.concatenate([targets, group.ids])
+                weights = np.concatenate([weights, group.weights_from(tune_id, node)])
+            self.adjacency[tune_id] = _best(targets, weights)
+
+        glog.debug("Set graph: recomputed %d tunes, removed %d, kept %d", len(changed), len(removed),
+                   len(previous.keys() & nodes.keys()) - len(changed))
+
+        return len(changed)
+
+    def suggest(self, start: int, length: int, count: int = 5, beam_width: int = BEAM_WIDTH) -> list:
+        """
+        Beam search for the best sets starting with a tune.
+
+        Args:
+            start: tune id of the first tune
+            length: number of tunes in the set
+            count: number of sets to return
+            beam_width: number of partial sets kept at each step
+
+        Returns:
+            List of (mean edge weight, [tune ids]), best first
+        """
+        if start not in self.adjacency:
+            return []
+
+        beams = [(0.0, [start])]
+        for _ in range(length - 1):
+            candidates = []
+            for score, path in beams:
+                targets, weights = self.adjacency[path[-1]]
+                added = 0
+                for target, weight in zip(targets.tolist(), weights.tolist()):
+                    if target in path:
+                        continue
+                    candidates.append((score + weight, path + [target]))
+                    # Neighbors are sorted, so the rest can't beat these
+                    added += 1
+                    if added == beam_width:
+                        break
+            if not candidates:
+                break
+            candidates.sort(key=lambda c: c[0], reverse=True)
+            beams = candidates[:beam_width]
+
+        return [(score / (len(path) - 1), path) for score, path in beams[:count] if len(path) > 1]
+
+    def save(self, path: str):
+        ids = list(self.nodes)
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        for i, tune_id in enumerate(ids):
+            offsets[i + 1] = offsets[i] + len(self.adjacency[tune_id][0])
+        empty = [np.zeros(0)]
+
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path,
+                 ids=np.array(ids, dtype=np.int64),
+                 tune_type=np.array([self.nodes[i].tune_type for i in ids], dtype=str),
+                 attributes=np.array([[n.tonic, n.mode, n.sharps, n.status, n.set_count]
+                                      for n in (self.nodes[i] for i in ids)], dtype=np.int64).reshape(-1, 5),
+                 offsets=offsets,
+                 targets=np.concatenate([self.adjacency[i][0] for i in ids] + empty).astype(np.int64),
+                 weights=np.concatenate([self.adjacency[i][1] for i in ids] + empty).astype(np.float32))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "SetGraph":
+        with np.load(path) as npz:
+            # Each access to an npz reads the array again, so read each one once
+            arrays = {name: npz[name] for name in npz.files}
+
+        offsets = arrays["offsets"].tolist()
+        nodes = {}
+        adjacency = {}
+        for i, (tune_id, tune_type, attributes) in enumerate(zip(arrays["ids"].tolist(),
+                                                                 arrays["tune_type"].tolist(),
+                                                                 arrays["attributes"].tolist())):
+            nodes[tune_id] = Node(tune_type, *attributes)
+            start, end = offsets[i], offsets[i + 1]
+            adjacency[tune_id] = (arrays["targets"][start:end], arrays["weights"][start:end])
+
+        return cls(nodes, adjacency)
+
+def load_graph(min_status: db.Status = db.Status.CAN_PLAY, path: str = None) -> SetGraph:
+    """
+    Load the saved graph and refresh it for any tunes that have changed, saving
+    it again if they have. Should be called with the database open.
+    """
+    path = path or default_graph_path()
+
+    graph = SetGraph()
+    if os.path.exists(path):
+        try:
+            graph = SetGraph.load(path)
+        except (OSError, KeyError, ValueError) as e:
+            glog.debug("Rebuilding set graph: %s", e)
+
+    if graph.refresh(playable_nodes(min_status)) or not os.path.exists(path):
+        graph.save(path)
+
+    return graph
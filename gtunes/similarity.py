@@ -0,0 +1,230 @@
+# Melodic similarity between tunes: "tunes like this one".
+#
+# Each stored setting is encoded as a fixed length feature vector: a histogram of
+# the intervals between its notes, a histogram of its melodic contour as trigrams
+# of (leap down, step down, step up, leap up), its pitch classes relative to the
+# tonic and its mode. The vectors of every setting are kept in one contiguous
+# float32 matrix that is memory-mapped, and a query is one matrix-vector product
+# giving the cosine similarity of every setting at once.
+#
+# Updates are incremental: a checksum of each setting is stored next to its
+# vector and only settings that are new or have changed are re-encoded. The
+# stored settings aren't scanned at all unless db.settings_state has changed,
+# which every write to them does through SettingsVersion.
+
+import os
+import zlib
+
+import numpy as np
+
+from gtunes import abcnotation
+from gtunes import db
+from gtunes import util
+
+glog = util.get_logger()
+
+MAX_INTERVAL = 12
+INTERVAL_FEATURES = 2 * MAX_INTERVAL + 1
+CONTOUR_LEVELS = 4
+CONTOUR_FEATURES = CONTOUR_LEVELS ** 3
+PITCH_CLASS_FEATURES = 12
+MODES = ["maj", "min", "dor", "mix", "phr", "lyd", "loc"]
+
+# How much each block of features counts towards the similarity
+WEIGHTS = {
+    "intervals": 1.0,
+    "contour": 1.0,
+    "pitch_classes": 1.0,
+    "mode": 0.5,
+}
+
+DIMENSIONS = INTERVAL_FEATURES + CONTOUR_FEATURES + PITCH_CLASS_FEATURES + len(MODES)
+
+def default_vectors_dir() -> str:
+    return os.path.join(util.get_data_dir(), "similarity")
+
+def _normalized(block: np.ndarray, weight: float) -> np.ndarray:
+    norm = np.linalg.norm(block)
+    return block * (weight / norm) if norm else block
+
+def encode(abc_string: str, key: str | None = None) -> np.ndarray:
+    """
+    Encode a setting as a unit length feature vector.
+
+    Args:
+        abc_string: the setting
+        key: its key, if the abc has no K: field
+
+    Returns:
+        float32 vector of DIMENSIONS features
+    """
+    key = abcnotation.parse_headers(abc_string)["key"] or (abcnotation.normalize_key(key) if key else None)
+    pitch_list = np.array(abcnotation.pitches(abc_string, key=key), dtype=np.int32)
+    steps = np.array(abcnotation.intervals(pitch_list.tolist()), dtype=np.int32)
+
+    intervals = np.bincount(np.clip(steps, -MAX_INTERVAL, MAX_INTERVAL) + MAX_INTERVAL,
+                            minlength=INTERVAL_FEATURES).astype(np.float32)
+
+    contour = np.zeros(CONTOUR_FEATURES, dtype=np.float32)
+    if len(steps) >= 3:
+        # Leap down, step down, step up, leap up. Repeated notes are already collapsed.
+        levels = np.digitize(steps, [-2, 0, 3])
+        trigrams = levels[:-2] * CONTOUR_LEVELS ** 2 + levels[1:-1] * CONTOUR_LEVELS + levels[2:]
+        contour = np.bincount(trigrams, minlength=CONTOUR_FEATURES).astype(np.float32)
+
+    pitch_classes = np.zeros(PITCH_CLASS_FEATURES, dtype=np.float32)
+    mode = np.zeros(len(MODES), dtype=np.float32)
+    tonic = abcnotation.tonic_semitone(key)
+    if len(pitch_list):
+        pitch_classes = np.bincount((pitch_list - (tonic or 0)) % 12,
+                                    minlength=PITCH_CLASS_FEATURES).astype(np.float32)
+    if key and key[-3:] in MODES:
+        mode[MODES.index(key[-3:])] = 1
+
+    vector = np.concatenate([
+        _normalized(intervals, WEIGHTS["intervals"]),
+        _normalized(contour, WEIGHTS["contour"]),
+        _normalized(pitch_classes, WEIGHTS["pitch_classes"]),
+        _normalized(mode, WEIGHTS["mode"]),
+    ])
+
+    return _normalized(vector, 1.0)
+
+def _checksum(abc_string: str, key: str | None) -> int:
+    return zlib.crc32(f"{key}\n{abc_string}".encode("utf-8"))
+
+class SimilarityIndex:
+    """
+    The memory-mapped matrix of setting vectors along with which setting each row is.
+    """
+    FILES = ("vectors", "sources", "rows", "checksums", "state")
+
+    def __init__(self, path: str):
+        self.path = path
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in self.FILES}
+        self.vectors = arrays["vectors"]
+        self.sources = arrays["sources"]
+        self.rows = arrays["rows"]
+        self.checksums = arrays["checksums"]
+        self.state = tuple(int(x) for x in arrays["state"])
+
+        if self.vectors.ndim != 2 or self.vectors.shape[1] != DIMENSIONS:
+            raise ValueError(f"Similarity vectors in {path} are out of date")
+
+    def __len__(self):
+        return len(self.rows)
+
+    def search(self, query: np.ndarray, limit: int) -> list:
+        """
+        Returns:
+            The limit most similar settings to the query vector as a list of
+            ((SettingSource value, row id), cosine similarity), best first.
+        """
+        if len(self) == 0:
+            return []
+
+        scores = self.vectors @ query
+        limit = min(limit, len(scores))
+        best = np.argpartition(-scores, limit - 1)[:limit]
+        best = best[np.argsort(-scores[best])]
+
+        return [((int(self.sources[i]), int(self.rows[i])), float(scores[i])) for i in best]
+
+def update_index(path: str = None, settings=None, state: tuple = None) -> SimilarityIndex:
+    """
+    Bring the similarity vectors up to date with the stored settings, re-encoding
+    only settings that are new or have changed. Should be called with the database open.
+
+    Args:
+        path: directory of the vectors, defaults to the data dir
+        settings: iterable of (SettingSource value, row id, abc, key), defaults to
+            every stored setting
+        state: db.settings_state of the settings, used to skip the update when
+            nothing has changed
+
+    Returns:
+        The updated index
+    """
+    path = path or default_vectors_dir()
+    os.makedirs(path, exist_ok=True)
+    if settings is None:
+        settings = db.iter_settings()
+        state = db.settings_state()
+
+    previous = {}
+    old = None
+    try:
+        old = SimilarityIndex(path)
+        if state is not None and old.state == tuple(state):
+            return old
+        for i, (source, row, checksum) in enumerate(zip(old.sources, old.rows, old.checksums)):
+            previous[(int(source), int(row))] = (i, int(checksum))
+    except (FileNotFoundError, ValueError) as e:
+        glog.debug("Rebuilding similarity vectors: %s", e)
+
+    sources, rows, checksums, vectors = [], [], [], []
+    reused = 0
+    for source, row, abc_string, key in settings:
+        checksum = _checksum(abc_string, key)
+        old_row = previous.get((source, row))
+        if old_row and old_row[1] == checksum:
+            vectors.append(old.vectors[old_row[0]])
+            reused += 1
+        else:
+            vectors.append(encode(abc_string, key))
+        sources.append(source)
+        rows.append(row)
+        checksums.append(checksum)
+
+    glog.debug("Encoded %d settings, reused %d", len(rows) - reused, reused)
+
+    state = tuple(state or (0, 0, 0, 0))
+    if (old is not None and reused == len(rows) == len(old) and old.state == state
+            and list(old.sources) == sources and list(old.rows) == rows):
+        return old
+
+    arrays = {
+        "vectors": np.array(vectors, dtype=np.float32).reshape(len(vectors), DIMENSIONS),
+        "sources": np.array(sources, dtype=np.uint8),
+        "rows": np.array(rows, dtype=np.uint32),
+        "checksums": np.array(checksums, dtype=np.uint32),
+        "state": np.array(state, dtype=np.int64),
+    }
+    del old, previous
+
+    for name, array in arrays.items():
+        tmp_path = os.path.join(path, f"{name}.tmp.npy")
+        np.save(tmp_path, array)
+        os.replace(tmp_path, os.path.join(path, f"{name}.npy"))
+
+    return SimilarityIndex(path)
+
+def similar_tunes(settings: list, limit: int = 10, index: SimilarityIndex = None,
+                  exclude_tune_id: int = None, exclude_ts_id: int = None) -> list:
+    """
+    Find the tunes most similar to a tune.
+
+    Args:
+        settings: (abc, key) of each setting of the tune
+        limit: maximum number of tunes to return
+        index: defaults to bringing the index in the data dir up to date
+        exclude_tune_id: library id of the tune itself, so it isn't returned
+        exclude_ts_id: TheSession id of the tune itself
+
+    Returns:
+        List of db.TuneMatch, most similar first
+    """
+    if not settings:
+        return []
+
+    index = index or update_index()
+    query = np.mean([encode(abc_string, key) for abc_string, key in settings], axis=0)
+    query = _normalized(query, 1.0)
+
+    # Take extra to make up for several settings of a tune, and the tune itself
+    scored = index.search(query, (limit + 1) * 5)
+    matches = db.describe_settings(scored, limit + 1)
+
+    return [m for m in matches
+            if not (exclude_tune_id and m.tune_id == exclude_tune_id)
+            and not (exclude_ts_id and m.ts_id == exclude_ts_id)][:limit]
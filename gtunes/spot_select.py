@@ -1,184 +1,286 @@
+import asyncio
 import logging
+from dataclasses import dataclass
+import requests
+import spotipy
 from textual.app import App, ComposeResult
-from textual.widgets import Footer, Header, ListView, Static, ListItem, Checkbox
-from textual.containers import Horizontal
+from textual.widgets import DataTable, Footer, Header, Static
+from textual.worker import Worker, WorkerState
 import gtunes.audio as audio
 import gtunes.scrape as scrape
-import threading
-import queue
+from gtunes import playback
+from gtunes import spotbroker
+from gtunes import spotcandidates
+from gtunes import db
+from gtunes import profiling
+import collections
 
-class SpotTrack(ListItem):
-    def __init__(self, spot_data: audio.SpotTuneTrackData):
-        super().__init__()
-
-        self.spot_data = spot_data
+# How often rows waiting to be shown are added to the table, in seconds
+BATCH_INTERVAL_SECS = 0.1
 
-        self._checkbox = Checkbox("")
-        self._track_info = Static(f"[b]{spot_data.track_name}[/b] by {spot_data.artist_name} on {spot_data.album_name}")
-        self._horizontal_container = Horizontal(self._checkbox, self._track_info)
-        self._is_playing = False
+# Recordings looked up on Spotify at once. The broker batches their album lookups.
+SPOTIFY_CONCURRENCY = 16
 
-    def compose(self) -> ComposeResult:
-        yield self._horizontal_container
+# Rows after the highlighted one whose details are fetched ahead of time
+PREVIEW_AHEAD = 5
 
-    def on_mount(self) -> None:
-        # Custom styling
-        self._horizontal_container.styles.height = "auto"
+CHECKED = "[x]"
+UNCHECKED = "[ ]"
 
-    def should_save(self) -> bool:
-        """
-        Returns:
-            True iff the SpotTrack checkbox is ticked
-        """
-        return self._checkbox.value
-    
-    def toggle_playback(self) -> bool:
-        """
-        Returns:
-            True iff track is currently set to be playing
-        """
-        self._is_playing = not self._is_playing
-        
-        return self._is_playing
+@dataclass(frozen=True)
+class TrackDetails:
+    """
+    What the detail pane shows of a track beyond the row.
+    """
+    duration_ms: int
+    album_art_url: str | None
 
 class SpotApp(App):
     """
-    TUI to select spotify tracks to save to the database
+    TUI to select spotify tracks to save to the database.
+
+    Tracks are shown in a DataTable, which only renders the rows in view. Tracks
+    found by the background worker wait in a list and are added to the table in
+    batches every BATCH_INTERVAL_SECS, so a flood of results is one redraw rather
+    than hundreds. Which tracks are ticked is a plain list alongside the tracks.
+
+    The highlighted track is shown in a detail pane. Details of it and the next
+    PREVIEW_AHEAD tracks are fetched in the background as the highlight moves,
+    and cached by track URI, so they're usually there as soon as a row is
+    highlighted. The Spotify device list is fetched on opening for the same
+    reason, so the first play goes straight to a device.
+
+    The worker is an asyncio task on the app's event loop, scraping TheSession
+    with an async client and matching recordings on Spotify in threads, so it's
+    cancelled the moment the app exits.
+
+    Args:
+        tune_name: the tune to find tracks of
+        output: the ticked tracks are added to it when saved
+        candidates: tracks already found, e.g. by spotcandidates.prefetch_tunes,
+            shown as soon as the app opens
+        known_recordings: (album, artist) of the recordings the candidates were
+            found from, which aren't looked for again
+        refresh: whether to look for recordings on TheSession. Always done when
+            there are no candidates.
+        found: if given, (ScrapeRecordingData, SpotTuneTrackData or None) of
+            each recording looked for is added to it, for saving as candidates
     """
     BINDINGS = [("space", "play_track", "Play track"),
+                ("x", "toggle_save", "Tick track"),
                 ("s", "save_tracks", "Save tracks"),
                 ("q", "quit", "Quit"),]
 
     CSS_PATH = "spot_select.css"  # Path to the external CSS file
 
-    def __init__(self, tune_name: str, output: list):
+    def __init__(self, tune_name: str, output: list, candidates: list = None, known_recordings: set = None,
+                 refresh: bool = True, found: list = None):
         super().__init__()
 
         self._tune_name = tune_name
+        self._refresh = refresh or candidates is None
+        self._known_recordings = known_recordings or set()
+        self._found = found
         self._sp = audio.connect_to_spotify()
-        self._selected_item = None
-        self._list_widget = None
-        self._stop_event = threading.Event() # Signals thread termination
-        
-        self._done_with_startup = False
-        self._done_with_startup_event = threading.Event() # Set 
+        self._playback = playback.PlaybackQueue(self._sp, notify=self.notify)
+        # Recordings are matched concurrently, often on the same albums
+        self._broker = spotbroker.SpotifyBroker(self._sp)
+        self._table = None
+
         self._output = output
 
-        self._scrape_data_queue = None
-        self._scraping_thread = None
-        self._queue_reader_thread = None
+        # Rows of the table, by index
+        self._tracks: list[audio.SpotTuneTrackData] = []
+        self._to_save: list[bool] = []
+        # Tracks found but not in the table yet. Appended to by the worker,
+        # emptied by the batch timer.
+        self._pending = collections.deque(candidates or [])
+        self._playing_row = None
+        # Details by track URI. Filled in by preview threads, read by the UI.
+        self._details: dict[str, TrackDetails] = {}
+        self._detail = None
 
     def compose(self) -> ComposeResult:
         """Create child widgets for the app."""
-        self._list_widget = ListView()
+        self._table = DataTable(cursor_type="row", zebra_stripes=True)
+        self._table.add_column("", key="save")
+        self._table.add_column("Track", key="track")
+        self._table.add_column("Artist", key="artist")
+        self._table.add_column("Album", key="album")
+        self._detail = Static(id="detail")
         yield Header()
         yield Footer()
-        yield self._list_widget
+        yield self._table
+        yield self._detail
+
+    def _highlighted_row(self) -> int | None:
+        if self._table is None or not self._tracks:
+            return None
+        return self._table.cursor_row
 
-    # TODO: toggle play/paused with internal boolean is_playing
-    # TODO: do this async so error can be displayed without blocking user input
     def action_play_track(self) -> None:
-        if self._list_widget:
-            highlighted_child = self._list_widget.highlighted_child
-            if highlighted_child and isinstance(highlighted_child, SpotTrack):
-                should_play = highlighted_child.toggle_playback()
-                if should_play:
-                    audio.spot_play_track(highlighted_child.spot_data.track_uri, self._sp, retries=0, log_fn=self.notify)
-                else:
-                    audio.spot_pause_track(highlighted_child.spot_data.track_uri, self._sp)
+        """
+        Play the highlighted track, or pause it if it's playing. Only queues the
+        command, see playback.PlaybackQueue.
+        """
+        row = self._highlighted_row()
+        if row is None:
+            return
+
+        if self._playing_row == row:
+            self._playing_row = None
+            self._playback.pause()
+        else:
+            self._playing_row = row
+            track = self._tracks[row]
+            self._playback.play(track.track_uri, label=f"{track.track_name} by {track.artist_name}")
+
+    def _show_details(self, row: int | None) -> None:
+        if row is None or self._detail is None:
+            return
+
+        track = self._tracks[row]
+        details = self._details.get(track.track_uri)
+        duration = db.format_secs(details.duration_ms // 1000) if details else "…"
+        lines = [f"{track.track_name} ({duration}) from {track.album_name} by {track.artist_name}"]
+        if track.track_tunes:
+            tunes = track.track_tunes.split(scrape.TUNE_DELIMITER)
+            lines.append("Tunes: " + "  ".join(f"{i}. {tune}" for i, tune in enumerate(tunes, 1)))
+        if details and details.album_art_url:
+            lines.append(f"Album art: {details.album_art_url}")
+        self._detail.update("\n".join(lines))
+
+    def _fetch_details(self, track_uris: list) -> None:
+        """
+        Fetch and cache the details of tracks in one call. Blocks on the Spotify
+        API, so it's run in a thread.
+        """
+        with profiling.span("spot_select preview", tracks=len(track_uris)):
+            tracks = audio.spot_tracks(track_uris, self._broker)
+        for track in tracks:
+            images = track["album"].get("images")
+            self._details[track["uri"]] = TrackDetails(duration_ms=track["duration_ms"],
+                                                       album_art_url=images[0]["url"] if images else None)
+
+    async def _preview(self, row: int) -> None:
+        """
+        Fetch the details of the tracks from row on that aren't cached, then show
+        those of the highlighted row.
+        """
+        track_uris = [t.track_uri for t in self._tracks[row:row + PREVIEW_AHEAD + 1]
+                      if t.track_uri not in self._details]
+        if not track_uris:
+            return
+
+        try:
+            await asyncio.to_thread(self._fetch_details, track_uris)
+        except (spotipy.SpotifyException, requests.RequestException) as e:
+            logging.debug(f"Couldn't fetch track details: {e}")
+            return
+
+        self._show_details(self._highlighted_row())
+
+    def on_data_table_row_highlighted(self, event: DataTable.RowHighlighted) -> None:
+        self._show_details(event.cursor_row)
+        # Moving on cancels the preview of rows passed over. A fetch already
+        # made still fills the cache.
+        self.run_worker(self._preview(event.cursor_row), name="preview", group="preview", exclusive=True)
+
+    def action_toggle_save(self) -> None:
+        row = self._highlighted_row()
+        if row is None:
+            return
+
+        self._to_save[row] = not self._to_save[row]
+        self._table.update_cell(str(row), "save", CHECKED if self._to_save[row] else UNCHECKED)
+
+    def on_data_table_row_selected(self, event: DataTable.RowSelected) -> None:
+        self.action_toggle_save()
 
     def action_save_tracks(self) -> list:
-        for spot_list_item in self._list_widget.children:
-            if spot_list_item.should_save():
-                self._output.append(spot_list_item.spot_data)
+        self._output.extend(track for track, save in zip(self._tracks, self._to_save) if save)
 
         self.exit(0)
 
-    def add_track(self, track: SpotTrack):
-        self._list_widget.append(track)
-        self._list_widget.refresh()
-
-    def read_tracks_from_queue(self, queue):
+    def add_track(self, track: audio.SpotTuneTrackData):
         """
-        Reads from the queue of track data and use it to populate list of
-        spotify tracks. This is intended to be run in its own thread.
+        Queue a track to be added to the table with the next batch. Safe to call
+        from any thread.
         """
-        while True:
-            if self._stop_event.is_set():
-                logging.debug("Stop event is set")
-                break
-            else:
-                logging.debug("Stop event not set")
-            scrape_data: scrape.ScrapeRecordingData = queue.get()
-            if scrape_data is None:
-                break
-
-            spot_album_data = audio.spot_search_albums(scrape_data.album_name, self._sp, artist_name=scrape_data.artist_name)
-            if not spot_album_data:
-                continue
-
-            spot_data = audio.SpotTuneTrackData(album_name=spot_album_data["name"], 
-                                          track_number=scrape_data.track_number, 
-                                          track_tunes=scrape_data.track_tunes,
-                                          album_uri=spot_album_data["uri"],
-                                          artist_name=scrape_data.artist_name)
-
-            spot_track_data = audio.spot_get_nth_album_track(spot_data.album_uri, spot_data.track_number, self._sp)
-
-            # Add track data
-            spot_data.track_name = spot_track_data["name"]
-            spot_data.track_uri = spot_track_data["uri"]
+        self._pending.append(track)
+
+    def _add_pending_tracks(self) -> None:
+        if not self._pending:
+            return
 
+        with profiling.span("spot_select add rows"):
+            while self._pending:
+                track = self._pending.popleft()
+                self._table.add_row(UNCHECKED, track.track_name, track.artist_name, track.album_name,
+                                    key=str(len(self._tracks)))
+                self._tracks.append(track)
+                self._to_save.append(False)
+
+    async def _find_tracks(self) -> None:
+        """
+        Scrape the recordings of the tune and add the ones found on Spotify to
+        the table, in the order TheSession lists them. Up to SPOTIFY_CONCURRENCY
+        recordings are matched at once.
+        """
+        semaphore = asyncio.Semaphore(SPOTIFY_CONCURRENCY)
+        # Match tasks in recording order, None once scraping is done
+        matches = asyncio.Queue()
+
+        async def match(scrape_data):
+            async with semaphore:
+                return scrape_data, await asyncio.to_thread(spotcandidates.match_recording, scrape_data,
+                                                            self._broker)
+
+        async def add_matches():
+            while (task := await matches.get()) is not None:
+                scrape_data, spot_data = await task
+                if self._found is not None:
+                    self._found.append((scrape_data, spot_data))
+                if spot_data:
+                    self.add_track(spot_data)
+
+        async with asyncio.TaskGroup() as tasks:
+            tasks.create_task(add_matches())
             try:
-                self.call_from_thread(self.add_track,
-                                      SpotTrack(spot_data))
-            except RuntimeError as runtime_error:
-                if "App is not running" in str(runtime_error):
-                    break
-                else:
-                    raise runtime_error
+                async with scrape.async_client() as client:
+                    async for scrape_data in scrape.iter_recording_data(client, tune_name=self._tune_name):
+                        if (scrape_data.album_name, scrape_data.artist_name) in self._known_recordings:
+                            continue
+                        matches.put_nowait(tasks.create_task(match(scrape_data)))
+            finally:
+                matches.put_nowait(None)
 
     async def on_mount(self) -> None:
-        # Ensure ListView items don't stretch
-        self.query_one(ListView).styles.height = "auto"
-
-        # Start background worker that fills the queue with albums data
-        # corresponding to the tune in question.
-        self._scrape_data_queue = queue.Queue()
-        logging.debug("Starting scraping thread")
-        self._scraping_thread = threading.Thread(target=scrape.scrape_recording_data,
-                                        kwargs={
-                                            "tune_name": self._tune_name,
-                                            "data_queue": self._scrape_data_queue,
-                                            "stop_event": self._stop_event})
-        self._scraping_thread.start()
-
-        # Start queue reader thread.
-        logging.debug("Starting queue reader thread")
-        self._queue_reader_thread = threading.Thread(target=self.read_tracks_from_queue, args=[self._scrape_data_queue])
-        self._queue_reader_thread.start()
-
-
-    async def on_unmount(self) -> None:
-        logging.debug("Setting stop event")
-        self._stop_event.set()
-        if self._scraping_thread.is_alive():
-            logging.debug("Joining scraping thread")
-            self._scraping_thread.join(2)
-        else:
-            logging.debug("Scraping thread is not live")
-
-        #logging.debug("Trying to send None to queue with timeout")
-        #self._scrape_data_queue.put(None, timeout = 0.5)
-        if self._queue_reader_thread.is_alive():
-            logging.debug("Joining queue reader")
-            self._queue_reader_thread.join(2)
-        else:
-            logging.debug("Queue thread is not live")
+        self.set_interval(BATCH_INTERVAL_SECS, self._add_pending_tracks)
+        self.run_worker(self._playback.run(), name="playback")
+        self.run_worker(self._playback.warm(), name="warm devices")
+        if self._refresh:
+            logging.debug("Starting find tracks worker")
+            self.run_worker(self._find_tracks(), name="find tracks", exit_on_error=False)
+
+    def on_unmount(self) -> None:
+        logging.debug(f"Spotify broker: {self._broker.stats()}")
+        self._broker.close()
+
+    def on_worker_state_changed(self, event: Worker.StateChanged) -> None:
+        if event.worker.name == "find tracks" and event.state == WorkerState.ERROR:
+            logging.debug(f"Find tracks worker failed: {event.worker.error!r}")
+            self.notify(f"Couldn't find tracks: {event.worker.error}", severity="error")
+
+def select_spotify_track(tune_name: str, **kwargs) -> list:
+    """
+    Run the SpotApp, see it for the kwargs.
 
-def select_spotify_track(tune_name: str) -> list:
+    Returns:
+        The tracks ticked and saved.
+    """
     output = []
-    app = SpotApp(tune_name, output)
+    app = SpotApp(tune_name, output, **kwargs)
     app.run()
 
     return output
@@ -0,0 +1,295 @@
+# Fewer, better behaved calls to the Spotify API from many threads at once.
+#
+# SpotifyBroker stands in for a spotipy.Spotify client where lookups are made
+# concurrently, like the spot selector matching recordings:
+#
+#   broker = SpotifyBroker(sp)
+#   album = broker.album(album_id)   # from any thread
+#
+# - Lookups of single albums and tracks are held for BATCH_WINDOW_SECS and made
+#   together through the batch endpoints, up to 20 albums or 50 tracks a call.
+#   album_tracks is answered from the album, which includes its first 50 tracks.
+# - A lookup or search that's already in flight isn't made again: the callers
+#   asking for it all wait on the one call (single flight).
+# - When Spotify answers 429, every call waits out its Retry-After, not just
+#   the one that got it, then the call is retried.
+# - A batch is made in the most urgent priority class (see scheduler) of the
+#   lookups in it, as it's made from the broker's own threads.
+#
+# stats() gives the number of lookups waiting and calls in flight, and the
+# latency of recent requests.
+
+import collections
+import concurrent.futures
+import threading
+import time
+from dataclasses import dataclass
+
+import spotipy
+
+from gtunes import profiling
+from gtunes import scheduler
+from gtunes import util
+
+glog = util.get_logger()
+
+# How long a lookup waits for others to batch with
+BATCH_WINDOW_SECS = 0.01
+
+MAX_ALBUM_IDS = 20
+MAX_TRACK_IDS = 50
+
+# Times a rate limited call is retried
+RATE_LIMIT_RETRIES = 3
+
+# Batch calls made at once
+MAX_CALLS_IN_FLIGHT = 4
+
+# Recent request latencies kept for stats
+LATENCY_SAMPLES = 1000
+
+@dataclass(frozen=True)
+class BrokerStats:
+    queued: int
+    in_flight: int
+    requests: int
+    calls: int
+    deduplicated: int
+    p50_ms: float
+    p95_ms: float
+
+    def __str__(self) -> str:
+        return (f"{self.requests} requests in {self.calls} calls ({self.deduplicated} deduplicated), "
+                f"{self.queued} queued, {self.in_flight} in flight, "
+                f"latency p50 {self.p50_ms:.0f}ms p95 {self.p95_ms:.0f}ms")
+
+class SpotifyBroker:
+    """
+    Batches, deduplicates and rate limits calls to a Spotify client. See the
+    module comment.
+
+    Methods it doesn't have are passed through to the client.
+    """
+    def __init__(self, sp: spotipy.Spotify, window_secs: float = BATCH_WINDOW_SECS):
+        self._sp = sp
+        self.window_secs = window_secs
+
+        self._cond = threading.Condition()
+        # Lookups waiting to be batched, by endpoint, id to future in the order asked
+        self._pending = {"albums": {}, "tracks": {}}
+        # The most urgent priority of each endpoint's waiting lookups
+        self._pending_priority = {}
+        self._first_pending_at = {}
+        # Every lookup and search not answered yet, for single flight
+        self._futures = {}
+        self._dispatcher = None
+        self._closed = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(MAX_CALLS_IN_FLIGHT,
+                                                               thread_name_prefix="spotify broker")
+
+        # The shared backoff clock: no call is made before this time
+        self._not_before = 0.0
+
+        self._in_flight = 0
+        self._requests = 0
+        self._calls = 0
+        self._deduplicated = 0
+        self._latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def __getattr__(self, name):
+        return getattr(self._sp, name)
+
+    def album(self, album_id: str) -> dict:
+        """
+        Returns:
+            The album, as from sp.album
+        """
+        return self._batched("albums", util.spotify_id(album_id))
+
+    def track(self, track_id: str) -> dict:
+        """
+        Returns:
+            The track, as from sp.track
+        """
+        return self._batched("tracks", util.spotify_id(track_id))
+
+    def album_tracks(self, album_id: str, limit: int = 50, offset: int = 0, market: str = None) -> dict:
+        tracks = self.album(album_id)["tracks"]
+        if offset + limit <= len(tracks["items"]) or len(tracks["items"]) >= tracks["total"]:
+            return dict(tracks, items=tracks["items"][offset:offset + limit], limit=limit, offset=offset)
+
+        # Past the tracks that come with the album
+        return self._single_flight(("album_tracks", album_id, limit, offset, market),
+                                   self._sp.album_tracks, album_id, limit=limit, offset=offset, market=market)
+
+    def search(self, q: str, limit: int = 10, offset: int = 0, type: str = "track", market: str = None) -> dict:
+        return self._single_flight(("search", q, limit, offset, type, market),
+                                   self._sp.search, q, limit=limit, offset=offset, type=type, market=market)
+
+    def stats(self) -> BrokerStats:
+        with self._cond:
+            latencies = sorted(self._latencies)
+            queued = sum(len(pending) for pending in self._pending.values())
+
+            def percentile(p):
+                return latencies[int(p * (len(latencies) - 1))] * 1000 if latencies else 0.0
+
+            return BrokerStats(queued=queued, in_flight=self._in_flight, requests=self._requests,
+                               calls=self._calls, deduplicated=self._deduplicated,
+                               p50_ms=percentile(0.5), p95_ms=percentile(0.95))
+
+    def close(self) -> None:
+        """
+        Stop batching. Lookups already waiting are still made, and later ones are
+        made one at a time by their callers.
+        """
+        with self._cond:
+            self._closed = True
+            dispatcher = self._dispatcher
+            self._cond.notify_all()
+        if dispatcher is not None:
+            dispatcher.join()
+        self._executor.shutdown(wait=False)
+
+    def _timed(self, future: concurrent.futures.Future, start: float):
+        try:
+            return future.result()
+        finally:
+            with self._cond:
+                self._latencies.append(time.monotonic() - start)
+
+    def _batched(self, endpoint: str, item_id: str) -> dict:
+        start = time.monotonic()
+        key = (endpoint, item_id)
+        request_priority = scheduler.current_priority()
+        unbatched = False
+        with self._cond:
+            self._requests += 1
+            future = self._futures.get(key)
+            if future is not None:
+                self._deduplicated += 1
+            elif self._closed:
+                future = self._futures[key] = concurrent.futures.Future()
+                unbatched = True
+            else:
+                future = self._futures[key] = concurrent.futures.Future()
+                pending = self._pending[endpoint]
+                if not pending:
+                    self._first_pending_at[endpoint] = start
+                pending[item_id] = future
+            if self._pending[endpoint]:
+                self._pending_priority[endpoint] = min(request_priority,
+                                                       self._pending_priority.get(endpoint, request_priority))
+                if self._dispatcher is None:
+                    self._dispatcher = threading.Thread(target=self._dispatch, name="spotify broker dispatcher",
+                                                        daemon=True)
+                    self._dispatcher.start()
+                self._cond.notify()
+
+        if unbatched:
+            self._fetch_batch(endpoint, {item_id: future}, request_priority)
+        return self._timed(future, start)
+
+    def _single_flight(self, key: tuple, call, *args, **kwargs) -> dict:
+        start = time.monotonic()
+        with self._cond:
+            self._requests += 1
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = concurrent.futures.Future()
+            else:
+                self._deduplicated += 1
+
+        if owner:
+            try:
+                future.set_result(self._call(call, *args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._cond:
+                    del self._futures[key]
+
+        return self._timed(future, start)
+
+    def _dispatch(self):
+        """
+        Send off batches once they're full or their window has passed, until
+        closed. Once closed, whatever is waiting is sent off without waiting out
+        the window.
+        """
+        limits = {"albums": MAX_ALBUM_IDS, "tracks": MAX_TRACK_IDS}
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    due = [e for e, pending in self._pending.items()
+                           if pending and (self._closed or len(pending) >= limits[e]
+                                           or now >= self._first_pending_at[e] + self.window_secs)]
+                    if due:
+                        break
+                    if self._closed:
+                        return
+                    waits = [self._first_pending_at[e] + self.window_secs - now
+                             for e, pending in self._pending.items() if pending]
+                    self._cond.wait(min(waits) if waits else None)
+
+                batches = []
+                for endpoint in due:
+                    pending = self._pending[endpoint]
+                    ids = list(pending)[:limits[endpoint]]
+                    request_priority = self._pending_priority[endpoint]
+                    batches.append((endpoint, {item_id: pending.pop(item_id) for item_id in ids}, request_priority))
+                    if pending:
+                        self._first_pending_at[endpoint] = now
+                    else:
+                        del self._pending_priority[endpoint]
+
+            # close shuts the executor down only once this thread has finished
+            for endpoint, batch, request_priority in batches:
+                self._executor.submit(self._fetch_batch, endpoint, batch, request_priority)
+
+    def _fetch_batch(self, endpoint: str, batch: dict, request_priority: scheduler.Priority):
+        items, error = None, None
+        try:
+            with profiling.span(f"spotify broker {endpoint}", ids=len(batch)), scheduler.priority(request_priority):
+                items = self._call(getattr(self._sp, endpoint), list(batch))[endpoint]
+        except Exception as e:
+            error = e
+
+        with self._cond:
+            for item_id in batch:
+                del self._futures[(endpoint, item_id)]
+
+        for i, (item_id, future) in enumerate(batch.items()):
+            if items is None:
+                future.set_exception(error)
+            elif items[i] is None:
+                future.set_exception(spotipy.SpotifyException(404, -1, f"Non existing id: '{item_id}'"))
+            else:
+                future.set_result(items[i])
+
+    def _call(self, call, *args, **kwargs):
+        """
+        Make an API call, waiting on and feeding the shared backoff clock.
+        """
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            wait = self._not_before - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+            with self._cond:
+                self._calls += 1
+                self._in_flight += 1
+            try:
+                return call(*args, **kwargs)
+            except spotipy.SpotifyException as e:
+                if e.http_status != 429 or attempt == RATE_LIMIT_RETRIES:
+                    raise
+                retry_after = float((e.headers or {}).get("Retry-After", 1))
+                glog.debug(f"Spotify rate limited, backing off {retry_after}s")
+                with self._cond:
+                    self._not_before = max(self._not_before, time.monotonic() + retry_after)
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
@@ -0,0 +1,222 @@
+# Spotify candidates for tunes, found ahead of time.
+#
+# `gtn tune spot --prefetch` runs the spot selector's pipeline for many tunes at
+# once: scrape the recordings TheSession lists for a tune, match each album on
+# Spotify, then look up the track. Tunes are resolved in a pool of worker threads
+# sharing one Spotify broker, and their candidates, along with the album pages
+# scraped for the recording catalog, are written from the calling thread in
+# batches, like enrich.
+# The selector then opens on a tune's candidates straight from the table.
+
+import concurrent.futures
+import datetime
+import time
+from dataclasses import dataclass, field
+
+from gtunes import audio
+from gtunes import db
+from gtunes import profiling
+from gtunes import scheduler
+from gtunes import scrape
+from gtunes import spotbroker
+from gtunes import util
+
+glog = util.get_logger()
+
+DEFAULT_WORKERS = 4
+# Tunes per database transaction
+DEFAULT_BATCH_SIZE = 10
+
+def match_recording(scrape_data: scrape.ScrapeRecordingData, sp) -> audio.SpotTuneTrackData | None:
+    """
+    Find the Spotify track of a recording TheSession lists. Does no database
+    access, so it is safe to run in a worker thread.
+
+    Returns:
+        The track, scored by how well its album matched, or None if it wasn't found.
+    """
+    with profiling.span("spot match album"):
+        match = audio.spot_match_album(scrape_data.album_name, sp, artist_name=scrape_data.artist_name)
+    if not match:
+        return None
+    album, album_score, artist_score = match
+
+    with profiling.span("spot find track"):
+        track = audio.spot_get_nth_album_track(album["uri"], scrape_data.track_number, sp)
+    if not track:
+        return None
+
+    return audio.SpotTuneTrackData(album_name=album["name"],
+                                   track_number=scrape_data.track_number,
+                                   track_uri=track["uri"],
+                                   album_uri=album["uri"],
+                                   track_tunes=scrape_data.track_tunes,
+                                   track_name=track["name"],
+                                   artist_name=scrape_data.artist_name,
+                                   session_album_name=scrape_data.album_name,
+                                   score=album_score * artist_score)
+
+def candidate_row(tune_id: int, position: int, scrape_data: scrape.ScrapeRecordingData,
+                  track: audio.SpotTuneTrackData | None) -> dict:
+    """
+    A SpotifyCandidate row for a recording, and its track if it was found.
+    """
+    row = {"tune": tune_id, "position": position, "session_album": scrape_data.album_name,
+           "artist": scrape_data.artist_name, "track_number": scrape_data.track_number,
+           "tune_number": scrape_data.tune_number, "track_tunes": scrape_data.track_tunes,
+           "album": None, "album_uri": None, "track_name": None, "track_uri": None, "score": 0.0,
+           "date_updated": datetime.datetime.now()}
+    if track:
+        row.update(album=track.album_name, album_uri=track.album_uri, track_name=track.track_name,
+                   track_uri=track.track_uri, score=track.score)
+    return row
+
+@dataclass
+class PrefetchResult:
+    tune_id: int
+    rows: list = field(default_factory=list)
+    # Album pages scraped, for the recording catalog, see scrape.find_track_number
+    albums: list = field(default_factory=list)
+    error: str | None = None
+
+@dataclass
+class PrefetchSummary:
+    tunes: int = 0
+    recordings: int = 0
+    matched: int = 0
+    failed: int = 0
+    elapsed_secs: float = 0
+    interrupted: bool = False
+
+    def __str__(self):
+        rate = self.tunes / self.elapsed_secs if self.elapsed_secs else 0
+        out = f"Prefetched {self.tunes} tunes in {self.elapsed_secs:.1f}s ({rate:.2f} tunes/s)"
+        if self.interrupted:
+            out += " before being interrupted"
+        out += f"\n{self.matched} of {self.recordings} recordings found on Spotify"
+        if self.failed:
+            out += f", {self.failed} tunes failed"
+        return out
+
+def resolve_tune(tune_id: int, tune_name: str, ts_id: int | None, sp) -> PrefetchResult:
+    """
+    Scrape the recordings of a tune and match each on Spotify. Only reads the
+    recording catalog, through the thread's own connection: album pages it had
+    to scrape come back in the result, for _write_batch to save.
+    """
+    try:
+        albums = []
+        recordings = scrape.scrape_recording_data(tune_name=tune_name, tune_id=ts_id, albums=albums)
+        return PrefetchResult(tune_id, [candidate_row(tune_id, position, recording, match_recording(recording, sp))
+                                        for position, recording in enumerate(recordings)], albums)
+    except Exception as e:
+        glog.debug("Failed to prefetch Spotify candidates of %s: %s", tune_name, e)
+        return PrefetchResult(tune_id, error=str(e))
+
+def save_candidates(tune_id: int, rows: list, replace: bool = True):
+    """
+    Save candidate rows of a tune, in place of those already saved if replace is set.
+    """
+    with db.db.atomic():
+        if replace:
+            db.SpotifyCandidate.delete().where(db.SpotifyCandidate.tune == tune_id).execute()
+        if rows:
+            db.SpotifyCandidate.insert_many(rows).execute()
+
+def _write_batch(batch: list):
+    with db.db.atomic():
+        for result in batch:
+            save_candidates(result.tune_id, result.rows)
+            for recording_id, tracks, name, artist in result.albums:
+                db.save_session_recording(recording_id, tracks, name=name, artist=artist)
+
+def tunes_to_prefetch(status: db.Status, refresh: bool = False):
+    """
+    Returns:
+        Query of tunes of a status, leaving out those that already have candidates
+        unless refresh is set.
+    """
+    query = db.Tune.select().where(db.Tune.status == status.value)
+    if not refresh:
+        query = query.where(db.Tune.id.not_in(db.SpotifyCandidate.select(db.SpotifyCandidate.tune)))
+    return query.order_by(db.Tune.id)
+
+def prefetch_tunes(tunes: list, workers: int = DEFAULT_WORKERS, batch_size: int = DEFAULT_BATCH_SIZE,
+                   log_fn=print) -> PrefetchSummary:
+    """
+    Find the Spotify candidates of the given tunes concurrently, writing them in
+    batches.
+
+    Should be called with the database already open. A KeyboardInterrupt stops the
+    run after saving everything that has finished so far.
+
+    Args:
+        tunes: db.Tune instances
+        workers: number of tunes resolved at once
+        batch_size: number of tunes per database transaction
+    """
+    summary = PrefetchSummary()
+    if not tunes:
+        return summary
+
+    sp = spotbroker.SpotifyBroker(audio.connect_to_spotify())
+    start = time.perf_counter()
+    batch = []
+
+    def flush():
+        if batch:
+            _write_batch(batch)
+            batch.clear()
+            log_fn(f"[{summary.tunes}/{len(tunes)}] saved")
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [executor.submit(scheduler.with_priority, scheduler.Priority.PREFETCH,
+                                   resolve_tune, t.id, t.name, t.ts_id, sp)
+                   for t in tunes]
+
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            summary.tunes += 1
+            if result.error:
+                summary.failed += 1
+                continue
+
+            summary.recordings += len(result.rows)
+            summary.matched += len([r for r in result.rows if r["track_uri"]])
+            batch.append(result)
+            if len(batch) >= batch_size:
+                flush()
+    except KeyboardInterrupt:
+        summary.interrupted = True
+        executor.shutdown(wait=False, cancel_futures=True)
+    finally:
+        flush()
+        executor.shutdown(wait=False)
+        sp.close()
+        glog.debug(f"Spotify broker: {sp.stats()}")
+        summary.elapsed_secs = time.perf_counter() - start
+
+    return summary
+
+def load_candidates(tune_id: int) -> tuple[list, set]:
+    """
+    Returns:
+        The tracks found for a tune, best match first, and the (album, artist)
+        of every recording already looked for, found or not.
+    """
+    tracks = []
+    known = set()
+    query = (db.SpotifyCandidate.select()
+             .where(db.SpotifyCandidate.tune == tune_id)
+             .order_by(db.SpotifyCandidate.score.desc(), db.SpotifyCandidate.position))
+    for candidate in query:
+        known.add((candidate.session_album, candidate.artist))
+        if candidate.track_uri:
+            tracks.append(audio.SpotTuneTrackData(album_name=candidate.album, track_number=candidate.track_number,
+                                                  track_uri=candidate.track_uri, album_uri=candidate.album_uri,
+                                                  track_tunes=candidate.track_tunes, track_name=candidate.track_name,
+                                                  artist_name=candidate.artist,
+                                                  session_album_name=candidate.session_album,
+                                                  score=candidate.score))
+    return tracks, known
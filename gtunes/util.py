@@ -5,6 +5,7 @@
 import logging
 import os
 import pathlib
+import re
 
 import dotenv
 
@@ -38,4 +39,20 @@ def get_data_dir() -> str:
 
 # Accept timestamps in the format 1:30 where 1 is the minutes and 30 is the seconds
 def timestamp_to_seconds(timestamp):
-    sum(x * int(t) for x, t in zip([60, 1], timestamp.split(":")))
\ No newline at end of file
+    return sum(x * int(t) for x, t in zip([60, 1], timestamp.split(":")))
+
+_SPOTIFY_URI = re.compile(r"(?:spotify:(\w+):|open\.spotify\.com/(?:intl-\w+/)?(\w+)/)([A-Za-z0-9]+)")
+
+def spotify_id(id_uri_or_url: str, kind: str = None) -> str | None:
+    """
+    Returns:
+        The bare id from a Spotify id, URI (spotify:track:id) or URL
+        (https://open.spotify.com/track/id?si=...). If kind is given, like
+        "track", None unless it's a URI or URL of that kind.
+    """
+    match = _SPOTIFY_URI.search(id_uri_or_url or "")
+    if match is None:
+        return None if kind else id_uri_or_url
+    if kind and kind not in match.group(1, 2):
+        return None
+    return match.group(3)
\ No newline at end of file
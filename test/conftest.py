@@ -0,0 +1,69 @@
+import pytest
+from gtunes import db
+from gtunes import httpfixtures
+from gtunes import querylog
+
+@pytest.fixture
+def memory_db():
+    """
+    Points the gtunes database at a fresh in-memory database for the duration of
+    a test, so tests never touch the real tune database.
+    """
+    database_path = db.db.database
+    db.db.init(":memory:", pragmas={'foreign_keys': 1})
+    db.db.connect()
+    db.db.create_tables(db.TABLES)
+
+    yield db.db
+
+    db.db.close()
+    db.db.init(database_path, pragmas={'foreign_keys': 1})
+
+@pytest.fixture
+def query_budget():
+    """
+    Fails the test if a block runs too many queries, e.g.
+
+        with query_budget(3, max_repeats=1):
+            ...
+    """
+    return querylog.budget
+
+# Cut down pages in the shape of TheSession's
+SEARCH_PAGE = """
+<ol class="manifest-inventory">
+  <li class="manifest-item"><a href="/tunes/1">The Ashplant</a><a-preview data-tuneid="1"></a-preview></li>
+</ol>
+"""
+
+RECORDINGS_PAGE = """
+<ol class="manifest-inventory">
+  <li class="manifest-item">
+    <a class="manifest-item-title" href="/recordings/3192?tune_id=1">Both Sides Now</a>
+    <span class="bill-item-cost">by <a href="/artists/1">Kevin Burke</a></span>
+  </li>
+</ol>
+"""
+
+ALBUM_PAGE = """
+<ol class="manifest-inventory">
+  <li class="manifest-item"><a href="/tunes/5">Other Reel</a><a-preview data-tuneid="5"></a-preview></li>
+  <li class="manifest-item">
+    <a href="/tunes/9">The Kesh</a><a-preview data-tuneid="9"></a-preview>
+    <a href="/tunes/1">The Ashplant</a><a-preview data-tuneid="1"></a-preview>
+  </li>
+</ol>
+"""
+
+@pytest.fixture
+def session_archive(tmp_path):
+    """
+    A fixture archive of the TheSession pages for the recordings of The Ashplant.
+    """
+    archive = httpfixtures.FixtureArchive(str(tmp_path / "thesession.json.xz"))
+    archive.put("GET /tunes/search?q=the+ashplant", 200, SEARCH_PAGE)
+    archive.put("GET /tunes/1/recordings", 200, RECORDINGS_PAGE)
+    archive.put("GET /recordings/3192", 200, ALBUM_PAGE)
+    archive.save()
+
+    return httpfixtures.FixtureArchive(archive.path)
@@ -0,0 +1,17 @@
+import gtunes.abcnotation as abcnotation
+
+def test_normalize_key():
+    assert abcnotation.normalize_key("D Mixolydian") == "Dmix"
+    assert abcnotation.normalize_key("Dmixolydian") == "Dmix"
+    assert abcnotation.normalize_key("Em") == "Emin"
+    assert abcnotation.normalize_key("Gmajor") == "Gmaj"
+    assert abcnotation.normalize_key("G") == "Gmaj"
+    assert abcnotation.normalize_key("F#m") == "F#min"
+    assert abcnotation.normalize_key("Bb") == "Bbmaj"
+    assert abcnotation.normalize_key("none") is None
+
+def test_parse_headers():
+    headers = abcnotation.parse_headers("X: 1\nT: The Ashplant\nR: Reel\nM: 4/4\nL: 1/8\nK: Edorian\n|:B2 ...\nK:G\n")
+    assert headers == {"key": "Edor", "meter": "4/4", "unit_length": "1/8", "rhythm": "reel"}
+
+    assert abcnotation.parse_headers("X:1\n|:ABcd|") == {"key": None, "meter": None, "unit_length": None, "rhythm": None}
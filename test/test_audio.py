@@ -0,0 +1,81 @@
+import time
+
+import pytest
+from spotipy.cache_handler import MemoryCacheHandler
+
+from gtunes import audio
+from gtunes import fakespot
+
+@pytest.fixture
+def shared_client(monkeypatch):
+    monkeypatch.setenv("GTUNES_SPOTIFY_BACKEND", "fake")
+    audio.reset_spotify_client()
+    yield
+    audio.reset_spotify_client()
+
+def test_client_is_shared(shared_client):
+    sp = audio.connect_to_spotify()
+    assert isinstance(sp, fakespot.FakeSpotify)
+    assert audio.connect_to_spotify() is sp
+
+    audio.reset_spotify_client()
+    assert audio.connect_to_spotify() is not sp
+
+class _AuthManager:
+    def __init__(self, expires_in=None):
+        token = None
+        if expires_in is not None:
+            token = {"access_token": "a", "refresh_token": "r", "expires_at": int(time.time()) + expires_in}
+        self.cache_handler = MemoryCacheHandler(token)
+        self.refreshed = 0
+
+    def refresh_access_token(self, refresh_token):
+        self.refreshed += 1
+        self.cache_handler.save_token_to_cache(dict(self.cache_handler.get_cached_token(),
+                                                    expires_at=int(time.time()) + 3600))
+
+def test_token_is_refreshed_before_it_expires():
+    auth_manager = _AuthManager(expires_in=audio.TOKEN_REFRESH_MARGIN_SECS - 10)
+    refresher = audio._TokenRefresher(auth_manager)
+    refresher.start()
+
+    deadline = time.monotonic() + 2
+    while not auth_manager.refreshed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    refresher.stop_event.set()
+    refresher.join(1)
+
+    assert auth_manager.refreshed == 1
+    assert not refresher.is_alive()
+
+def test_refresher_waits_for_the_first_login(monkeypatch):
+    monkeypatch.setattr(audio, "TOKEN_POLL_SECS", 0.01)
+    auth_manager = _AuthManager()
+    refresher = audio._TokenRefresher(auth_manager)
+    refresher.start()
+
+    time.sleep(0.05)
+    assert refresher.is_alive()
+    # Logged in by the first request
+    auth_manager.cache_handler.save_token_to_cache({"access_token": "a", "refresh_token": "r",
+                                                    "expires_at": int(time.time())})
+
+    deadline = time.monotonic() + 2
+    while not auth_manager.refreshed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    refresher.stop()
+    refresher.join(1)
+
+    assert auth_manager.refreshed == 1
+    assert not refresher.is_alive()
+
+def test_reset_stops_the_refresher(monkeypatch):
+    refresher = audio._TokenRefresher(_AuthManager(expires_in=3600))
+    monkeypatch.setattr(audio, "_build_client", lambda: (object(), refresher))
+    audio.reset_spotify_client()
+    audio.connect_to_spotify()
+    refresher.start()
+
+    audio.reset_spotify_client()
+    refresher.join(1)
+    assert not refresher.is_alive()
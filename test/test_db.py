@@ -0,0 +1,141 @@
+import os
+import shutil
+
+from gtunes import db
+from gtunes import util
+
+ASHPLANT = "X: 1\nT: The Ashplant\nR: reel\nM: 4/4\nL: 1/8\nK: Edorian\n|:B2 BA GABd|"
+ASHPLANT_2 = "X: 2\nT: The Ashplant\nR: reel\nM: 4/4\nL: 1/8\nK: Ador\n|:e2 ed cdeg|"
+
+def test_save_tune_settings(memory_db):
+    tune = db.Tune.create(name="The Ashplant")
+    db.save_tune_settings(tune, [ASHPLANT, ASHPLANT_2])
+
+    assert tune.key == "Edor"
+    assert tune.first_abc() == ASHPLANT
+    assert [s.key for s in tune.settings.order_by(db.TuneSetting.position)] == ["Edor", "Ador"]
+
+    # Replaces rather than appends
+    db.save_tune_settings(tune, [ASHPLANT_2])
+    assert tune.settings.count() == 1
+    assert tune.first_abc() == ASHPLANT_2
+
+    reels_in_a_dorian = (db.Tune.select()
+                         .join(db.TuneSetting)
+                         .where((db.TuneSetting.rhythm == "reel") & (db.TuneSetting.key == "Ador")))
+    assert [t.name for t in reels_in_a_dorian] == ["The Ashplant"]
+
+def test_migrate_abc_to_settings(memory_db):
+    db.Tune.create(name="Single", abc=ASHPLANT)
+    db.Tune.create(name="Listed", abc=repr([ASHPLANT, ASHPLANT_2]))
+
+    db._migrate_abc_to_settings()
+
+    single = db.Tune.get(db.Tune.name == "Single")
+    listed = db.Tune.get(db.Tune.name == "Listed")
+    assert single.abc is None
+    assert single.first_abc() == ASHPLANT
+    assert listed.settings.count() == 2
+
+def test_linked_rows_in_fixed_queries(memory_db, query_budget):
+    tunes = [db.Tune.create(name=f"Tune {i}", key="D", type="REEL") for i in range(3)]
+    recordings = [db.Recording.create(name=f"Track {i}", url=f"spotify:track:{i}", source="spotify")
+                  for i in range(200)]
+    for i, recording in enumerate(recordings):
+        for position, tune in enumerate(tunes):
+            db.RecordingTune.create(recording=recording, tune=tune,
+                                    start_time_secs=position * 60 + i % 2, end_time_secs=position * 60 + 60)
+    db.save_set(tunes[::-1], "Reels")
+    db.save_set(tunes[1:], None)
+
+    with query_budget(5):
+        details = db.tune_details(tunes[1].id)
+    assert len(details.recordings) == 200
+    assert details.recordings[0].start_time_secs == 60
+    assert [[t.name for t in rows] for _, rows in details.sets] == [["Tune 2", "Tune 1", "Tune 0"], ["Tune 1", "Tune 2"]]
+
+    with query_budget(1):
+        rows = db.recording_tunes(recordings[1].id)
+    assert [str(r) for r in rows] == ["Tune 0 (D reel) [0:01-1:00]", "Tune 1 (D reel) [1:01-2:00]",
+                                      "Tune 2 (D reel) [2:01-3:00]"]
+
+    with query_budget(1):
+        assert [r.position for r in db.set_tunes(details.sets[0][0].id)] == [0, 1, 2]
+
+    with query_budget(2):
+        assert len(db.sets_with_tunes()) == 2
+
+def test_open_db_migrates_an_old_database(tmp_path):
+    # A database made before the recordings' track ids and the settings tables
+    path = tmp_path / "gtunes.db"
+    shutil.copy(os.path.join(os.path.dirname(__file__), "..", "gtunes", "data", "bak.gtunes.db"), path)
+    database_path = db.db.database
+    db.db.init(str(path), pragmas={'foreign_keys': 1})
+    try:
+        db.open_db()
+        assert "track_id" in {c.name for c in db.db.get_columns("recording")}
+        assert "recording_track_id" in {i.name for i in db.db.get_indexes("recording")}
+        assert db.Tune.select().where(db.Tune.abc.is_null(False)).count() == 0
+        db.close_db()
+
+        # And opens again once it's migrated
+        db.open_db()
+        db.close_db()
+    finally:
+        db.db.init(database_path, pragmas={'foreign_keys': 1})
+
+def test_migrate_recording_track_ids(memory_db):
+    memory_db.execute_sql("DROP INDEX recording_track_id")
+    memory_db.execute_sql("ALTER TABLE recording DROP COLUMN track_id")
+    for url in ["https://open.spotify.com/track/3dEbGOSpPkqa5p2Jrx9fkS?si=ec31a1a68cb3489e",
+                "https://www.youtube.com/watch?v=zHqC__xzSkI"]:
+        memory_db.execute_sql("INSERT INTO recording (url, source) VALUES (?, ?)", (url, "spotify"))
+
+    db._migrate_recording_track_ids()
+
+    assert [r.track_id for r in db.Recording.select().order_by(db.Recording.id)] == ["3dEbGOSpPkqa5p2Jrx9fkS", None]
+    assert "recording_track_id" in {i.name for i in memory_db.get_indexes("recording")}
+
+def test_save_spotify_recordings(memory_db, query_budget):
+    assert db.spotify_track_id("spotify:track:abc123") == "abc123"
+    assert db.spotify_track_id("https://www.youtube.com/watch?v=abc") is None
+    assert db.spotify_track_id("https://open.spotify.com/intl-de/track/abc123?si=x") == "abc123"
+    assert db.spotify_track_id("spotify:album:abc123") is None
+    assert util.spotify_id("https://open.spotify.com/album/abc123?si=x") == "abc123"
+    assert util.spotify_id("abc123") == "abc123"
+
+    def track(i):
+        return {"id": f"t{i}", "name": f"Tune {i}", "artists": [{"name": "A"}, {"name": "B"}],
+                "album": {"name": "Album"}}
+
+    db.Recording.create(name="Old", url="https://open.spotify.com/track/t0?si=x", source="spotify",
+                        track_id="t0")
+
+    with query_budget(10):
+        added, already_saved = db.save_spotify_recordings([track(i) for i in range(250)] + [track(1)])
+
+    assert added == [f"t{i}" for i in range(1, 250)]
+    assert already_saved == 2
+    assert db.Recording.get(db.Recording.track_id == "t5").artist == "A, B"
+
+def test_session_recording_catalog(memory_db, query_budget):
+    db.save_session_recording(3192, [("Other Reel", [(5, "Other Reel")]),
+                                     ("The Kesh / The Ashplant", [(9, "The Kesh"), (1, "The Ashplant")])],
+                              name="Both Sides Now", artist="Kevin Burke")
+    db.save_session_recording(7, [("The Ashplant", [(1, "The Ashplant")])])
+
+    assert db.session_track_number(3192, 1) == {"track_number": 2, "tune_number": 2,
+                                                "track_string": "The Kesh / The Ashplant"}
+    assert db.session_track_number(3192, 42) == {"track_number": None, "tune_number": None, "track_string": ""}
+    assert db.session_track_number(1, 1) is None
+
+    with query_budget(1):
+        appearances = db.session_appearances(1)
+    assert appearances == [db.SessionAppearance(7, None, None, 1, 1, "The Ashplant"),
+                           db.SessionAppearance(3192, "Both Sides Now", "Kevin Burke", 2, 2,
+                                                "The Kesh / The Ashplant")]
+
+    # Saving again replaces the tracks
+    db.save_session_recording(7, [("Other Reel", [(5, "Other Reel")])])
+    assert db.session_track_number(7, 1)["track_number"] is None
+    assert db.SessionTrackTune.select().count() == 4
@@ -0,0 +1,45 @@
+import gtunes.enrich as enrich
+import gtunes.scrape as scrape
+from gtunes import db
+
+def _fake_search(tune_name, limit=None):
+    if tune_name == "mystery tune":
+        return []
+    if tune_name == "flaky tune":
+        raise ConnectionError("connection reset")
+    return [{"name": "Something Else", "id": "1"}, {"name": "Ashplant, The", "id": "42"}]
+
+def _fake_tune_data(tune_name=None, tune_id=None):
+    return scrape.ScrapeTuneData("The Ashplant", tune_id, "reel", ["X:1\nK:Edor\nABc|"], "Edor")
+
+def test_name_confidence():
+    assert enrich.name_confidence("the ash plant", "Ashplant, The") == 1.0
+    assert enrich.name_confidence("the ashplant", "Banshee, The") < 0.5
+
+def test_enrich_tunes_checkpoints_and_resumes(memory_db, monkeypatch):
+    monkeypatch.setattr(scrape, "query_the_session", _fake_search)
+    monkeypatch.setattr(scrape, "get_tune_data", _fake_tune_data)
+
+    db.Tune.create(name="the ashplant")
+    db.Tune.create(name="mystery tune")
+    db.Tune.create(name="flaky tune")
+
+    summary = enrich.enrich_tunes(list(enrich.pending_tunes()), workers=2, batch_size=2, log_fn=lambda _: None)
+    assert summary.total == 3
+    assert summary.counts[db.EnrichStatus.DONE] == 1
+    assert summary.counts[db.EnrichStatus.NOT_FOUND] == 1
+    assert summary.counts[db.EnrichStatus.FAILED] == 1
+
+    ashplant = db.Tune.get(db.Tune.name == "the ashplant")
+    assert ashplant.ts_id == 42
+    assert ashplant.key == "Edor"
+    assert ashplant.type == "REEL"
+    assert ashplant.first_abc() == "X:1\nK:Edor\nABc|"
+
+    # Only the failed lookup is picked up again on the next run
+    assert [t.name for t in enrich.pending_tunes()] == ["flaky tune"]
+    assert len(enrich.pending_tunes(retry=True)) == 2
+
+    enrich.enrich_tunes(list(enrich.pending_tunes()), log_fn=lambda _: None)
+    flaky = db.TuneEnrichment.get(db.TuneEnrichment.tune == db.Tune.get(db.Tune.name == "flaky tune"))
+    assert flaky.attempts == 2
@@ -0,0 +1,115 @@
+import time
+
+import pytest
+import spotipy
+
+from gtunes import audio
+from gtunes import fakespot
+from gtunes import httpfixtures
+from gtunes import playback
+from gtunes import scrape
+from gtunes import spot_select
+
+CATALOG = {"albums": [
+    {"id": "album1", "name": "Both Sides Now", "artists": ["Kevin Burke"],
+     "images": [{"url": "https://i.scdn.co/image/album1", "height": 640, "width": 640}],
+     "tracks": [{"id": "track11", "name": "Other Reel", "duration_ms": 200000},
+                {"id": "track12", "name": "The Kesh / The Ashplant", "duration_ms": 240000}]},
+    {"id": "album2", "name": "Both Sides Of The Shannon", "artists": ["Someone Else"],
+     "tracks": [{"id": "track21", "name": "Something", "duration_ms": 100000}]},
+]}
+
+def test_album_lookup():
+    sp = fakespot.FakeSpotify(CATALOG)
+
+    album = audio.spot_search_albums("Both Sides Now", sp, artist_name="Kevin Burke")
+    assert album["uri"] == "spotify:album:album1"
+
+    track = audio.spot_get_nth_album_track(album["uri"], 2, sp)
+    assert track["name"] == "The Kesh / The Ashplant"
+    assert sp.track("https://open.spotify.com/track/track12?si=abc")["album"]["name"] == "Both Sides Now"
+    assert sp.calls == {"search": 1, "album_tracks": 1, "track": 1}
+
+def test_bulk_track_lookups():
+    catalog = fakespot.generate_catalog(3, tracks_per_album=60)
+    track_ids = [t["id"] for a in catalog["albums"] for t in a["tracks"]]
+    catalog["playlists"] = [{"id": "playlist1", "tracks": track_ids[:130] + ["missing"]}]
+    sp = fakespot.FakeSpotify(catalog)
+
+    assert audio.spot_album_track_ids("spotify:album:album000001", sp) == track_ids[60:120]
+    assert sp.calls["album_tracks"] == 2
+    assert audio.spot_playlist_track_ids("https://open.spotify.com/playlist/playlist1?si=x", sp) == track_ids[:130]
+    assert sp.calls["playlist_items"] == 2
+
+    tracks = audio.spot_tracks(track_ids[:120] + ["missing"], sp)
+    assert [t["id"] for t in tracks] == track_ids[:120]
+    assert sp.calls["tracks"] == 3
+
+def test_rate_limiting():
+    sp = fakespot.FakeSpotify(CATALOG, rate_limit=100)
+    for _ in range(110):
+        sp.track("track11")
+    assert sp.rate_limited > 0
+
+    sp = fakespot.FakeSpotify(CATALOG, rate_limit=1, status_retries=0)
+    sp.track("track11")
+    with pytest.raises(spotipy.SpotifyException) as e:
+        sp.track("track11")
+    assert e.value.http_status == 429
+
+def test_playback():
+    sp = fakespot.FakeSpotify(CATALOG)
+    assert sp.current_playback() is None
+
+    sp.start_playback(uris=["spotify:track:track12"], position_ms=1000)
+    time.sleep(0.05)
+    playback = sp.current_playback()
+    assert playback["is_playing"]
+    assert playback["progress_ms"] >= 1050
+    assert playback["item"]["uri"] == "spotify:track:track12"
+
+    sp.pause_playback()
+    paused = sp.current_playback()["progress_ms"]
+    time.sleep(0.02)
+    assert sp.current_playback()["progress_ms"] == paused
+
+    calls = sp.calls["start_playback"]
+    assert audio.spot_play_track("spotify:track:track11", sp, retries=3, delay=0)
+    assert sp.calls["start_playback"] == calls + 1
+
+    logged = []
+    sp.active_device = False
+    assert not audio.spot_play_track("spotify:track:track11", sp, retries=0, delay=0, log_fn=logged.append)
+    assert logged
+    assert audio.spot_play_track("spotify:track:track11", sp, retries=0,
+                                 device_id=audio.spot_pick_device(sp.devices()["devices"]))
+
+async def test_spot_app_fills_from_fakes(session_archive, monkeypatch):
+    async_client = scrape.async_client
+    transport = httpfixtures.async_transport(mode="replay", path=session_archive.path)
+    monkeypatch.setattr(scrape, "async_client", lambda: async_client(transport))
+    monkeypatch.setattr(audio, "connect_to_spotify", lambda: fakespot.FakeSpotify(CATALOG, latency=0.01))
+
+    app = spot_select.SpotApp("The Ashplant", [])
+    async with app.run_test() as pilot:
+        deadline = time.monotonic() + 5
+        while not app._tracks and time.monotonic() < deadline:
+            await pilot.pause(0.01)
+
+        track = app._tracks[0]
+        assert track.track_uri == "spotify:track:track12"
+        assert track.track_tunes == "The Kesh / The Ashplant"
+
+        await pilot.pause(spot_select.BATCH_INTERVAL_SECS * 2)
+        assert app._details["spotify:track:track12"] == spot_select.TrackDetails(240000,
+                                                                              "https://i.scdn.co/image/album1")
+        detail = str(app._detail.render())
+        assert "(4:00)" in detail and "2. The Ashplant" in detail
+        assert app._sp.calls["devices"] == 1
+
+        await pilot.press("space", "space", "space")
+        await pilot.pause(playback.DEBOUNCE_SECS + 0.1)
+        assert app._sp.current_playback()["item"]["uri"] == "spotify:track:track12"
+        assert app._sp.calls["start_playback"] == 1
+
+        await pilot.press("q")
@@ -0,0 +1,60 @@
+import pytest
+
+from gtunes import htmlextract
+
+PAGE = """<!DOCTYPE html><html><head><meta charset="utf-8"><title>Recordings</title></head><body>
+<h1>The Kesh <a href="/tunes/jigs">jig</a></h1>
+<ul><li><a href="/tunes">Tunes</a></li></ul>
+<ol class="manifest-inventory">
+  <li class="manifest-item big"><a href="/tunes/9">The Kesh</a><a-preview data-tuneid="9"></a-preview><br>
+    <span class="bill-item-cost">by <a href="/artists/1">Kevin Burke</a><!-- a comment --></span></li>
+  <li class="manifest-item"><a class="manifest-item-title" href="/recordings/1?tune_id=9">Caf&eacute;</a></li>
+</ol>
+<div class="notes">X: 1
+K: G</div></body></html>"""
+
+def _summary(node):
+    return (node.tag, node.attrs, node.text.strip(), [_summary(child) for child in node.children])
+
+@pytest.mark.parametrize("parser", htmlextract.available_parsers())
+def test_parsers_agree(parser):
+    items = htmlextract.extract(PAGE, htmlextract.MANIFEST_ITEMS, parser)
+
+    assert [item["class"] for item in items] == ["manifest-item big", "manifest-item"]
+    assert [a.text for a in items[0].find_all("a")] == ["The Kesh", "Kevin Burke"]
+    assert items[0].find("a-preview")["data-tuneid"] == "9"
+    assert items[0].find("span", class_="bill-item-cost").find("a").text == "Kevin Burke"
+    assert items[1].find("a", class_="manifest-item-title").text == "Café"
+
+    reference = htmlextract.extract(PAGE, htmlextract.TUNE_PAGE, "html.parser")
+    assert [_summary(n) for n in htmlextract.extract(PAGE, htmlextract.TUNE_PAGE, parser)] == \
+        [_summary(n) for n in reference]
+    assert [n.tag for n in reference] == ["h1", "div"]
+    assert reference[1].text == "X: 1\nK: G"
+
+@pytest.mark.parametrize("parser", htmlextract.STREAMING_PARSERS)
+def test_streaming_parsers_give_items_as_they_end(parser):
+    if parser not in htmlextract.available_parsers():
+        pytest.skip(f"{parser} isn't installed")
+
+    data = PAGE.encode("utf-8")
+    second_item = data.index(b'<li class="manifest-item">')
+    extractor = htmlextract.extractor(htmlextract.MANIFEST_ITEMS, parser)
+
+    first = extractor.feed(data[:second_item])
+    assert [a.text for a in first[0].find_all("a")] == ["The Kesh", "Kevin Burke"]
+
+    rest = extractor.feed(data[second_item:]) + extractor.close()
+    assert [item["class"] for item in rest] == ["manifest-item"]
+
+def test_error_pages_have_no_targets():
+    for parser in htmlextract.available_parsers():
+        assert htmlextract.extract("", htmlextract.MANIFEST_ITEMS, parser) == []
+
+def test_default_parser(monkeypatch):
+    monkeypatch.setenv("GTUNES_HTML_PARSER", "bs4")
+    assert htmlextract.default_parser() == "bs4"
+
+    monkeypatch.setenv("GTUNES_HTML_PARSER", "regex")
+    with pytest.raises(ValueError):
+        htmlextract.default_parser()
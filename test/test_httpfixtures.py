@@ -0,0 +1,149 @@
+import concurrent.futures
+
+import requests
+import pytest
+
+from gtunes import db
+from gtunes import httpfixtures
+from gtunes import scrape
+
+def _scrape_with(session, monkeypatch, base_url="https://thesession.org"):
+    monkeypatch.setattr(scrape, "session", session)
+    monkeypatch.setattr(scrape, "BASE_URL", base_url)
+    return scrape.scrape_recording_data(tune_id="1")
+
+def test_request_key_ignores_host_and_query_order():
+    assert (httpfixtures.request_key("get", "https://thesession.org/tunes/search?q=kesh&type=jig")
+            == httpfixtures.request_key("GET", "http://127.0.0.1:8000/tunes/search?type=jig&q=kesh"))
+
+def test_replay(session_archive, monkeypatch):
+    assert len(session_archive) == 3
+
+    session = requests.Session()
+    httpfixtures.mount(session, mode="replay", path=session_archive.path)
+    result = _scrape_with(session, monkeypatch)
+
+    assert result == [scrape.ScrapeRecordingData(album_name="Both Sides Now", track_number=2, tune_number=2,
+                                                 track_tunes="The Kesh / The Ashplant", artist_name="Kevin Burke")]
+    assert session.get("https://thesession.org/not/recorded").status_code == 404
+
+def test_record_from_stand_in_server(session_archive, tmp_path, monkeypatch):
+    session = requests.Session()
+    recorded = httpfixtures.mount(session, mode="record", path=str(tmp_path / "recorded.json.xz"))
+
+    with httpfixtures.StandInServer(session_archive, latency=0.01, jitter=0.01) as server:
+        result = _scrape_with(session, monkeypatch, server.url)
+
+    assert result[0].track_tunes == "The Kesh / The Ashplant"
+    assert server.requests == 2
+    assert recorded.entries.items() <= session_archive.entries.items()
+
+def test_stand_in_server_errors_are_retried(session_archive, monkeypatch):
+    session = requests.Session()
+    httpfixtures.mount(session, mode="live", max_retries=scrape.RETRIES.new(backoff_factor=0))
+
+    with httpfixtures.StandInServer(session_archive, error_rate=0.5, seed=1) as server:
+        result = _scrape_with(session, monkeypatch, server.url)
+        assert result[0].album_name == "Both Sides Now"
+        assert server.errors > 0
+
+    with httpfixtures.StandInServer(session_archive, error_rate=1) as server:
+        with pytest.raises(requests.exceptions.RetryError):
+            _scrape_with(session, monkeypatch, server.url)
+        assert server.requests == scrape.RETRIES.total + 1
+
+async def _iter_scrape_with(transport, monkeypatch, base_url="https://thesession.org"):
+    monkeypatch.setattr(scrape, "BASE_URL", base_url)
+    async with scrape.async_client(transport) as client:
+        return [entry async for entry in scrape.iter_recording_data(client, tune_name="The Ashplant")]
+
+async def test_async_replay(session_archive, monkeypatch):
+    transport = httpfixtures.async_transport(mode="replay", path=session_archive.path)
+    result = await _iter_scrape_with(transport, monkeypatch)
+
+    assert result == [scrape.ScrapeRecordingData(album_name="Both Sides Now", track_number=2, tune_number=2,
+                                                 track_tunes="The Kesh / The Ashplant", artist_name="Kevin Burke")]
+
+async def test_async_record_and_retry(session_archive, tmp_path, monkeypatch):
+    monkeypatch.setattr(scrape, "RETRIES", scrape.RETRIES.new(backoff_factor=0))
+    transport = httpfixtures.async_transport(mode="record", path=str(tmp_path / "recorded.json.xz"))
+
+    with httpfixtures.StandInServer(session_archive, latency=0.01, error_rate=0.3, seed=1) as server:
+        result = await _iter_scrape_with(transport, monkeypatch, server.url)
+
+    assert result[0].track_tunes == "The Kesh / The Ashplant"
+    assert server.errors > 0
+    assert transport.archive.entries.items() <= session_archive.entries.items()
+
+def test_album_pages_come_from_the_catalog(session_archive, memory_db, monkeypatch):
+    session = requests.Session()
+    httpfixtures.mount(session, mode="live")
+
+    with httpfixtures.StandInServer(session_archive) as server:
+        first = _scrape_with(session, monkeypatch, server.url)
+        assert server.requests == 2
+        second = _scrape_with(session, monkeypatch, server.url)
+        # Only the recordings page, the album is in the catalog
+        assert server.requests == 3
+
+    assert first == second
+    assert db.session_appearances(1)[0].album_name == "Both Sides Now"
+
+def test_worker_threads_fill_the_catalog(session_archive, tmp_path, monkeypatch):
+    database_path = db.db.database
+    db.db.init(str(tmp_path / "gtunes.db"), pragmas={'foreign_keys': 1})
+    db.open_db()
+    try:
+        session = requests.Session()
+        httpfixtures.mount(session, mode="replay", path=session_archive.path)
+        # Like enrich and prefetch, which scrape from a pool of threads
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            executor.submit(_scrape_with, session, monkeypatch).result()
+
+        assert db.SessionRecording.select().count() == 1
+        assert db.SessionTrack.select().count() > 0
+        assert db.session_appearances(1)[0].album_name == "Both Sides Now"
+    finally:
+        db.close_db()
+        db.db.init(database_path, pragmas={'foreign_keys': 1})
+
+def _paged_recordings(pages: int, per_page: int) -> httpfixtures.FixtureArchive:
+    archive = httpfixtures.FixtureArchive()
+    links = "".join(f'<a href="/tunes/1/recordings?page={page}">{page}</a>' for page in range(1, pages + 1))
+    for page in range(1, pages + 1):
+        items = "".join(f'<li class="manifest-item"><a class="manifest-item-title" href="/recordings/{i}?tune_id=1">'
+                        f'Album {i}</a><span class="bill-item-cost">by <a href="/artists/1">A</a></span></li>'
+                        for i in range((page - 1) * per_page, page * per_page))
+        key = "GET /tunes/1/recordings" + (f"?page={page}" if page > 1 else "")
+        archive.put(key, 200, f'<ol class="manifest-inventory">{items}</ol><nav>{links}</nav>')
+    return archive
+
+def test_every_page_of_recordings(monkeypatch):
+    session = requests.Session()
+    httpfixtures.mount(session, mode="live")
+
+    with httpfixtures.StandInServer(_paged_recordings(pages=3, per_page=2), latency=0.01, jitter=0.02) as server:
+        result = _scrape_with(session, monkeypatch, server.url)
+        assert [r.album_name for r in result] == [f"Album {i}" for i in range(6)]
+        # Three pages and an album page for each recording
+        assert server.requests == 3 + 6
+
+        server.requests = 0
+        monkeypatch.setattr(scrape, "BASE_URL", server.url)
+        result = scrape.scrape_recording_data(tune_id="1", limit=3)
+        assert [r.album_name for r in result] == ["Album 0", "Album 1", "Album 2"]
+        # The third page isn't needed
+        assert server.requests == 2 + 3
+
+async def test_async_every_page_of_recordings(monkeypatch):
+    archive = _paged_recordings(pages=4, per_page=3)
+    with httpfixtures.StandInServer(archive, latency=0.01, jitter=0.02) as server:
+        monkeypatch.setattr(scrape, "BASE_URL", server.url)
+        async with scrape.async_client() as client:
+            result = [entry async for entry in scrape.iter_recording_data(client, tune_id=1)]
+            assert [r.album_name for r in result] == [f"Album {i}" for i in range(12)]
+
+            server.requests = 0
+            result = [entry async for entry in scrape.iter_recording_data(client, tune_id=1, limit=4)]
+            assert len(result) == 4
+            assert server.requests == 2 + 4
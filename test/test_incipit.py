@@ -0,0 +1,48 @@
+from gtunes import db
+from gtunes import incipit
+
+ASHPLANT = "X: 1\nT: The Ashplant\nR: reel\nM: 4/4\nL: 1/8\nK: Edorian\n|:B2 BA GABd|e2 ed efge|dBGB AGEF|GEDE GABd|"
+COOLEYS = "X: 1\nT: Cooley's\nR: reel\nM: 4/4\nL: 1/8\nK: Edorian\n|:D2|EBBA B2 EB|B2 AB dBAG|FDAD BDAD|"
+
+def test_identify(memory_db, tmp_path):
+    ashplant = db.Tune.create(name="The Ashplant")
+    db.save_tune_settings(ashplant, [ASHPLANT])
+    db.import_session_settings([
+        {"setting_id": "1", "tune_id": "1", "name": "Cooley's", "type": "reel", "meter": "4/4",
+         "mode": "Edorian", "abc": "|:D2|EBBA B2 EB|B2 AB dBAG|FDAD BDAD|"},
+        {"setting_id": "2", "tune_id": "1", "name": "Cooley's", "type": "reel", "meter": "4/4",
+         "mode": "Edorian", "abc": COOLEYS},
+    ])
+
+    index_path = str(tmp_path / "incipit.idx")
+    index = incipit.open_index(index_path, log_fn=lambda _: None)
+    try:
+        # Transposed up a tone and without a key, it should still be found
+        matches = incipit.identify("|:c2 cB ABce|f2 fe", index=index)
+        assert matches[0].name == "The Ashplant"
+        assert matches[0].source == "library"
+        assert matches[0].score == 1.0
+
+        # Both settings of Cooley's only show up once
+        matches = incipit.identify("EBBA B2 EB|B2 AB", key="Edor", index=index)
+        assert [m.name for m in matches] == ["Cooley's"]
+    finally:
+        index.close()
+
+    # Adding a setting makes the index stale, so it's rebuilt
+    cooleys = db.Tune.create(name="Cooley's")
+    db.save_tune_settings(cooleys, [COOLEYS])
+    index = incipit.open_index(index_path, log_fn=lambda _: None)
+    try:
+        assert index.num_docs == 4
+    finally:
+        index.close()
+
+    # So does replacing a setting, though the count and highest id stay the same
+    db.save_tune_settings(cooleys, [ASHPLANT])
+    index = incipit.open_index(index_path, log_fn=lambda _: None)
+    try:
+        matches = incipit.identify("|:c2 cB ABce|f2 fe", index=index)
+        assert {m.name for m in matches if m.score == 1.0} == {"The Ashplant", "Cooley's"}
+    finally:
+        index.close()
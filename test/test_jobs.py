@@ -0,0 +1,87 @@
+import datetime
+import json
+
+import pytest
+
+import gtunes.jobs as jobs
+from gtunes import db
+
+# Job kinds run in worker processes, which import them from this module
+def _square(args, progress):
+    progress(0.5, "halfway")
+    return args["n"] ** 2
+
+def _fail(args, progress):
+    raise ValueError(f"no {args['n']}")
+
+def _rename(args, value):
+    db.Tune.update(name=value).where(db.Tune.id == args["tune_id"]).execute()
+    return {"renamed": value}
+
+def _upper(args, progress):
+    return args["name"].upper()
+
+@pytest.fixture
+def kinds(monkeypatch):
+    monkeypatch.setitem(jobs.KINDS, "square", jobs.JobKind(_square))
+    monkeypatch.setitem(jobs.KINDS, "fail", jobs.JobKind(_fail, max_attempts=2))
+    monkeypatch.setitem(jobs.KINDS, "rename", jobs.JobKind(_upper, _rename))
+    monkeypatch.setattr(jobs, "RETRY_BACKOFF_SECS", 0)
+    monkeypatch.setattr(jobs, "FLUSH_SECS", 0.05)
+
+def test_enqueue_is_idempotent_by_key(memory_db, kinds):
+    first = jobs.enqueue("square", {"n": 2}, key="square:2")
+    assert jobs.enqueue("square", {"n": 2}, key="square:2").id == first.id
+    assert jobs.enqueue("square", {"n": 2}).id != first.id
+
+    # A cancelled job is queued again for its key
+    jobs.cancel([first.id])
+    again = jobs.enqueue("square", {"n": 2}, key="square:2")
+    assert again.id == first.id
+    assert again.status == db.JobStatus.QUEUED.value
+
+    with pytest.raises(ValueError):
+        jobs.enqueue("nonsense", {})
+
+def test_claim_leases_jobs_until_they_expire(memory_db, kinds):
+    for n in range(3):
+        jobs.enqueue("square", {"n": n})
+
+    claimed = jobs.claim("a", 2)
+    assert [json.loads(job.args)["n"] for job in claimed] == [0, 1]
+    assert all(job.status == db.JobStatus.RUNNING.value and job.attempts == 1 for job in claimed)
+    assert [json.loads(job.args)["n"] for job in jobs.claim("b", 5)] == [2]
+    assert jobs.claim("c", 5) == []
+
+    # A runner that died leaves its leases to run out
+    db.Job.update(lease_expires=datetime.datetime.now() - datetime.timedelta(seconds=1)).where(
+        db.Job.lease_owner == "a").execute()
+    reclaimed = jobs.claim("c", 5)
+    assert [job.id for job in reclaimed] == [job.id for job in claimed]
+    assert all(job.lease_owner == "c" and job.attempts == 2 for job in reclaimed)
+
+def test_run_jobs(memory_db, kinds):
+    tune = db.Tune.create(name="the ashplant")
+    square = jobs.enqueue("square", {"n": 3})
+    fail = jobs.enqueue("fail", {"n": 1})
+    rename = jobs.enqueue("rename", {"tune_id": tune.id, "name": tune.name})
+    cancelled = jobs.enqueue("square", {"n": 4})
+    jobs.cancel([cancelled.id])
+
+    summary = jobs.run_jobs(workers=2, log_fn=lambda _: None)
+    assert (summary.done, summary.failed, summary.retried) == (2, 1, 1)
+
+    square = db.Job.get_by_id(square.id)
+    assert (square.status, json.loads(square.result), square.progress) == (db.JobStatus.DONE.value, 9, 1.0)
+    assert square.lease_owner is None
+
+    # Tried again after failing, then given up on
+    fail = db.Job.get_by_id(fail.id)
+    assert (fail.status, fail.attempts) == (db.JobStatus.FAILED.value, 2)
+    assert "ValueError: no 1" in fail.error
+
+    # Results are applied by the runner
+    assert db.Tune.get_by_id(tune.id).name == "THE ASHPLANT"
+    assert json.loads(db.Job.get_by_id(rename.id).result) == {"renamed": "THE ASHPLANT"}
+
+    assert db.Job.get_by_id(cancelled.id).status == db.JobStatus.CANCELLED.value
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+import spotipy
+
+from gtunes import fakespot
+from gtunes import playback
+
+CATALOG = fakespot.generate_catalog(2, tracks_per_album=2)
+
+@pytest.fixture
+def notified():
+    return []
+
+async def _run(queue, *commands, settle=0.1):
+    task = asyncio.create_task(queue.run())
+    for command in commands:
+        command()
+        await asyncio.sleep(0)
+    await asyncio.sleep(queue.debounce_secs + settle)
+    task.cancel()
+
+async def test_presses_are_debounced_and_coalesced(notified):
+    sp = fakespot.FakeSpotify(CATALOG)
+    queue = playback.PlaybackQueue(sp, notify=lambda m, severity="information": notified.append(m),
+                                   debounce_secs=0.05)
+
+    await _run(queue, lambda: queue.play("spotify:track:track00000000"),
+               lambda: queue.play("spotify:track:track00000001"))
+    assert sp.current_playback()["item"]["id"] == "track00000001"
+    assert sp.calls["start_playback"] == 1
+    assert notified == ["Playing spotify:track:track00000001"]
+
+    # Pausing and playing again before either is sent leaves it playing
+    await _run(queue, queue.pause, lambda: queue.play("spotify:track:track00000001"))
+    assert sp.calls["start_playback"] == 1
+    assert "pause_playback" not in sp.calls
+    assert queue.sent == 1
+
+async def test_device_is_picked_from_cached_list(notified):
+    sp = fakespot.FakeSpotify(CATALOG, active_device=False)
+    queue = playback.PlaybackQueue(sp, notify=lambda m, severity="information": notified.append((m, severity)),
+                                   debounce_secs=0.01)
+
+    await _run(queue, lambda: queue.play("spotify:track:track00000000", label="Tune"))
+    await _run(queue, queue.pause)
+    await _run(queue, lambda: queue.play("spotify:track:track00010001"))
+    assert sp.calls["devices"] == 1
+    assert notified[:2] == [("Playing Tune", "information"), ("Paused", "information")]
+
+
+async def test_errors_are_notified(notified, monkeypatch):
+    sp = fakespot.FakeSpotify(CATALOG)
+    queue = playback.PlaybackQueue(sp, notify=lambda m, severity="information": notified.append((m, severity)),
+                                   debounce_secs=0.01)
+
+    def start_playback(**kwargs):
+        raise spotipy.SpotifyException(403, -1, "Player command failed: Premium required")
+    monkeypatch.setattr(sp, "start_playback", start_playback)
+
+    await _run(queue, lambda: queue.play("spotify:track:track00000000"))
+    assert notified == [("Spotify: Player command failed: Premium required", "error")]
@@ -0,0 +1,59 @@
+import datetime
+import random
+
+import numpy as np
+
+from gtunes import db
+from gtunes import practice
+
+def test_replay_logs_matches_next_state():
+    random.seed(0)
+    histories = {tune_id: [random.choice(list(db.Grade)) for _ in range(random.randint(1, 12))]
+                 for tune_id in range(1, 50)}
+
+    tune_ids, grades, reviewed_at = [], [], []
+    for tune_id, history in histories.items():
+        for day, grade in enumerate(history):
+            tune_ids.append(tune_id)
+            grades.append(grade.value)
+            reviewed_at.append(day * practice.SECONDS_PER_DAY)
+
+    states = practice.replay_logs(np.array(tune_ids), np.array(grades), np.array(reviewed_at, dtype=float))
+
+    for i, tune_id in enumerate(states["tune"]):
+        expected = practice.ReviewState()
+        for grade in histories[tune_id]:
+            expected = practice.next_state(expected, grade)
+
+        assert np.isclose(states["ease"][i], expected.ease)
+        assert np.isclose(states["interval_days"][i], expected.interval_days)
+        assert states["repetitions"][i] == expected.repetitions
+        assert states["lapses"][i] == expected.lapses
+
+def test_practice_session(memory_db):
+    db.Tune.create(name="Still learning", status=db.Status.TODO.value)
+    db.Tune.create(name="The Ashplant", status=db.Status.CAN_PLAY.value)
+    db.Tune.create(name="Cooley's", status=db.Status.MASTERED.value)
+
+    assert practice.enroll_tunes() == 2
+    assert practice.enroll_tunes() == 0
+
+    start = datetime.datetime.now()
+    session = practice.PracticeSession()
+    for review in practice.due_reviews(10, start):
+        session.grade(review, db.Grade.GOOD, start)
+    assert db.ReviewLog.select().count() == 0
+    assert session.flush() == 2
+
+    assert practice.due_reviews(10, start) == []
+    tomorrow = start + datetime.timedelta(days=1, minutes=1)
+    assert len(practice.due_reviews(1, tomorrow)) == 1
+
+    # The schedule recomputed from the log is the one the session wrote
+    before = {r.tune_id: (r.interval_days, r.due) for r in db.Review.select()}
+    assert practice.recompute_schedules() == 2
+    after = {r.tune_id: (r.interval_days, r.due) for r in db.Review.select()}
+    assert before.keys() == after.keys()
+    for tune_id in before:
+        assert before[tune_id][0] == after[tune_id][0]
+        assert abs(before[tune_id][1] - after[tune_id][1]) < datetime.timedelta(seconds=1)
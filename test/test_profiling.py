@@ -0,0 +1,58 @@
+import json
+import threading
+
+import pytest
+
+from gtunes import db
+from gtunes import profiling
+
+@pytest.fixture
+def profiled(monkeypatch, tmp_path):
+    trace_path = str(tmp_path / "trace.json")
+    monkeypatch.setattr(profiling, "enabled", True)
+    monkeypatch.setattr(profiling, "_trace_path", trace_path)
+    profiling.reset()
+
+    yield trace_path
+
+    profiling.reset()
+
+def test_disabled_spans_do_nothing():
+    assert not profiling.enabled
+    with profiling.span("anything") as s:
+        s.add_bytes(10)
+    assert profiling.summary() == []
+
+def test_span_tree(profiled):
+    with profiling.span("command"):
+        for _ in range(3):
+            with profiling.span("http") as s:
+                s.add_bytes(100)
+        with profiling.span("subprocess"):
+            pass
+
+    thread = threading.Thread(target=lambda: profiling.span("worker").__enter__().__exit__())
+    thread.start()
+    thread.join()
+
+    rows = {name: (depth, count, n_bytes) for depth, name, count, _, n_bytes in profiling.summary()}
+    assert rows == {
+        "command": (0, 1, 0),
+        "http": (1, 3, 300),
+        "subprocess": (1, 1, 0),
+        "worker": (0, 1, 0),
+    }
+
+    profiling.write_trace(profiled)
+    with open(profiled) as trace_file:
+        events = json.load(trace_file)["traceEvents"]
+    assert len(events) == 6
+    assert {e["name"] for e in events if e["args"].get("bytes") == "100"} == {"http"}
+
+def test_queries_are_spans(profiled, memory_db):
+    db.Tune.create(name="The Ashplant")
+    list(db.Tune.select())
+
+    names = [name for _, name, *_ in profiling.summary()]
+    assert "sqlite INSERT" in names
+    assert "sqlite SELECT" in names
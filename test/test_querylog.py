@@ -0,0 +1,34 @@
+import pytest
+
+from gtunes import db
+from gtunes import querylog
+
+def test_shape_collapses_parameter_lists():
+    assert (querylog.shape('SELECT * FROM "tune" WHERE "id" IN (?, ?, ?)')
+            == querylog.shape('SELECT * FROM "tune" WHERE "id" IN (?,?)'))
+
+def test_n_plus_one_detected(memory_db):
+    recording = db.Recording.create(name="Both Sides Now", url="spotify:track:1", source="spotify")
+    for i in range(6):
+        db.RecordingTune.create(tune=db.Tune.create(name=f"Tune {i}"), recording=recording)
+
+    with querylog.capture() as log:
+        names = [rt.tune.name for rt in recording.recording_tunes]
+
+    assert len(names) == 6
+    assert log.count == 7
+    [(repeated_shape, count)] = log.repeated()
+    assert count == 6
+    assert '"tune"' in repeated_shape
+    assert "possible N+1" in log.report()
+
+def test_query_budget(memory_db, query_budget):
+    db.Tune.create(name="The Ashplant")
+
+    with query_budget(1):
+        db.Tune.get(db.Tune.name == "The Ashplant")
+
+    with pytest.raises(querylog.QueryBudgetExceeded):
+        with query_budget(10, max_repeats=1):
+            for _ in range(2):
+                db.Tune.get(db.Tune.name == "The Ashplant")
@@ -0,0 +1,123 @@
+import asyncio
+import threading
+import time
+
+import httpx
+import pytest
+import requests
+
+from gtunes import httpfixtures
+from gtunes import scheduler
+from gtunes.scheduler import HostLimits, Priority
+
+HOST = "thesession.org"
+
+def _hold(sched, request_priority, order, held, release):
+    """
+    Take a slot, note the order it was granted in, and hold it until released.
+    """
+    with sched.slot(HOST, request_priority):
+        order.append(request_priority)
+        held.release()
+        release.wait()
+
+def _start(sched, priorities, order, held, release):
+    threads = []
+    for request_priority in priorities:
+        thread = threading.Thread(target=_hold, args=(sched, request_priority, order, held, release))
+        thread.start()
+        threads.append(thread)
+        # So they queue in this order
+        time.sleep(0.01)
+    return threads
+
+def test_interactive_requests_go_first_and_have_reserved_slots():
+    sched = scheduler.Scheduler({HOST: HostLimits(concurrency=3, reserved=1)})
+    order, held, release = [], threading.Semaphore(0), threading.Event()
+
+    # Background requests can't take the reserved slot
+    threads = _start(sched, [Priority.BULK] * 4, order, held, release)
+    held.acquire(), held.acquire()
+    assert sched.in_flight(HOST) == 2
+
+    # but an interactive one gets it straight away, and goes ahead of the queue
+    threads += _start(sched, [Priority.INTERACTIVE], order, held, release)
+    assert held.acquire(timeout=1)
+    assert order == [Priority.BULK, Priority.BULK, Priority.INTERACTIVE]
+
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert sched.in_flight(HOST) == 0
+
+    stats = sched.stats()
+    assert stats[Priority.BULK].requests == 4
+    assert stats[Priority.INTERACTIVE].wait.percentile(0.5) <= 5
+
+def test_background_classes_share_by_weight():
+    sched = scheduler.Scheduler({HOST: HostLimits(concurrency=1, reserved=0)})
+    order = []
+
+    blocker = threading.Event()
+    first = threading.Thread(target=_hold, args=(sched, Priority.BULK, [], threading.Semaphore(0), blocker))
+    first.start()
+    time.sleep(0.01)
+
+    def request(request_priority):
+        with sched.slot(HOST, request_priority):
+            order.append(request_priority)
+
+    threads = []
+    for request_priority in [Priority.BULK] * 3 + [Priority.PREFETCH] * 10:
+        threads.append(threading.Thread(target=request, args=(request_priority,)))
+        threads[-1].start()
+        time.sleep(0.01)
+
+    blocker.set()
+    for thread in [first] + threads:
+        thread.join()
+
+    # Four prefetches to a bulk request, so neither class starves
+    p, b = Priority.PREFETCH, Priority.BULK
+    assert order == [p, p, p, p] + [p, p, p, p, b] + [p, p, b, b]
+
+def test_rate_limit():
+    sched = scheduler.Scheduler({HOST: HostLimits(concurrency=4, rate=20, reserved=0)})
+    start = time.monotonic()
+    for _ in range(30):
+        with sched.slot(HOST):
+            pass
+    # A second's worth at once, then 20 a second
+    assert 0.4 < time.monotonic() - start < 1.5
+
+async def test_cancelled_waits_give_up_their_place():
+    sched = scheduler.Scheduler({HOST: HostLimits(concurrency=1, reserved=0)})
+
+    async with sched.aslot(HOST):
+        waiting = asyncio.ensure_future(sched.aslot(HOST).__aenter__())
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+
+    async with sched.aslot(HOST, Priority.BULK):
+        assert sched.in_flight(HOST) == 1
+    assert sched.in_flight(HOST) == 0
+
+async def test_scheduled_sessions_and_transports(session_archive):
+    sched = scheduler.Scheduler({})
+
+    session = requests.Session()
+    httpfixtures.mount(session, mode="replay", path=session_archive.path)
+    scheduler.schedule(session, sched)
+    with scheduler.priority(Priority.BULK):
+        assert session.get("https://thesession.org/tunes/1/recordings").status_code == 200
+
+    transport = scheduler.ScheduledAsyncTransport(
+        httpfixtures.async_transport(mode="replay", path=session_archive.path), sched)
+    async with httpx.AsyncClient(transport=transport) as client:
+        assert (await client.get("https://thesession.org/recordings/3192")).status_code == 200
+
+    stats = sched.stats()
+    assert (stats[Priority.BULK].requests, stats[Priority.INTERACTIVE].requests) == (1, 1)
+    assert "requests" in str(stats[Priority.BULK])
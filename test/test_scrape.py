@@ -1,7 +1,35 @@
 import gtunes.scrape as scrape
+from gtunes import httpfixtures
+import os
 import queue
+import pytest
+import requests
 from threading import Event, Thread
 
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "thesession.json.xz")
+
+@pytest.fixture(autouse=True)
+def thesession(monkeypatch, session_archive):
+    """
+    Replays the TheSession responses recorded in FIXTURES, or conftest's cut down
+    pages when none have been recorded, so the tests never go to the network by
+    default. Run with GTUNES_HTTP_MODE=record to record them, or
+    GTUNES_HTTP_MODE=live to test against the site.
+    """
+    mode = os.getenv("GTUNES_HTTP_MODE") or "replay"
+    path = FIXTURES
+    if mode == "replay" and not os.path.exists(FIXTURES):
+        path = session_archive.path
+    session = requests.Session()
+    archive = httpfixtures.mount(session, mode=mode, path=path, max_retries=scrape.RETRIES)
+    monkeypatch.setattr(scrape, "session", session)
+
+    yield
+
+    if archive is not None and archive.changed:
+        os.makedirs(os.path.dirname(FIXTURES), exist_ok=True)
+        archive.save()
+
 def test_scrape_recording_data():
     result = scrape.scrape_recording_data(tune_name="The Ashplant", limit=1)
     assert isinstance(result, list)
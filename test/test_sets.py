@@ -0,0 +1,48 @@
+from gtunes import db
+from gtunes import sets
+
+def _add(name, tune_type, key, status=db.Status.CAN_PLAY):
+    return db.Tune.create(name=name, type=tune_type, key=key, status=status.value)
+
+def test_suggest_prefers_key_changes(memory_db, tmp_path):
+    kesh = _add("The Kesh", "JIG", "Gmaj")
+    morrison = _add("Morrison's", "JIG", "Edor")
+    banish = _add("Banish Misfortune", "JIG", "Dmix")
+    swallowtail = _add("Swallowtail", "JIG", "Emin")
+    cooleys = _add("Cooley's", "REEL", "Emin")
+    _add("Still learning", "JIG", "Dmaj", db.Status.TODO)
+
+    graph = sets.load_graph(path=str(tmp_path / "graph.npz"))
+    assert set(graph.nodes) == {kesh.id, morrison.id, banish.id, swallowtail.id, cooleys.id}
+
+    suggestions = graph.suggest(kesh.id, 3)
+    score, path = suggestions[0]
+    assert path[0] == kesh.id
+    assert len(path) == len(set(path)) == 3
+    # Only jigs, and G to D is the best change there is
+    assert set(path) <= {kesh.id, morrison.id, banish.id, swallowtail.id}
+    assert path[1] == banish.id
+    assert all(s <= score for s, _ in suggestions)
+
+def test_refresh_is_incremental(memory_db, tmp_path):
+    path = str(tmp_path / "graph.npz")
+    tunes = [_add(f"Reel {i}", "REEL", key) for i, key in enumerate(["Dmaj", "Gmaj", "Amix", "Edor", "Bmin"])]
+    graph = sets.load_graph(path=path)
+
+    # Nothing changed
+    assert sets.SetGraph.load(path).refresh(sets.playable_nodes()) == 0
+
+    db.save_set(tunes[:2])
+    tunes[2].key = "Gmaj"
+    tunes[2].save()
+    tunes[4].delete_instance()
+
+    loaded = sets.SetGraph.load(path)
+    assert loaded.nodes == graph.nodes
+    assert loaded.refresh(sets.playable_nodes()) == 3
+
+    rebuilt = sets.SetGraph()
+    rebuilt.refresh(sets.playable_nodes())
+    for tune_id, (targets, weights) in rebuilt.adjacency.items():
+        loaded_targets, loaded_weights = loaded.adjacency[tune_id]
+        assert dict(zip(loaded_targets.tolist(), loaded_weights.tolist())) == dict(zip(targets.tolist(), weights.tolist()))
@@ -0,0 +1,49 @@
+import numpy as np
+from gtunes import db
+from gtunes import similarity
+
+ASHPLANT = "X: 1\nT: The Ashplant\nR: reel\nM: 4/4\nL: 1/8\nK: Edorian\n|:B2 BA GABd|e2 ed efge|dBGB AGEF|GEDE GABd|"
+ASHPLANT_IN_A = "X: 2\nT: The Ashplant\nR: reel\nM: 4/4\nL: 1/8\nK: Adorian\n|:e2 ed cdeg|a2 ag abc'a|gece dcAB|cAGA cdeg|"
+POLKA = "X: 1\nT: Britches Full Of Stitches\nR: polka\nM: 2/4\nL: 1/8\nK: Amajor\n|:A>B AF|ED EF|A>B AF|E2 E2|"
+
+def test_encode():
+    vector = similarity.encode(ASHPLANT)
+    assert vector.shape == (similarity.DIMENSIONS,)
+    assert np.isclose(np.linalg.norm(vector), 1.0)
+
+    # Transposing doesn't change the encoding
+    assert np.allclose(vector, similarity.encode(ASHPLANT_IN_A))
+
+def test_similar_tunes(memory_db, tmp_path):
+    ashplant = db.Tune.create(name="The Ashplant")
+    db.save_tune_settings(ashplant, [ASHPLANT])
+    db.save_tune_settings(db.Tune.create(name="The Ashplant in A"), [ASHPLANT_IN_A])
+    db.save_tune_settings(db.Tune.create(name="Britches Full Of Stitches"), [POLKA])
+
+    index = similarity.update_index(str(tmp_path))
+    assert len(index) == 3
+
+    matches = similarity.similar_tunes([(ASHPLANT, None)], limit=2, index=index, exclude_tune_id=ashplant.id)
+    assert [m.name for m in matches] == ["The Ashplant in A", "Britches Full Of Stitches"]
+    assert matches[0].score > 0.99
+
+    # Nothing changed, so nothing is rebuilt
+    assert similarity.update_index(str(tmp_path)).state == index.state
+
+    db.save_tune_settings(ashplant, [ASHPLANT, ASHPLANT_IN_A])
+    assert len(similarity.update_index(str(tmp_path))) == 4
+
+def test_update_index_compares_checksums_once_the_state_changes(tmp_path):
+    settings = [(db.SettingSource.LIBRARY.value, 1, ASHPLANT, None)]
+    index = similarity.update_index(str(tmp_path), settings=settings, state=(1, 1, 0, 1))
+
+    # Same id and count, new version: the changed setting is re-encoded
+    settings = [(db.SettingSource.LIBRARY.value, 1, POLKA, None)]
+    updated = similarity.update_index(str(tmp_path), settings=settings, state=(1, 1, 0, 2))
+    assert np.allclose(updated.vectors[0], similarity.encode(POLKA))
+
+    # The same state isn't scanned at all
+    def unread():
+        raise AssertionError("settings were scanned")
+        yield
+    assert similarity.update_index(str(tmp_path), settings=unread(), state=updated.state).state == updated.state
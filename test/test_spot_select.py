@@ -1,6 +1,9 @@
 import logging
 import time
 import gtunes.spot_select as spot_select
+from gtunes import audio
+from gtunes import fakespot
+from gtunes import scrape
 from textual.color import Color
 import asyncio
 
@@ -14,4 +17,31 @@ async def test_spot_select_app():
         time.sleep(0.2)
         logging.debug("Test pressing q")
 
-        await pilot.press("q")
\ No newline at end of file
+        await pilot.press("q")
+
+async def test_spot_select_thousands_of_rows(monkeypatch):
+    rows = 1200
+    catalog = fakespot.generate_catalog(rows // 12, tracks_per_album=12)
+    monkeypatch.setattr(audio, "connect_to_spotify", lambda: fakespot.FakeSpotify(catalog))
+
+    async def iter_recording_data(client, **kwargs):
+        for i in range(rows):
+            album = catalog["albums"][i // 12]
+            yield scrape.ScrapeRecordingData(album_name=album["name"], track_number=i % 12 + 1, tune_number=1,
+                                             track_tunes="", artist_name=album["artists"][0])
+    monkeypatch.setattr(scrape, "iter_recording_data", iter_recording_data)
+
+    output = []
+    app = spot_select.SpotApp("Lots", output)
+    async with app.run_test() as pilot:
+        deadline = time.monotonic() + 20
+        while app._table.row_count < rows and time.monotonic() < deadline:
+            await pilot.pause(0.05)
+        assert app._table.row_count == rows
+
+        app._table.move_cursor(row=rows - 1)
+        start = time.monotonic()
+        await pilot.press("x", "up", "x", "s")
+        assert time.monotonic() - start < 1
+
+    assert [(t.album_name, t.track_number) for t in output] == [("Album 99", 11), ("Album 99", 12)]
@@ -0,0 +1,101 @@
+import concurrent.futures
+import time
+
+import pytest
+import spotipy
+
+from gtunes import audio
+from gtunes import fakespot
+from gtunes import scheduler
+from gtunes import spotbroker
+
+CATALOG = fakespot.generate_catalog(30, tracks_per_album=3)
+
+def _in_threads(fn, args, workers=None):
+    args = list(args)
+    with concurrent.futures.ThreadPoolExecutor(workers or len(args)) as pool:
+        return list(pool.map(fn, args))
+
+def test_lookups_are_batched_and_deduplicated():
+    sp = fakespot.FakeSpotify(CATALOG, latency=0.02)
+    broker = spotbroker.SpotifyBroker(sp, window_secs=0.05)
+
+    album_ids = [f"spotify:album:album{i % 10:06d}" for i in range(40)]
+    albums = _in_threads(broker.album, album_ids)
+    assert [a["uri"] for a in albums] == album_ids
+    assert sp.calls == {"albums": 1}
+
+    track_ids = [t["id"] for a in CATALOG["albums"] for t in a["tracks"]][:60]
+    tracks = _in_threads(broker.track, track_ids)
+    assert [t["id"] for t in tracks] == track_ids
+    assert sp.calls["tracks"] == 2
+
+    stats = broker.stats()
+    assert stats.requests == 100
+    assert stats.deduplicated == 30
+    assert stats.queued == stats.in_flight == 0
+    assert stats.p95_ms >= 20
+    broker.close()
+
+def test_album_lookups_from_the_pipeline():
+    sp = fakespot.FakeSpotify(CATALOG, latency=0.02)
+    broker = spotbroker.SpotifyBroker(sp)
+
+    searches = _in_threads(lambda _: audio.spot_search_albums("Album 7", broker), range(8))
+    assert all(album["name"] == "Album 7" for album in searches)
+    track = audio.spot_get_nth_album_track(searches[0]["uri"], 2, broker)
+    assert track["id"] == CATALOG["albums"][7]["tracks"][1]["id"]
+    assert "album_tracks" not in sp.calls
+    assert sp.calls["search"] < 8
+
+    with pytest.raises(spotipy.SpotifyException) as e:
+        broker.album("spotify:album:missing")
+    assert e.value.http_status == 404
+    broker.close()
+
+def test_rate_limits_back_off_every_caller():
+    sp = fakespot.FakeSpotify(CATALOG, rate_limit=5, status_retries=0)
+    broker = spotbroker.SpotifyBroker(sp)
+
+    results = _in_threads(lambda q: broker.search(q, type="album"), [f"Album {i}" for i in range(12)], workers=4)
+    assert len(results) == 12
+    assert sp.rate_limited > 0
+    assert broker.stats().calls > 12
+    broker.close()
+
+def test_batches_take_the_most_urgent_priority():
+    priorities = []
+
+    class Recording(fakespot.FakeSpotify):
+        def albums(self, albums, market=None):
+            priorities.append(scheduler.current_priority())
+            return super().albums(albums, market)
+
+    broker = spotbroker.SpotifyBroker(Recording(CATALOG), window_secs=0.05)
+
+    def lookup(args):
+        album_id, request_priority = args
+        with scheduler.priority(request_priority):
+            return broker.album(album_id)
+
+    _in_threads(lookup, [("album000001", scheduler.Priority.BULK), ("album000002", scheduler.Priority.BULK)])
+    _in_threads(lookup, [("album000003", scheduler.Priority.BULK), ("album000004", scheduler.Priority.PREFETCH)])
+    assert priorities == [scheduler.Priority.BULK, scheduler.Priority.PREFETCH]
+    broker.close()
+
+def test_close_stops_the_dispatcher():
+    sp = fakespot.FakeSpotify(CATALOG)
+    broker = spotbroker.SpotifyBroker(sp, window_secs=10)
+
+    # A lookup waiting out a long window is still made on close
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        waiting = pool.submit(broker.album, "album000001")
+        while not broker.stats().queued:
+            time.sleep(0.001)
+        broker.close()
+        assert waiting.result(timeout=1)["id"] == "album000001"
+
+    assert not broker._dispatcher.is_alive()
+    # Later lookups are made by their callers
+    assert broker.track(CATALOG["albums"][0]["tracks"][0]["id"])["track_number"] == 1
+    assert sp.calls == {"albums": 1, "tracks": 1}
@@ -0,0 +1,57 @@
+import requests
+
+from gtunes import audio
+from gtunes import db
+from gtunes import fakespot
+from gtunes import httpfixtures
+from gtunes import scrape
+from gtunes import spot_select
+from gtunes import spotcandidates
+
+CATALOG = {"albums": [
+    {"id": "album1", "name": "Both Sides Now", "artists": ["Kevin Burke"],
+     "tracks": [{"id": "track11", "name": "Other Reel"}, {"id": "track12", "name": "The Kesh / The Ashplant"}]},
+]}
+
+def test_prefetch_and_load(memory_db, session_archive, monkeypatch):
+    session = requests.Session()
+    httpfixtures.mount(session, mode="replay", path=session_archive.path)
+    monkeypatch.setattr(scrape, "session", session)
+    sp = fakespot.FakeSpotify(CATALOG)
+    monkeypatch.setattr(audio, "connect_to_spotify", lambda: sp)
+
+    ashplant = db.Tune.create(name="The Ashplant", ts_id=1)
+    db.Tune.create(name="Known Already", status=db.Status.CAN_PLAY.value)
+    missing = db.Tune.create(name="Not On TheSession", ts_id=2)
+
+    tunes = list(spotcandidates.tunes_to_prefetch(db.Status.TODO))
+    assert [t.name for t in tunes] == ["The Ashplant", "Not On TheSession"]
+
+    summary = spotcandidates.prefetch_tunes(tunes, workers=2, log_fn=lambda _: None)
+    assert (summary.tunes, summary.recordings, summary.matched, summary.failed) == (2, 1, 1, 0)
+    assert [t.name for t in spotcandidates.tunes_to_prefetch(db.Status.TODO)] == ["Not On TheSession"]
+
+    tracks, known = spotcandidates.load_candidates(ashplant.id)
+    assert [t.track_uri for t in tracks] == ["spotify:track:track12"]
+    assert tracks[0].score > 0.8
+    assert known == {("Both Sides Now", "Kevin Burke")}
+    assert spotcandidates.load_candidates(missing.id) == ([], set())
+
+    # The album pages the workers scraped are saved with the candidates
+    assert [r.recording_id for r in db.SessionRecording.select()] == [3192]
+
+async def test_selector_opens_on_candidates(monkeypatch):
+    monkeypatch.setattr(audio, "connect_to_spotify", lambda: fakespot.FakeSpotify(CATALOG))
+
+    async def iter_recording_data(client, **kwargs):
+        raise AssertionError("Scraped without refresh")
+        yield
+    monkeypatch.setattr(scrape, "iter_recording_data", iter_recording_data)
+
+    candidate = audio.SpotTuneTrackData(album_name="Both Sides Now", track_uri="spotify:track:track12",
+                                        track_name="The Kesh / The Ashplant", artist_name="Kevin Burke")
+    app = spot_select.SpotApp("The Ashplant", [], candidates=[candidate], refresh=False)
+    async with app.run_test() as pilot:
+        await pilot.pause(spot_select.BATCH_INTERVAL_SECS * 2)
+        assert app._tracks == [candidate]
+        await pilot.press("q")